@@ -18,10 +18,97 @@ import WikicorpusTextFormatting
 
 import argparse
 import itertools
+import json
 import multiprocessing
 import os
 import pprint
+import random
 import subprocess
+import sys
+import time
+
+# create_pretraining_data.py and tokenization.py are in the parent directory
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def init_shard_worker(vocab_file, do_lower_case):
+    """Loads the vocab once per worker process, for all the shards it creates."""
+    from tokenization import BertTokenizer
+
+    global shard_tokenizer
+    shard_tokenizer = BertTokenizer(vocab_file, do_lower_case=do_lower_case, max_len=512)
+
+
+def create_shard(job):
+    """Creates the pretraining instances of one text shard and writes them to
+    its output file, retrying on failure.
+
+    The output is written to a temporary file which is renamed once complete,
+    so that an interrupted shard is created again on resume. Returns the stats
+    of the shard, or its error.
+    """
+    from create_pretraining_data import create_training_instances, write_instance_to_example_file
+
+    name, input_file, output_file, options = job
+    for attempt in range(options['retries'] + 1):
+        start = time.time()
+        try:
+            rng = random.Random(options['random_seed'])
+            instances = create_training_instances(
+                [input_file], shard_tokenizer, options['max_seq_length'], options['dupe_factor'],
+                options['short_seq_prob'], options['masked_lm_prob'], options['max_predictions_per_seq'], rng)
+            temp_file = output_file + '.tmp'
+            write_instance_to_example_file(instances, shard_tokenizer, options['max_seq_length'],
+                                           options['max_predictions_per_seq'], temp_file)
+            os.replace(temp_file, output_file)
+            return {'shard': name,
+                    'instances': len(instances),
+                    'tokens': sum(len(instance.tokens) for instance in instances),
+                    'seconds': round(time.time() - start, 1)}
+        except Exception as e:
+            error = '{}: {}'.format(type(e).__name__, e)
+            print('Shard {} failed (attempt {}): {}'.format(name, attempt + 1, error))
+    return {'shard': name, 'error': error}
+
+
+def create_shards(jobs, output_dir, options, n_processes):
+    """Creates the shards of `jobs` with a pool of worker processes.
+
+    The stats of every completed shard are appended to manifest.jsonl in
+    `output_dir`. Shards which are in the manifest and whose output file exists
+    are skipped, so that an interrupted run only creates the missing shards.
+    """
+    manifest_file = os.path.join(output_dir, 'manifest.jsonl')
+    completed = set()
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as manifest:
+            completed = set(json.loads(line)['shard'] for line in manifest if line.strip())
+    pending = [job for job in jobs if not (job[0] in completed and os.path.exists(job[2]))]
+    print('Creating {} shards, {} already done'.format(len(pending), len(jobs) - len(pending)))
+    if not pending:
+        return
+
+    # fail here on missing dependencies, a pool respawns failing initializers forever
+    import create_pretraining_data  # noqa: F401
+
+    n_processes = min(n_processes, multiprocessing.cpu_count(), len(pending))
+    failed = []
+    start = time.time()
+    with multiprocessing.Pool(n_processes, initializer=init_shard_worker,
+                              initargs=(options['vocab_file'], options['do_lower_case'])) as pool, \
+            open(manifest_file, 'a') as manifest:
+        for done, stats in enumerate(pool.imap_unordered(create_shard, [job + (options,) for job in pending]), 1):
+            if 'error' in stats:
+                failed.append(stats['shard'])
+                continue
+            manifest.write(json.dumps(stats) + '\n')
+            manifest.flush()
+            print('[{}/{}] {}: {} instances, {} tokens in {}s ({:.0f}s elapsed)'.format(
+                done, len(pending), stats['shard'], stats['instances'], stats['tokens'], stats['seconds'],
+                time.time() - start))
+
+    if failed:
+        raise RuntimeError('Failed to create shards: {}'.format(', '.join(sorted(failed))))
 
 
 def main(args):
@@ -142,84 +229,31 @@ def main(args):
         else:
             assert False, 'Unsupported dataset for sharding'
 
-    elif args.action == 'create_tfrecord_files':
-        assert False, 'TFrecord creation not supported in this PyTorch model example release.' \
-                      ''
-        if not os.path.exists(directory_structure['tfrecord'] + "/" + args.dataset):
-            os.makedirs(directory_structure['tfrecord'] + "/" + args.dataset)
-
-        def create_record_worker(filename_prefix, shard_id, output_format='tfrecord'):
-            bert_preprocessing_command = 'python create_pretraining_data.py'
-            bert_preprocessing_command += ' --input_file=' + directory_structure['sharded'] + '/' + args.dataset + '/' + filename_prefix + '_' + str(shard_id) + '.txt'
-            bert_preprocessing_command += ' --output_file=' + directory_structure['tfrecord'] + '/' + args.dataset + '/' + filename_prefix + '_' + str(shard_id) + '.' + output_format
-            bert_preprocessing_command += ' --vocab_file=' + args.vocab_file
-            bert_preprocessing_command += ' --do_lower_case' if args.do_lower_case else ''
-            bert_preprocessing_command += ' --max_seq_length=' + str(args.max_seq_length)
-            bert_preprocessing_command += ' --max_predictions_per_seq=' + str(args.max_predictions_per_seq)
-            bert_preprocessing_command += ' --masked_lm_prob=' + str(args.masked_lm_prob)
-            bert_preprocessing_command += ' --random_seed=' + str(args.random_seed)
-            bert_preprocessing_command += ' --dupe_factor=' + str(args.dupe_factor)
-            bert_preprocessing_process = subprocess.Popen(bert_preprocessing_command, shell=True)
-            bert_preprocessing_process.communicate()
-
-            last_process = bert_preprocessing_process
-
-            # This could be better optimized (fine if all take equal time)
-            if shard_id % args.n_processes == 0 and shard_id > 0:
-                bert_preprocessing_process.wait()
-            return last_process
-
-        output_file_prefix = args.dataset
-
-        for i in range(args.n_training_shards):
-            last_process =create_record_worker(output_file_prefix + '_training', i)
-
-        last_process.wait()
-
-        for i in range(args.n_test_shards):
-            last_process = create_record_worker(output_file_prefix + '_test', i)
-
-        last_process.wait()
-
-
     elif args.action == 'create_hdf5_files':
-        last_process = None
-
         if not os.path.exists(directory_structure['hdf5'] + "/" + args.dataset):
             os.makedirs(directory_structure['hdf5'] + "/" + args.dataset)
 
-        def create_record_worker(filename_prefix, shard_id, output_format='hdf5'):
-            bert_preprocessing_command = 'python create_pretraining_data.py'
-            bert_preprocessing_command += ' --input_file=' + directory_structure['sharded'] + '/' + args.dataset + '/' + filename_prefix + '_' + str(shard_id) + '.txt'
-            bert_preprocessing_command += ' --output_file=' + directory_structure['hdf5'] + '/' + args.dataset + '/' + filename_prefix + '_' + str(shard_id) + '.' + output_format
-            bert_preprocessing_command += ' --vocab_file=' + args.vocab_file
-            bert_preprocessing_command += ' --do_lower_case' if args.do_lower_case else ''
-            bert_preprocessing_command += ' --max_seq_length=' + str(args.max_seq_length)
-            bert_preprocessing_command += ' --max_predictions_per_seq=' + str(args.max_predictions_per_seq)
-            bert_preprocessing_command += ' --masked_lm_prob=' + str(args.masked_lm_prob)
-            bert_preprocessing_command += ' --random_seed=' + str(args.random_seed)
-            bert_preprocessing_command += ' --dupe_factor=' + str(args.dupe_factor)
-            bert_preprocessing_process = subprocess.Popen(bert_preprocessing_command, shell=True)
-            bert_preprocessing_process.communicate()
-
-            last_process = bert_preprocessing_process
-
-            # This could be better optimized (fine if all take equal time)
-            if shard_id % args.n_processes == 0 and shard_id > 0:
-                bert_preprocessing_process.wait()
-            return last_process
-
-        output_file_prefix = args.dataset
-
-        for i in range(args.n_training_shards):
-            last_process = create_record_worker(output_file_prefix + '_training', i)
-
-        last_process.wait()
-
-        for i in range(args.n_test_shards):
-            last_process = create_record_worker(output_file_prefix + '_test', i)
-
-        last_process.wait()
+        output_dir = directory_structure['hdf5'] + '/' + args.dataset
+        jobs = []
+        for split, n_shards in (('training', args.n_training_shards), ('test', args.n_test_shards)):
+            for shard_id in range(n_shards):
+                name = args.dataset + '_' + split + '_' + str(shard_id)
+                jobs.append((name,
+                             directory_structure['sharded'] + '/' + args.dataset + '/' + name + '.txt',
+                             output_dir + '/' + name + '.hdf5'))
+
+        options = {
+            'vocab_file': args.vocab_file,
+            'do_lower_case': bool(args.do_lower_case),
+            'max_seq_length': args.max_seq_length,
+            'max_predictions_per_seq': args.max_predictions_per_seq,
+            'masked_lm_prob': args.masked_lm_prob,
+            'short_seq_prob': 0.1,
+            'random_seed': args.random_seed,
+            'dupe_factor': args.dupe_factor,
+            'retries': args.n_shard_retries,
+        }
+        create_shards(jobs, output_dir, options, args.n_processes)
 
 
 if __name__ == "__main__":
@@ -301,6 +335,13 @@ if __name__ == "__main__":
         default=20
     )
 
+    parser.add_argument(
+        '--n_shard_retries',
+        type=int,
+        help='Specify the number of times a shard is retried when creating it fails',
+        default=1
+    )
+
     parser.add_argument(
         '--random_seed',
         type=int,
@@ -363,4 +404,7 @@ if __name__ == "__main__":
     )
 
     args = parser.parse_args()
+    if args.action == 'create_tfrecord_files':
+        parser.error('TFrecord creation is not supported in this PyTorch model example release, '
+                     'use --action create_hdf5_files')
     main(args)
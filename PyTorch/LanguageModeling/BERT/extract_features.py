@@ -23,14 +23,19 @@ import argparse
 import collections
 import logging
 import json
+import os
+import queue
 import re
+import threading
 
+import numpy as np
 import torch
 from torch.utils.data import TensorDataset, DataLoader, SequentialSampler
 from torch.utils.data.distributed import DistributedSampler
 
 from tokenization import BertTokenizer
 from modeling import BertModel
+from utils import LengthBucketSampler, get_rank, get_world_size, is_main_process, trim_batch
 
 logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s', 
                     datefmt = '%m/%d/%Y %H:%M:%S',
@@ -189,6 +194,84 @@ def read_examples(input_file):
     return examples
 
 
+class FeatureStoreWriter(object):
+    """Writes the features of all examples as float16 arrays in a directory of
+    memory-mapped .npy files:
+
+        embeddings.npy: [num_tokens, num_layers, hidden_size], the tokens of
+            all examples one after the other
+        offsets.npy: [num_examples + 1], the tokens of example i are
+            embeddings[offsets[i]:offsets[i + 1]]
+        unique_ids.npy: [num_examples], the line index of each example
+        layers.npy: [num_layers], the layer indexes
+        tokens.txt: the tokens of each example, one line per example
+
+    Batches are copied to the host and written on a background thread, so
+    that the model runs the next batch meanwhile. Every example has a fixed
+    place in the store, so all ranks write to the same files.
+    """
+
+    def __init__(self, output_dir, features, layer_indexes, hidden_size, max_pending=4):
+        lengths = np.array([len(f.tokens) for f in features], dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(lengths)])
+        shape = (int(self.offsets[-1]), len(layer_indexes), hidden_size)
+        embeddings_file = os.path.join(output_dir, "embeddings.npy")
+        if is_main_process():
+            if not os.path.exists(output_dir):
+                os.makedirs(output_dir)
+            np.save(os.path.join(output_dir, "offsets.npy"), self.offsets)
+            np.save(os.path.join(output_dir, "unique_ids.npy"),
+                    np.array([f.unique_id for f in features], dtype=np.int64))
+            np.save(os.path.join(output_dir, "layers.npy"), np.array(layer_indexes, dtype=np.int64))
+            with open(os.path.join(output_dir, "tokens.txt"), "w", encoding='utf-8') as writer:
+                for feature in features:
+                    writer.write(" ".join(feature.tokens) + "\n")
+            self.embeddings = np.lib.format.open_memmap(embeddings_file, mode="w+", dtype=np.float16, shape=shape)
+        if get_world_size() > 1:
+            torch.distributed.barrier()
+        if not is_main_process():
+            self.embeddings = np.lib.format.open_memmap(embeddings_file, mode="r+")
+
+        self._error = None
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            example_indices, layers = self._queue.get()
+            try:
+                layers = layers.cpu().numpy()
+                for b, example_index in enumerate(example_indices.tolist()):
+                    start, end = self.offsets[example_index], self.offsets[example_index + 1]
+                    self.embeddings[start:end] = layers[b, :end - start]
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def write(self, example_indices, layers):
+        """Enqueue the features of a batch.
+
+        Args:
+            example_indices: [batch_size] indexes of the examples
+            layers: [batch_size, seq_length, num_layers, hidden_size] tensor
+        """
+        self._check_error()
+        self._queue.put((example_indices, layers))
+
+    def close(self):
+        """Block until all features are written and flush them to disk."""
+        self._queue.join()
+        self._check_error()
+        self.embeddings.flush()
+
+    def _check_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+
 def main():
     parser = argparse.ArgumentParser()
 
@@ -213,6 +296,15 @@ def main():
     parser.add_argument("--no_cuda",
                         action='store_true',
                         help="Whether not to use CUDA when available")
+    parser.add_argument("--output_format",
+                        default="json",
+                        choices=["json", "npy"],
+                        help="json: one JSON line per example with the values of every token and layer. "
+                             "npy: float16 arrays in memory-mapped .npy files, written to the output_file directory.")
+    parser.add_argument('--length_bucketing',
+                        action='store_true',
+                        help="Batch sequences of similar lengths together and cut each batch after its longest "
+                             "sequence, rounded up to a multiple of 8, instead of padding to max_seq_length.")
 
     args = parser.parse_args()
 
@@ -241,6 +333,7 @@ def main():
 
     model = BertModel.from_pretrained(args.bert_model)
     model.to(device)
+    hidden_size = model.config.hidden_size
 
     if args.local_rank != -1:
         model = torch.nn.parallel.DistributedDataParallel(model, device_ids=[args.local_rank],
@@ -253,20 +346,42 @@ def main():
     all_example_index = torch.arange(all_input_ids.size(0), dtype=torch.long)
 
     eval_data = TensorDataset(all_input_ids, all_input_mask, all_example_index)
-    if args.local_rank == -1:
-        eval_sampler = SequentialSampler(eval_data)
+    if args.length_bucketing:
+        eval_sampler = LengthBucketSampler(all_input_mask.sum(-1).numpy(), args.batch_size, shuffle=False,
+                                           num_replicas=get_world_size(), rank=get_rank())
+        eval_dataloader = DataLoader(eval_data, batch_sampler=eval_sampler,
+                                     collate_fn=lambda batch: trim_batch(batch, seq_fields=(0, 1)))
     else:
-        eval_sampler = DistributedSampler(eval_data)
-    eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.batch_size)
+        if args.local_rank == -1:
+            eval_sampler = SequentialSampler(eval_data)
+        else:
+            eval_sampler = DistributedSampler(eval_data)
+        eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.batch_size)
 
     model.eval()
-    with open(args.output_file, "w", encoding='utf-8') as writer:
+    if args.output_format == "npy":
+        store = FeatureStoreWriter(args.output_file, features, layer_indexes, hidden_size)
+        with torch.no_grad():
+            for input_ids, input_mask, example_indices in eval_dataloader:
+                input_ids = input_ids.to(device)
+                input_mask = input_mask.to(device)
+
+                all_encoder_layers, _ = model(input_ids, token_type_ids=None, attention_mask=input_mask)
+                layers = torch.stack([all_encoder_layers[layer_index] for layer_index in layer_indexes], dim=2)
+                store.write(example_indices, layers.half())
+        store.close()
+        return
+
+    # with length bucketing the lines are written at the end, in the order of the input
+    output_lines = {}
+    with open(args.output_file, "w", encoding='utf-8') as writer, torch.no_grad():
         for input_ids, input_mask, example_indices in eval_dataloader:
             input_ids = input_ids.to(device)
             input_mask = input_mask.to(device)
 
             all_encoder_layers, _ = model(input_ids, token_type_ids=None, attention_mask=input_mask)
-            all_encoder_layers = all_encoder_layers
+            # copy the requested layers to the host once per batch
+            layer_outputs = [all_encoder_layers[int(layer_index)].cpu().numpy() for layer_index in layer_indexes]
 
             for b, example_index in enumerate(example_indices):
                 feature = features[example_index.item()]
@@ -278,8 +393,7 @@ def main():
                 for (i, token) in enumerate(feature.tokens):
                     all_layers = []
                     for (j, layer_index) in enumerate(layer_indexes):
-                        layer_output = all_encoder_layers[int(layer_index)].detach().cpu().numpy()
-                        layer_output = layer_output[b]
+                        layer_output = layer_outputs[j][b]
                         layers = collections.OrderedDict()
                         layers["index"] = layer_index
                         layers["values"] = [
@@ -291,7 +405,13 @@ def main():
                     out_features["layers"] = all_layers
                     all_out_features.append(out_features)
                 output_json["features"] = all_out_features
-                writer.write(json.dumps(output_json) + "\n")
+                if args.length_bucketing:
+                    output_lines[unique_id] = json.dumps(output_json)
+                else:
+                    writer.write(json.dumps(output_json) + "\n")
+
+        for unique_id in sorted(output_lines):
+            writer.write(output_lines[unique_id] + "\n")
 
 
 if __name__ == "__main__":
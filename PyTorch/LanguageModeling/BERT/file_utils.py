@@ -19,11 +19,14 @@ Copyright by the AllenNLP authors.
 
 from __future__ import (absolute_import, division, print_function, unicode_literals)
 
+import fcntl
 import json
 import logging
 import os
 import shutil
+import tarfile
 import tempfile
+from contextlib import contextmanager
 from functools import wraps
 from hashlib import sha256
 import sys
@@ -185,10 +188,55 @@ def http_get(url, temp_file):
     progress.close()
 
 
+@contextmanager
+def file_lock(lock_path):
+    """
+    Hold an exclusive lock on `lock_path` while in the context, so that only
+    one local process at a time creates a cache entry and the others wait.
+    """
+    with open(lock_path, 'a') as lock_file:
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+class _HashingWriter(object):
+    """Writes to a file and computes the sha256 of what was written."""
+
+    def __init__(self, file_):
+        self.file = file_
+        self.hash = sha256()
+
+    def write(self, data):
+        self.hash.update(data)
+        return self.file.write(data)
+
+
+def _write_atomic(path, text):
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(path), delete=False) as temp_file:
+        temp_file.write(text)
+    os.replace(temp_file.name, path)
+
+
+def _lookup_cache(ref_path, cache_dir):
+    if not os.path.exists(ref_path):
+        return None
+    with open(ref_path, encoding="utf-8") as ref_file:
+        cache_path = os.path.join(cache_dir, ref_file.read().strip())
+    return cache_path if os.path.exists(cache_path) else None
+
+
 def get_from_cache(url, cache_dir=None):
     """
     Given a URL, look for the corresponding dataset in the local cache.
     If it's not there, download it. Then return the path to the cached file.
+
+    Files are stored under the sha256 of their content, and a `.ref` file
+    named after the url points to it, so a cached url is resolved without
+    any network request. The download is done by a single process on the
+    node while the others wait for the lock.
     """
     if cache_dir is None:
         cache_dir = PYTORCH_PRETRAINED_BERT_CACHE
@@ -196,53 +244,95 @@ def get_from_cache(url, cache_dir=None):
         cache_dir = str(cache_dir)
 
     if not os.path.exists(cache_dir):
-        os.makedirs(cache_dir)
-
-    # Get eTag to add to filename, if it exists.
-    if url.startswith("s3://"):
-        etag = s3_etag(url)
-    else:
-        response = requests.head(url, allow_redirects=True)
-        if response.status_code != 200:
-            raise IOError("HEAD request failed for url {} with status code {}"
-                          .format(url, response.status_code))
-        etag = response.headers.get("ETag")
-
-    filename = url_to_filename(url, etag)
-
-    # get cache path to put the file
-    cache_path = os.path.join(cache_dir, filename)
-
-    if not os.path.exists(cache_path):
-        # Download to temporary file, then copy to cache dir once finished.
+        os.makedirs(cache_dir, exist_ok=True)
+
+    ref_path = os.path.join(cache_dir, url_to_filename(url) + '.ref')
+    cache_path = _lookup_cache(ref_path, cache_dir)
+    if cache_path is not None:
+        return cache_path
+
+    with file_lock(ref_path + '.lock'):
+        # another process may have downloaded it while we were waiting
+        cache_path = _lookup_cache(ref_path, cache_dir)
+        if cache_path is not None:
+            return cache_path
+
+        # Get eTag to store in the metadata, if it exists.
+        if url.startswith("s3://"):
+            etag = s3_etag(url)
+        else:
+            response = requests.head(url, allow_redirects=True)
+            if response.status_code != 200:
+                raise IOError("HEAD request failed for url {} with status code {}"
+                              .format(url, response.status_code))
+            etag = response.headers.get("ETag")
+
+        # Download to a temporary file in the cache dir, then move it in place once finished.
         # Otherwise you get corrupt cache entries if the download gets interrupted.
-        with tempfile.NamedTemporaryFile() as temp_file:
+        with tempfile.NamedTemporaryFile(dir=cache_dir, delete=False) as temp_file:
             logger.info("%s not found in cache, downloading to %s", url, temp_file.name)
+            writer = _HashingWriter(temp_file)
+            try:
+                # GET file object
+                if url.startswith("s3://"):
+                    s3_get(url, writer)
+                else:
+                    http_get(url, writer)
+            except BaseException:
+                os.remove(temp_file.name)
+                raise
 
-            # GET file object
-            if url.startswith("s3://"):
-                s3_get(url, temp_file)
-            else:
-                http_get(url, temp_file)
+        filename = writer.hash.hexdigest()
+        cache_path = os.path.join(cache_dir, filename)
+        logger.info("moving %s to cache at %s", temp_file.name, cache_path)
+        os.chmod(temp_file.name, 0o644)
+        os.replace(temp_file.name, cache_path)
 
-            # we are copying the file before closing it, so flush to avoid truncation
-            temp_file.flush()
-            # shutil.copyfileobj() starts at the current position, so go to the start
-            temp_file.seek(0)
+        logger.info("creating metadata file for %s", cache_path)
+        meta = {'url': url, 'etag': etag}
+        _write_atomic(cache_path + '.json', json.dumps(meta))
+        _write_atomic(ref_path, filename)
 
-            logger.info("copying %s to cache at %s", temp_file.name, cache_path)
-            with open(cache_path, 'wb') as cache_file:
-                shutil.copyfileobj(temp_file, cache_file)
+    return cache_path
 
-            logger.info("creating metadata file for %s", cache_path)
-            meta = {'url': url, 'etag': etag}
-            meta_path = cache_path + '.json'
-            with open(meta_path, 'w', encoding="utf-8") as meta_file:
-                json.dump(meta, meta_file)
 
-            logger.info("removing temp file %s", temp_file.name)
+def extract_archive(archive_path, cache_dir=None):
+    """
+    Extract a .tar.gz archive once into a directory of the cache shared by
+    all the processes, and return the path to that directory.
+    """
+    if cache_dir is None:
+        cache_dir = PYTORCH_PRETRAINED_BERT_CACHE
+    if sys.version_info[0] == 3 and isinstance(archive_path, Path):
+        archive_path = str(archive_path)
+    if sys.version_info[0] == 3 and isinstance(cache_dir, Path):
+        cache_dir = str(cache_dir)
 
-    return cache_path
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+
+    # a modified archive is extracted again
+    stat = os.stat(archive_path)
+    version = '{}-{}'.format(stat.st_size, stat.st_mtime_ns)
+    extracted_path = os.path.join(cache_dir,
+                                  url_to_filename(os.path.realpath(archive_path), version) + '.extracted')
+    if os.path.isdir(extracted_path):
+        return extracted_path
+
+    with file_lock(extracted_path + '.lock'):
+        if not os.path.isdir(extracted_path):
+            temp_dir = tempfile.mkdtemp(dir=cache_dir)
+            logger.info("extracting archive file %s to %s", archive_path, extracted_path)
+            try:
+                with tarfile.open(archive_path, 'r:gz') as archive:
+                    archive.extractall(temp_dir)
+            except BaseException:
+                shutil.rmtree(temp_dir)
+                raise
+            os.chmod(temp_dir, 0o755)
+            os.rename(temp_dir, extracted_path)
+
+    return extracted_path
 
 
 def read_set_from_file(filename):
@@ -22,9 +22,6 @@ import json
 import logging
 import math
 import os
-import shutil
-import tarfile
-import tempfile
 import sys
 from io import open
 
@@ -33,7 +30,7 @@ from torch import nn
 from torch.nn import CrossEntropyLoss
 from torch.utils import checkpoint
 
-from file_utils import cached_path
+from file_utils import cached_path, extract_archive
 
 from torch.nn import Module
 from torch.nn.parameter import Parameter
@@ -317,6 +314,14 @@ except ImportError:
             x = (x - u) / torch.sqrt(s + self.variance_epsilon)
             return self.weight * x + self.bias
 
+def packed_attention_mask(sequence_ids):
+    """Returns the [batch_size, seq_length, seq_length] attention mask of packed sequences, which lets each
+    token attend to the tokens of its own sequence. `sequence_ids` numbers the sequences of a pack from 1
+    on, and is 0 for padding."""
+    to_sequence_ids = sequence_ids.unsqueeze(1)
+    return ((sequence_ids.unsqueeze(2) == to_sequence_ids) & (to_sequence_ids > 0)).long()
+
+
 class BertEmbeddings(nn.Module):
     """Construct the embeddings from word, position and token_type embeddings.
     """
@@ -331,10 +336,11 @@ class BertEmbeddings(nn.Module):
         self.LayerNorm = BertLayerNorm(config.hidden_size, eps=1e-12)
         self.dropout = nn.Dropout(config.hidden_dropout_prob)
 
-    def forward(self, input_ids, token_type_ids=None):
-        seq_length = input_ids.size(1)
-        position_ids = torch.arange(seq_length, dtype=torch.long, device=input_ids.device)
-        position_ids = position_ids.unsqueeze(0).expand_as(input_ids)
+    def forward(self, input_ids, token_type_ids=None, position_ids=None):
+        if position_ids is None:
+            seq_length = input_ids.size(1)
+            position_ids = torch.arange(seq_length, dtype=torch.long, device=input_ids.device)
+            position_ids = position_ids.unsqueeze(0).expand_as(input_ids)
         if token_type_ids is None:
             token_type_ids = torch.zeros_like(input_ids)
 
@@ -535,10 +541,14 @@ class BertPooler(nn.Module):
         super(BertPooler, self).__init__()
         self.dense_act = LinearActivation(config.hidden_size, config.hidden_size, act="tanh")
 
-    def forward(self, hidden_states):
+    def forward(self, hidden_states, positions=None):
         # We "pool" the model by simply taking the hidden state corresponding
-        # to the first token.
-        first_token_tensor = hidden_states[:, 0]
+        # to the first token, or to the first token of each packed sequence.
+        if positions is None:
+            first_token_tensor = hidden_states[:, 0]
+        else:
+            index = positions.unsqueeze(-1).expand(-1, -1, hidden_states.size(-1))
+            first_token_tensor = hidden_states.gather(1, index)
         pooled_output = self.dense_act(first_token_tensor)
         return pooled_output
 
@@ -602,7 +612,11 @@ class BertPreTrainingHeads(nn.Module):
         self.predictions = BertLMPredictionHead(config, bert_model_embedding_weights)
         self.seq_relationship = nn.Linear(config.hidden_size, 2)
 
-    def forward(self, sequence_output, pooled_output):
+    def forward(self, sequence_output, pooled_output, masked_lm_positions=None):
+        if masked_lm_positions is not None:
+            # only predict the masked tokens: [batch_size, max_predictions_per_seq, hidden_size]
+            index = masked_lm_positions.unsqueeze(-1).expand(-1, -1, sequence_output.size(-1))
+            sequence_output = sequence_output.gather(1, index)
         prediction_scores = self.predictions(sequence_output)
         seq_relationship_score = self.seq_relationship(pooled_output)
         return prediction_scores, seq_relationship_score
@@ -686,17 +700,11 @@ class BertPreTrainedModel(nn.Module):
         else:
             logger.info("loading archive file {} from cache at {}".format(
                 archive_file, resolved_archive_file))
-        tempdir = None
         if os.path.isdir(resolved_archive_file) or from_tf:
             serialization_dir = resolved_archive_file
         else:
-            # Extract archive to temp dir
-            tempdir = tempfile.mkdtemp()
-            logger.info("extracting archive file {} to temp dir {}".format(
-                resolved_archive_file, tempdir))
-            with tarfile.open(resolved_archive_file, 'r:gz') as archive:
-                archive.extractall(tempdir)
-            serialization_dir = tempdir
+            # Extract archive once to a directory shared by all processes
+            serialization_dir = extract_archive(resolved_archive_file, cache_dir=cache_dir)
         # Load config
         config_file = os.path.join(serialization_dir, CONFIG_NAME)
         config = BertConfig.from_json_file(config_file)
@@ -706,9 +714,6 @@ class BertPreTrainedModel(nn.Module):
         if state_dict is None and not from_tf:
             weights_path = os.path.join(serialization_dir, WEIGHTS_NAME)
             state_dict = torch.load(weights_path, map_location='cpu' if not torch.cuda.is_available() else None)
-        if tempdir:
-            # Clean up temp dir
-            shutil.rmtree(tempdir)
         if from_tf:
             # Directly load from a TensorFlow checkpoint
             weights_path = os.path.join(serialization_dir, TF_WEIGHTS_NAME)
@@ -776,8 +781,13 @@ class BertModel(BertPreTrainedModel):
         `attention_mask`: an optional torch.LongTensor of shape [batch_size, sequence_length] with indices
             selected in [0, 1]. It's a mask to be used if the input sequence length is smaller than the max
             input sequence length in the current batch. It's the mask that we typically use for attention when
-            a batch has varying length sentences.
+            a batch has varying length sentences. It can also be of shape [batch_size, sequence_length,
+            sequence_length] to set which tokens each token attends to, e.g. the `packed_attention_mask`.
         `output_all_encoded_layers`: boolean which controls the content of the `encoded_layers` output as described below. Default: `True`.
+        `position_ids`: an optional torch.LongTensor of shape [batch_size, sequence_length] with the position
+            of each token. Defaults to 0, 1, ..., sequence_length - 1; packed sequences restart from 0.
+        `cls_positions`: an optional torch.LongTensor of shape [batch_size, num_sequences] with the positions
+            of the `CLS` tokens of packed sequences, where the `pooled_output` is computed.
 
     Outputs: Tuple of (encoded_layers, pooled_output)
         `encoded_layers`: controled by `output_all_encoded_layers` argument:
@@ -788,7 +798,8 @@ class BertModel(BertPreTrainedModel):
                 to the last attention block of shape [batch_size, sequence_length, hidden_size],
         `pooled_output`: a torch.FloatTensor of size [batch_size, hidden_size] which is the output of a
             classifier pretrained on top of the hidden state associated to the first character of the
-            input (`CLS`) to train on the Next-Sentence task (see BERT's paper).
+            input (`CLS`) to train on the Next-Sentence task (see BERT's paper). It is of size
+            [batch_size, num_sequences, hidden_size] if `cls_positions` is set.
 
     Example usage:
     ```python
@@ -811,7 +822,8 @@ class BertModel(BertPreTrainedModel):
         self.pooler = BertPooler(config)
         self.apply(self.init_bert_weights)
 
-    def forward(self, input_ids, token_type_ids=None, attention_mask=None, output_all_encoded_layers=True, checkpoint_activations=False):
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, output_all_encoded_layers=True, checkpoint_activations=False,
+                position_ids=None, cls_positions=None):
         if attention_mask is None:
             attention_mask = torch.ones_like(input_ids)
         if token_type_ids is None:
@@ -822,7 +834,11 @@ class BertModel(BertPreTrainedModel):
         # So we can broadcast to [batch_size, num_heads, from_seq_length, to_seq_length]
         # this attention mask is more simple than the triangular masking of causal attention
         # used in OpenAI GPT, we just need to prepare the broadcast dimension here.
-        extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
+        # A mask which is already [batch_size, from_seq_length, to_seq_length] only needs the head dimension.
+        if attention_mask.dim() == 3:
+            extended_attention_mask = attention_mask.unsqueeze(1)
+        else:
+            extended_attention_mask = attention_mask.unsqueeze(1).unsqueeze(2)
 
         # Since attention_mask is 1.0 for positions we want to attend and 0.0 for
         # masked positions, this operation will create a tensor which is 0.0 for
@@ -832,12 +848,12 @@ class BertModel(BertPreTrainedModel):
         extended_attention_mask = extended_attention_mask.to(dtype=next(self.parameters()).dtype) # fp16 compatibility
         extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
 
-        embedding_output = self.embeddings(input_ids, token_type_ids)
+        embedding_output = self.embeddings(input_ids, token_type_ids, position_ids)
         encoded_layers = self.encoder(embedding_output,
                                       extended_attention_mask,
                                       output_all_encoded_layers=output_all_encoded_layers, checkpoint_activations=checkpoint_activations)
         sequence_output = encoded_layers[-1]
-        pooled_output = self.pooler(sequence_output)
+        pooled_output = self.pooler(sequence_output, cls_positions)
         if not output_all_encoded_layers:
             encoded_layers = encoded_layers[-1]
         return encoded_layers, pooled_output
@@ -869,6 +885,14 @@ class BertForPreTraining(BertPreTrainedModel):
         `next_sentence_label`: optional next sentence classification loss: torch.LongTensor of shape [batch_size]
             with indices selected in [0, 1].
             0 => next sentence is the continuation, 1 => next sentence is a random sentence.
+        `masked_lm_positions`: optional torch.LongTensor of shape [batch_size, max_predictions_per_seq] with the
+            positions of the masked tokens. If set, the masked language modeling head is only evaluated at these
+            positions and `masked_lm_labels` must be of shape [batch_size, max_predictions_per_seq] as well.
+        `position_ids`: optional torch.LongTensor of shape [batch_size, sequence_length] with the positions
+            of the tokens within their packed sequence.
+        `next_sentence_positions`: optional torch.LongTensor of shape [batch_size, num_sequences] with the
+            positions of the `CLS` tokens of packed sequences. If set, `next_sentence_label` is of shape
+            [batch_size, num_sequences], with -1 for the padding sequences.
 
     Outputs:
         if `masked_lm_labels` and `next_sentence_label` are not `None`:
@@ -876,7 +900,8 @@ class BertForPreTraining(BertPreTrainedModel):
             sentence classification loss.
         if `masked_lm_labels` or `next_sentence_label` is `None`:
             Outputs a tuple comprising
-            - the masked language modeling logits of shape [batch_size, sequence_length, vocab_size], and
+            - the masked language modeling logits of shape [batch_size, sequence_length, vocab_size]
+              (or [batch_size, max_predictions_per_seq, vocab_size] if `masked_lm_positions` is set), and
             - the next sentence classification logits of shape [batch_size, 2].
 
     Example usage:
@@ -899,10 +924,12 @@ class BertForPreTraining(BertPreTrainedModel):
         self.cls = BertPreTrainingHeads(config, self.bert.embeddings.word_embeddings.weight)
         self.apply(self.init_bert_weights)
 
-    def forward(self, input_ids, token_type_ids=None, attention_mask=None, masked_lm_labels=None, next_sentence_label=None, checkpoint_activations=False):
+    def forward(self, input_ids, token_type_ids=None, attention_mask=None, masked_lm_labels=None, next_sentence_label=None,
+                checkpoint_activations=False, masked_lm_positions=None, position_ids=None, next_sentence_positions=None):
         sequence_output, pooled_output = self.bert(input_ids, token_type_ids, attention_mask,
-                                                   output_all_encoded_layers=False, checkpoint_activations=checkpoint_activations)
-        prediction_scores, seq_relationship_score = self.cls(sequence_output, pooled_output)
+                                                   output_all_encoded_layers=False, checkpoint_activations=checkpoint_activations,
+                                                   position_ids=position_ids, cls_positions=next_sentence_positions)
+        prediction_scores, seq_relationship_score = self.cls(sequence_output, pooled_output, masked_lm_positions)
 
         if masked_lm_labels is not None and next_sentence_label is not None:
             loss_fct = CrossEntropyLoss(ignore_index=-1)
@@ -16,6 +16,7 @@
 
 """PyTorch optimization for BERT model."""
 
+import collections
 import math
 import torch
 from torch.optim import Optimizer
@@ -61,6 +62,71 @@ SCHEDULES = {
 }
 
 
+class FlatParams(object):
+    """Parameters of the same dtype and hyperparameters, whose data and
+    optimizer state are stored in contiguous buffers.
+
+    The parameters and their state tensors become views of the buffers, so the
+    optimizer state dict and the per-parameter update keep working on them.
+    """
+    def __init__(self, group, params):
+        self.group = group
+        self.params = params
+        self.numels = [p.numel() for p in params]
+        self.param, views = self.flatten([p.data for p in params])
+        for p, view in zip(params, views):
+            p.data = view
+        self.numels_tensor = torch.tensor(self.numels, device=self.param.device)
+
+    def flatten(self, tensors, dtype=None):
+        """Copies `tensors`, one per parameter, into a new buffer and returns
+        it with its views shaped like the parameters."""
+        flat = torch.cat([t.detach().reshape(-1).to(dtype or t.dtype) for t in tensors])
+        return flat, [view.view_as(p) for view, p in zip(flat.split(self.numels), self.params)]
+
+    def flatten_state(self, state, key, dtype=None):
+        """Moves `state[p][key]` of all parameters into a buffer and returns it."""
+        flat, views = self.flatten([state[p][key] for p in self.params], dtype)
+        for p, view in zip(self.params, views):
+            state[p][key] = view
+        return flat
+
+    def grads(self):
+        """Returns the gradients, or None if some parameter has none."""
+        grads = [p.grad for p in self.params]
+        if any(g is None for g in grads):
+            return None
+        return grads
+
+    def expand(self, per_param):
+        """Repeats a tensor of one value per parameter to one per element."""
+        return torch.repeat_interleave(per_param, self.numels_tensor, output_size=self.param.numel())
+
+    def norms(self, flat):
+        """Computes the L2 norm of each parameter's part of a buffer."""
+        if flat.is_cuda:
+            overflow_buf = torch.cuda.IntTensor([0])
+            return multi_tensor_applier(multi_tensor_l2norm, overflow_buf, [list(flat.split(self.numels))], True)[1]
+        return torch.stack([torch.norm(t.float(), 2) for t in flat.split(self.numels)])
+
+
+def flat_params(optimizer, dtypes):
+    """Groups the parameters of `optimizer` which have a gradient by dtype and
+    hyperparameters, and returns their `FlatParams` along with the parameters
+    left out."""
+    groups = collections.OrderedDict()
+    rest = []
+    for group in optimizer.param_groups:
+        hyperparams = tuple(group.get(k) for k in sorted(optimizer.defaults) if k != 'params')
+        for p in group['params']:
+            if p.grad is None or p.dtype not in dtypes:
+                rest.append(p)
+                continue
+            key = hyperparams + (p.dtype, p.device)
+            groups.setdefault(key, (group, []))[1].append(p)
+    return [FlatParams(group, params) for group, params in groups.values()], rest
+
+
 class BertLAMB(Optimizer):
     """Implements BERT version of LAMB algorithm.
     Params:
@@ -74,10 +140,16 @@ class BertLAMB(Optimizer):
         e: LAMBs epsilon. Default: 1e-6
         weight_decay: Weight decay. Default: 0.01
         max_grad_norm: Maximum global norm for the gradients. Default: 1.0
+        flat: Keep the parameters, fp32 master weights and moments in one buffer per
+            dtype and weight decay, and compute the global gradient norm once for all
+            of them. Parameters which are not on the GPU are updated with torch ops.
+            When there are both fp32 and fp16 parameters, the updates differ from the
+            default ones, which clip the gradients of each dtype with their own global
+            norm. Default: False
     """
     def __init__(self, params, lr=required, warmup=-1, t_total=-1, schedule='warmup_poly',
                  b1=0.9, b2=0.999, e=1e-6, weight_decay=0.01,
-                 max_grad_norm=1.0):
+                 max_grad_norm=1.0, flat=False):
         if lr is not required and lr < 0.0:
             raise ValueError("Invalid learning rate: {} - should be >= 0.0".format(lr))
         if schedule not in SCHEDULES:
@@ -104,6 +176,13 @@ class BertLAMB(Optimizer):
         self.warmup = warmup
         self.max_steps = t_total
         self.updates_created=False
+        self.flat = flat
+        self.flat_params = None
+
+    def load_state_dict(self, state_dict):
+        super(BertLAMB, self).load_state_dict(state_dict)
+        # the loaded state is moved to new buffers at the next step
+        self.flat_params = None
 
     def get_lr(self):
         lr = []
@@ -120,13 +199,17 @@ class BertLAMB(Optimizer):
                 lr.append(lr_scheduled)
         return lr
 
-    def apply_gradients(self, dummy_overflow_buf, lr_scheduled, per_param_decay, grad_list, param_list, momentum, velocity, update):
+    def apply_gradients(self, dummy_overflow_buf, lr_scheduled, per_param_decay, grad_list, param_list, momentum, velocity, update,
+                        global_grad_norm=None):
         # Compute global gradient norm
-        global_grad_norm = multi_tensor_applier(
-                        multi_tensor_l2norm,
-                        dummy_overflow_buf,
-                        [grad_list],
-                        False)[0].item()
+        if global_grad_norm is None:
+            global_grad_norm = multi_tensor_applier(
+                            multi_tensor_l2norm,
+                            dummy_overflow_buf,
+                            [grad_list],
+                            False)[0].item()
+        if not torch.is_tensor(per_param_decay):
+            per_param_decay = torch.cuda.FloatTensor(per_param_decay)
 
         # Compute per parameter norm
         param_norms = multi_tensor_applier(
@@ -140,7 +223,7 @@ class BertLAMB(Optimizer):
                         lamb_compute_update,
                         dummy_overflow_buf,
                         [grad_list, param_list, momentum, velocity, update],
-                        torch.cuda.FloatTensor(per_param_decay),
+                        per_param_decay,
                         self.step_count,
                         self.b1,
                         self.b2,
@@ -166,6 +249,108 @@ class BertLAMB(Optimizer):
                         lr_scheduled,
                         )
 
+    def apply_gradients_reference(self, lr_scheduled, flat, grad_list, global_grad_norm):
+        """Same update as `apply_gradients` with torch ops on the buffers of
+        `flat`, for parameters which are not on the GPU."""
+        clipped_global_grad_norm = global_grad_norm / self.max_global_grad_norm \
+            if global_grad_norm > self.max_global_grad_norm else 1.0
+        # the bias corrections of lamb_compute_update are for the step after step_count
+        beta1_correction = 1.0 - self.b1 ** (self.step_count + 1)
+        beta2_correction = 1.0 - self.b2 ** (self.step_count + 1)
+
+        grad = torch.cat([g.reshape(-1).float() for g in grad_list]) / clipped_global_grad_norm
+        flat.momentum.mul_(self.b1).add_(grad, alpha=1 - self.b1)
+        flat.velocity.mul_(self.b2).addcmul_(grad, grad, value=1 - self.b2)
+        update = (flat.momentum / beta1_correction) / ((flat.velocity / beta2_correction).sqrt() + self.epsilon)
+        update += flat.group['weight_decay'] * flat.master
+        flat.update.copy_(update)
+
+        param_norms = flat.norms(flat.master)
+        update_norms = flat.norms(flat.update)
+        ratio = torch.where((param_norms != 0) & (update_norms != 0),
+                            lr_scheduled * (param_norms / update_norms),
+                            torch.full_like(param_norms, lr_scheduled))
+        flat.master.sub_(flat.expand(ratio) * flat.update)
+
+    def flat_step(self):
+        """Updates the parameters from their buffers. Returns False, without
+        updating anything, when the update has to be done per parameter
+        because the parameters with a gradient are not those which had one at
+        the first step.
+        """
+        if self.flat_params is None:
+            self.flat_params, self.rest_params = flat_params(self, (torch.float32, torch.float16))
+            for flat in self.flat_params:
+                for p in flat.params:
+                    state = self.state[p]
+                    if len(state) == 0:
+                        state['step'] = 0
+                        state['momentum'] = torch.zeros_like(p.data, dtype=torch.float32)
+                        state['velocity'] = torch.zeros_like(p.data, dtype=torch.float32)
+                    if 'master_param' not in state.keys() and p.dtype == torch.float16:
+                        state['master_param'] = p.detach().clone().float()
+                flat.momentum = flat.flatten_state(self.state, 'momentum', torch.float32)
+                flat.velocity = flat.flatten_state(self.state, 'velocity', torch.float32)
+                if flat.param.dtype == torch.float16:
+                    flat.master = flat.flatten_state(self.state, 'master_param', torch.float32)
+                    # Use fp16 weights as temporary buffer for update term, as in step
+                    flat.update = flat.param
+                else:
+                    flat.master = flat.param
+                    flat.update = torch.empty_like(flat.param)
+                flat.decay = torch.full([len(flat.params)], flat.group['weight_decay'],
+                                        dtype=torch.float32, device=flat.param.device)
+                flat.views = [list(buffer.split(flat.numels))
+                              for buffer in (flat.master, flat.momentum, flat.velocity, flat.update)]
+            self.last_flat_param = [p for flat in self.flat_params for p in flat.params][-1]
+
+        all_grads = [flat.grads() for flat in self.flat_params]
+        if any(grads is None for grads in all_grads) or any(p.grad is not None for p in self.rest_params):
+            return False
+
+        for flat in self.flat_params:
+            for p in flat.params:
+                self.state[p]['step'] += 1
+        self.step_count = self.state[self.last_flat_param]['step']
+        lr_scheduled = self.scheduled_lr()
+
+        # Compute global gradient norm once for all parameters
+        on_gpu = self.flat_params[0].param.is_cuda
+        if on_gpu:
+            overflow_buf = torch.cuda.IntTensor([0])
+            # the norm kernel takes tensors of a single dtype
+            norms = []
+            for dtype in (torch.float32, torch.float16):
+                grad_list = [g for flat, grads in zip(self.flat_params, all_grads)
+                             if flat.param.dtype == dtype for g in grads]
+                if grad_list:
+                    norms.append(multi_tensor_applier(multi_tensor_l2norm, overflow_buf, [grad_list], False)[0])
+            global_grad_norm = torch.norm(torch.stack(norms)).item()
+        else:
+            global_grad_norm = torch.norm(torch.stack(
+                [torch.norm(torch.cat([g.reshape(-1).float() for g in grads])) for grads in all_grads])).item()
+
+        for flat, grads in zip(self.flat_params, all_grads):
+            if on_gpu:
+                self.apply_gradients(overflow_buf, lr_scheduled, flat.decay, grads, *flat.views,
+                                     global_grad_norm=global_grad_norm)
+            else:
+                self.apply_gradients_reference(lr_scheduled, flat, grads, global_grad_norm)
+            if flat.param.dtype == torch.float16:
+                flat.param.copy_(flat.master)
+        return True
+
+    def scheduled_lr(self):
+        # Calculate learning rate from input schedule
+        # if self.max_steps != -1:
+        schedule_fct = SCHEDULES[self.schedule]
+        lr_scheduled = self.learning_rate * schedule_fct(self.step_count / self.max_steps, self.warmup)
+        if not torch.distributed.is_initialized() or torch.distributed.get_rank() == 0:
+            print("Step {} LR {}".format(self.step_count, lr_scheduled))
+        # else:
+        #     lr_scheduled = self.learning_rate
+        return lr_scheduled
+
     def step(self, closure=None):
         """Performs a single optimization step.
 
@@ -176,6 +361,8 @@ class BertLAMB(Optimizer):
         loss = None
         if closure is not None:
             loss = closure()
+        if self.flat and self.flat_step():
+            return loss
         check = 1#torch.norm(all_grads, 2)
 
         grad_list = []
@@ -251,14 +438,7 @@ class BertLAMB(Optimizer):
         fp16_update = self.fp16_update
 
         self.step_count = state['step']
-        # Calculate learning rate from input schedule
-        # if self.max_steps != -1:
-        schedule_fct = SCHEDULES[self.schedule]
-        lr_scheduled = self.learning_rate * schedule_fct(self.step_count / self.max_steps, self.warmup)
-        if torch.distributed.get_rank() == 0:
-            print("Step {} LR {}".format(self.step_count, lr_scheduled))
-        # else:
-        #     lr_scheduled = self.learning_rate
+        lr_scheduled = self.scheduled_lr()
 
         overflow_buf = torch.cuda.IntTensor([0])
 
@@ -287,10 +467,13 @@ class BertAdam(Optimizer):
         e: Adams epsilon. Default: 1e-6
         weight_decay: Weight decay. Default: 0.01
         max_grad_norm: Maximum norm for the gradients (-1 means no clipping). Default: 1.0
+        flat: Keep the parameters, gradients and moments in one buffer per dtype and
+            hyperparameters, and update each buffer with a few vectorized ops instead
+            of several ops per parameter. Default: False
     """
     def __init__(self, params, lr=required, warmup=-1, t_total=-1, schedule='warmup_linear',
                  b1=0.9, b2=0.999, e=1e-6, weight_decay=0.01,
-                 max_grad_norm=1.0):
+                 max_grad_norm=1.0, flat=False):
         if lr is not required and lr < 0.0:
             raise ValueError("Invalid learning rate: {} - should be >= 0.0".format(lr))
         if schedule not in SCHEDULES:
@@ -307,6 +490,13 @@ class BertAdam(Optimizer):
                         b1=b1, b2=b2, e=e, weight_decay=weight_decay,
                         max_grad_norm=max_grad_norm)
         super(BertAdam, self).__init__(params, defaults)
+        self.flat = flat
+        self.flat_params = None
+
+    def load_state_dict(self, state_dict):
+        super(BertAdam, self).load_state_dict(state_dict)
+        # the loaded state is moved to new buffers at the next step
+        self.flat_params = None
 
     def get_lr(self):
         lr = []
@@ -323,6 +513,74 @@ class BertAdam(Optimizer):
                 lr.append(lr_scheduled)
         return lr
 
+    def init_state(self, p):
+        state = self.state[p]
+        state['step'] = 0
+        # Exponential moving average of gradient values
+        state['next_m'] = torch.zeros_like(p.data)
+        # Exponential moving average of squared gradient values
+        state['next_v'] = torch.zeros_like(p.data)
+
+    def flat_step(self):
+        """Updates the parameters from their buffers, with the same ops as the
+        per-parameter update. Returns False, without updating anything, when
+        the update has to be done per parameter: when the parameters with a
+        gradient are not those which had one at the first step, or when
+        parameters of a buffer are not at the same step.
+        """
+        if self.flat_params is None:
+            self.flat_params, self.rest_params = flat_params(self, (torch.float32, torch.float16))
+            for flat in self.flat_params:
+                for p in flat.params:
+                    if len(self.state[p]) == 0:
+                        self.init_state(p)
+                flat.next_m = flat.flatten_state(self.state, 'next_m')
+                flat.next_v = flat.flatten_state(self.state, 'next_v')
+                flat.grad = torch.empty_like(flat.param)
+                flat.update = torch.empty_like(flat.param)
+
+        all_grads = [flat.grads() for flat in self.flat_params]
+        if any(grads is None for grads in all_grads) or any(p.grad is not None for p in self.rest_params):
+            return False
+        steps = [set(self.state[p]['step'] for p in flat.params) for flat in self.flat_params]
+        if any(len(step) > 1 for step in steps):
+            return False
+
+        for flat, grads, step in zip(self.flat_params, all_grads, steps):
+            group = flat.group
+            step = step.pop()
+            grad, update, next_m, next_v = flat.grad, flat.update, flat.next_m, flat.next_v
+            torch.cat([g.reshape(-1) for g in grads], out=grad)
+            beta1, beta2 = group['b1'], group['b2']
+
+            # Add grad clipping, with the norm of each parameter
+            if group['max_grad_norm'] > 0:
+                clip_coef = torch.clamp(group['max_grad_norm'] / (flat.norms(grad) + 1e-6), max=1.0)
+                grad.mul_(flat.expand(clip_coef))
+
+            next_m.mul_(beta1).add_(1 - beta1, grad)
+            next_v.mul_(beta2).addcmul_(1 - beta2, grad, grad)
+            torch.sqrt(next_v, out=update)
+            update.add_(group['e'])
+            torch.div(next_m, update, out=update)
+
+            # grad is reused as a temporary buffer from here on
+            if group['weight_decay'] > 0.0:
+                update += torch.mul(flat.param, group['weight_decay'], out=grad)
+
+            if group['t_total'] != -1:
+                schedule_fct = SCHEDULES[group['schedule']]
+                lr_scheduled = group['lr'] * schedule_fct(step/group['t_total'], group['warmup'])
+            else:
+                lr_scheduled = group['lr']
+
+            update.mul_(lr_scheduled)
+            flat.param.sub_(update)
+
+            for p in flat.params:
+                self.state[p]['step'] += 1
+        return True
+
     def step(self, closure=None):
         """Performs a single optimization step.
 
@@ -334,6 +592,9 @@ class BertAdam(Optimizer):
         if closure is not None:
             loss = closure()
 
+        if self.flat and self.flat_step():
+            return loss
+
         for group in self.param_groups:
             for p in group['params']:
                 if p.grad is None:
@@ -346,11 +607,7 @@ class BertAdam(Optimizer):
 
                 # State initialization
                 if len(state) == 0:
-                    state['step'] = 0
-                    # Exponential moving average of gradient values
-                    state['next_m'] = torch.zeros_like(p.data)
-                    # Exponential moving average of squared gradient values
-                    state['next_v'] = torch.zeros_like(p.data)
+                    self.init_state(p)
 
                 next_m, next_v = state['next_m'], state['next_v']
                 beta1, beta2 = group['b1'], group['b2']
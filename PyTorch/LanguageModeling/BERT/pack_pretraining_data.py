@@ -0,0 +1,149 @@
+# coding=utf-8
+# Copyright (c) 2019 NVIDIA CORPORATION. All rights reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Pack the instances of pretraining data files into full-length sequences.
+
+Instances made by create_pretraining_data.py are often shorter than
+max_seq_length. Several of them are combined into one sequence of
+max_seq_length tokens, so that less compute is spent on padding. Each packed
+instance keeps its own position ids, [CLS] token and next sentence label, and
+only attends to its own tokens (see `packed_attention_mask` in modeling.py),
+so the model sees the same inputs as without packing.
+"""
+from __future__ import absolute_import, division, print_function
+
+import argparse
+import os
+
+import h5py
+import numpy as np
+from tqdm import tqdm
+
+
+def pack_instances(lengths, max_seq_length, max_instances_per_pack):
+    """Assign instances to packs with the best-fit decreasing heuristic.
+
+    Instances are placed from the longest to the shortest, each into the open
+    pack with the least room left that can hold it. A pack is closed when it
+    holds max_instances_per_pack instances.
+
+    Returns a list of packs, each a list of instance indices.
+    """
+    packs = []
+    # open_packs[i] holds the packs with i tokens of room left
+    open_packs = [[] for _ in range(max_seq_length + 1)]
+    for index in np.argsort(-lengths, kind='stable').tolist():
+        length = int(lengths[index])
+        for room in range(length, max_seq_length + 1):
+            if open_packs[room]:
+                pack = open_packs[room].pop()
+                break
+        else:
+            pack, room = len(packs), max_seq_length
+            packs.append([])
+        packs[pack].append(index)
+        if len(packs[pack]) < max_instances_per_pack and room > length:
+            open_packs[room - length].append(pack)
+    return packs
+
+
+def pack_file(input_file, output_file, max_instances_per_pack):
+    with h5py.File(input_file, "r") as f:
+        inputs = {key: np.asarray(f[key][:]) for key in f.keys()}
+    num_instances, max_seq_length = inputs["input_ids"].shape
+    max_predictions_per_seq = inputs["masked_lm_positions"].shape[1]
+    lengths = inputs["input_mask"].sum(1)
+    # predictions are padded with position 0, which is always the [CLS] token
+    num_predictions = (inputs["masked_lm_positions"] != 0).sum(1)
+
+    packs = pack_instances(lengths, max_seq_length, max_instances_per_pack)
+    num_packs = len(packs)
+    max_predictions = max_predictions_per_seq * max_instances_per_pack
+    features = {
+        "input_ids": np.zeros([num_packs, max_seq_length], dtype="int32"),
+        "sequence_ids": np.zeros([num_packs, max_seq_length], dtype="int8"),
+        "segment_ids": np.zeros([num_packs, max_seq_length], dtype="int8"),
+        "position_ids": np.zeros([num_packs, max_seq_length], dtype="int16"),
+        "masked_lm_positions": np.zeros([num_packs, max_predictions], dtype="int32"),
+        "masked_lm_ids": np.zeros([num_packs, max_predictions], dtype="int32"),
+        "next_sentence_positions": np.zeros([num_packs, max_instances_per_pack], dtype="int16"),
+        "next_sentence_labels": np.full([num_packs, max_instances_per_pack], -1, dtype="int8"),
+    }
+    for pack_index, pack in enumerate(tqdm(packs)):
+        offset, num_packed_predictions = 0, 0
+        for i, index in enumerate(pack):
+            length, predictions = lengths[index], num_predictions[index]
+            tokens = slice(offset, offset + length)
+            features["input_ids"][pack_index, tokens] = inputs["input_ids"][index, :length]
+            features["sequence_ids"][pack_index, tokens] = i + 1
+            features["segment_ids"][pack_index, tokens] = inputs["segment_ids"][index, :length]
+            features["position_ids"][pack_index, tokens] = np.arange(length)
+            predicted = slice(num_packed_predictions, num_packed_predictions + predictions)
+            features["masked_lm_positions"][pack_index, predicted] = \
+                inputs["masked_lm_positions"][index, :predictions] + offset
+            features["masked_lm_ids"][pack_index, predicted] = inputs["masked_lm_ids"][index, :predictions]
+            features["next_sentence_positions"][pack_index, i] = offset
+            features["next_sentence_labels"][pack_index, i] = inputs["next_sentence_labels"][index]
+            offset += length
+            num_packed_predictions += predictions
+
+    with h5py.File(output_file, "w") as f:
+        for key, value in features.items():
+            f.create_dataset(key, data=value, compression='gzip')
+
+    real_tokens = lengths.sum()
+    print("{}: packed {} instances into {} sequences, padding went from {:.1f}% to {:.1f}% of the tokens".format(
+        input_file, num_instances, num_packs,
+        100. * (1 - real_tokens / (num_instances * max_seq_length)),
+        100. * (1 - real_tokens / (num_packs * max_seq_length))))
+
+
+def main():
+
+    parser = argparse.ArgumentParser()
+    ## Required parameters
+    parser.add_argument("--input_file",
+                        default=None,
+                        type=str,
+                        required=True,
+                        help="The .hdf5 file written by create_pretraining_data.py, or a directory of them")
+    parser.add_argument("--output_file",
+                        default=None,
+                        type=str,
+                        required=True,
+                        help="The packed output file, or the output directory if input_file is a directory")
+
+    ## Other parameters
+    parser.add_argument("--max_instances_per_pack",
+                        default=3,
+                        type=int,
+                        help="Maximum number of instances packed into one sequence.")
+
+    args = parser.parse_args()
+
+    if os.path.isfile(args.input_file):
+        pack_file(args.input_file, args.output_file, args.max_instances_per_pack)
+    elif os.path.isdir(args.input_file):
+        if not os.path.exists(args.output_file):
+            os.makedirs(args.output_file)
+        for name in sorted(os.listdir(args.input_file)):
+            if name.endswith('.hdf5'):
+                pack_file(os.path.join(args.input_file, name), os.path.join(args.output_file, name),
+                          args.max_instances_per_pack)
+    else:
+        raise ValueError("{} is not a valid path".format(args.input_file))
+
+
+if __name__ == "__main__":
+    main()
@@ -42,11 +42,11 @@ import math
 import multiprocessing
 
 from tokenization import BertTokenizer
-from modeling import BertForPreTraining, BertConfig
+from modeling import BertForPreTraining, BertConfig, packed_attention_mask
 from optimization import BertLAMB
 
 from file_utils import PYTORCH_PRETRAINED_BERT_CACHE
-from utils import is_main_process, Timers
+from utils import is_main_process, get_rank, Timers, AsyncCheckpointWriter, shard_checkpoint, shard_path, load_checkpoint
 from schedulers import LinearWarmUpScheduler
 import amp_C
 import apex_C
@@ -72,7 +72,9 @@ logger = logging.getLogger(__name__)
 
 def create_pretraining_dataset(input_file, max_pred_length, shared_list, args):
 
-    train_data = pretraining_dataset(input_file=input_file, max_pred_length=max_pred_length)
+    train_data = pretraining_dataset(input_file=input_file, max_pred_length=max_pred_length,
+                                     masked_positions_only=args.masked_positions_only,
+                                     packed=args.packed_sequences)
     train_sampler = RandomSampler(train_data)
     train_dataloader = DataLoader(train_data, sampler=train_sampler,
                                   batch_size=args.train_batch_size * args.n_gpu, num_workers=4,
@@ -81,12 +83,19 @@ def create_pretraining_dataset(input_file, max_pred_length, shared_list, args):
 
 class pretraining_dataset(Dataset):
 
-    def __init__(self, input_file, max_pred_length):
+    def __init__(self, input_file, max_pred_length, masked_positions_only=False, packed=False):
         self.input_file = input_file
         self.max_pred_length = max_pred_length
+        self.masked_positions_only = masked_positions_only
+        self.packed = packed
         f = h5py.File(input_file, "r")
-        keys = ['input_ids', 'input_mask', 'segment_ids', 'masked_lm_positions', 'masked_lm_ids',
-                'next_sentence_labels']
+        if packed:
+            # written by pack_pretraining_data.py
+            keys = ['input_ids', 'sequence_ids', 'segment_ids', 'masked_lm_positions', 'masked_lm_ids',
+                    'next_sentence_labels', 'position_ids', 'next_sentence_positions']
+        else:
+            keys = ['input_ids', 'input_mask', 'segment_ids', 'masked_lm_positions', 'masked_lm_ids',
+                    'next_sentence_labels']
         self.inputs = [np.asarray(f[key][:]) for key in keys]
         f.close()
 
@@ -96,16 +105,34 @@ class pretraining_dataset(Dataset):
 
     def __getitem__(self, index):
 
+        if self.packed:
+            [input_ids, sequence_ids, segment_ids, masked_lm_positions, masked_lm_ids, next_sentence_labels,
+             position_ids, next_sentence_positions] = [
+                torch.from_numpy(input[index].astype(np.int64)) for input in self.inputs]
+            # padded predictions are at position 0, padded sequences have label -1
+            masked_lm_labels = masked_lm_ids.masked_fill(masked_lm_positions == 0, -1)
+            return [input_ids, segment_ids, sequence_ids,
+                    masked_lm_labels, next_sentence_labels, masked_lm_positions, position_ids,
+                    next_sentence_positions]
+
         [input_ids, input_mask, segment_ids, masked_lm_positions, masked_lm_ids, next_sentence_labels] = [
             torch.from_numpy(input[index].astype(np.int64)) if indice < 5 else torch.from_numpy(
                 np.asarray(input[index].astype(np.int64))) for indice, input in enumerate(self.inputs)]
 
-        masked_lm_labels = torch.ones(input_ids.shape, dtype=torch.long) * -1
         index = self.max_pred_length
         # store number of  masked tokens in index
         padded_mask_indices = (masked_lm_positions == 0).nonzero()
         if len(padded_mask_indices) != 0:
             index = padded_mask_indices[0].item()
+
+        if self.masked_positions_only:
+            # labels of the masked positions, padded predictions are ignored
+            masked_lm_labels = masked_lm_ids.clone()
+            masked_lm_labels[index:] = -1
+            return [input_ids, segment_ids, input_mask,
+                    masked_lm_labels, next_sentence_labels, masked_lm_positions]
+
+        masked_lm_labels = torch.ones(input_ids.shape, dtype=torch.long) * -1
         masked_lm_labels[masked_lm_positions[:index]] = masked_lm_ids[:index]
 
         return [input_ids, segment_ids, input_mask,
@@ -196,6 +223,16 @@ def parse_arguments():
                         default=False,
                         action='store_true',
                         help="Whether to use gradient checkpointing")
+    parser.add_argument('--masked_positions_only',
+                        default=False,
+                        action='store_true',
+                        help="Whether to evaluate the masked LM head only at the masked positions "
+                             "instead of at every token")
+    parser.add_argument('--packed_sequences',
+                        default=False,
+                        action='store_true',
+                        help="Whether the input files were packed with pack_pretraining_data.py. The masked "
+                             "LM head is then only evaluated at the masked positions.")
     parser.add_argument("--resume_from_checkpoint",
                         default=False,
                         action='store_true',
@@ -208,6 +245,15 @@ def parse_arguments():
                         type=int,
                         default=100,
                         help="Number of update steps until a model checkpoint is saved to disk.")
+    parser.add_argument('--async_checkpoint',
+                        default=False,
+                        action='store_true',
+                        help="Whether to write checkpoints on a background thread.")
+    parser.add_argument('--shard_checkpoint',
+                        default=False,
+                        action='store_true',
+                        help="Whether to split the optimizer state of checkpoints across all ranks, "
+                             "so that every rank writes a part of it.")
     parser.add_argument('--phase2',
                         default=False,
                         action='store_true',
@@ -238,6 +284,10 @@ def parse_arguments():
                         choices=['adam', 'fusedadam', 'lamb'],
                         default='lamb',
                         help="which optimizer to use")
+    parser.add_argument('--flat_optimizer',
+                        action='store_true',
+                        help="Keep the parameters and the LAMB state in contiguous buffers and compute "
+                             "the global gradient norm once per step.")
 
     # nvprof args
     parser.add_argument('--nvprof', action='store_true',
@@ -340,10 +390,22 @@ def prepare_model_and_optimizer(args, device):
     else:
         if args.resume_step == -1:
             model_names = [f for f in os.listdir(args.output_dir) if f.endswith(".pt")]
-            args.resume_step = max([int(x.split('.pt')[0].split('_')[1].strip()) for x in model_names])
+            steps = sorted([int(x.split('.pt')[0].split('_')[1].strip()) for x in model_names], reverse=True)
+            # the shards of the latest checkpoint may be missing if the job was interrupted
+            for step in steps:
+                try:
+                    checkpoint = load_checkpoint(os.path.join(args.output_dir, "ckpt_{}.pt".format(step)))
+                except FileNotFoundError as e:
+                    logger.warning("skipping incomplete checkpoint: {}".format(e))
+                    continue
+                args.resume_step = step
+                break
+            else:
+                raise FileNotFoundError("no complete checkpoint found in {}".format(args.output_dir))
+        else:
+            checkpoint = load_checkpoint(os.path.join(args.output_dir, "ckpt_{}.pt".format(args.resume_step)))
         global_step = args.resume_step
 
-        checkpoint = torch.load(os.path.join(args.output_dir, "ckpt_{}.pt".format(global_step)), map_location="cpu")
         model.load_state_dict(checkpoint['model'], strict=False)
         if args.phase2:
             global_step -= args.phase1_end_step
@@ -371,7 +433,8 @@ def prepare_model_and_optimizer(args, device):
         optimizer = BertLAMB(optimizer_grouped_parameters,
                             lr=args.learning_rate,
                             warmup=args.warmup_proportion,
-                            t_total=args.max_steps)
+                            t_total=args.max_steps,
+                            flat=args.flat_optimizer)
     elif args.optimizer == 'fusedadam':
         optimizer = FusedAdam(optimizer_grouped_parameters,
                               lr=args.learning_rate,
@@ -505,7 +568,7 @@ def main():
             print("Training. . .")
 
         model.train()
-        most_recent_ckpts_paths = []
+        checkpoint_writer = AsyncCheckpointWriter(keep=3, async_write=args.async_checkpoint)
         benchmark_stats = defaultdict(lambda: [])
         average_loss = 0.0  # averaged loss every args.log_freq steps
         epoch = 0
@@ -542,7 +605,9 @@ def main():
 
             previous_file = data_file
 
-            train_data = pretraining_dataset(data_file, args.max_predictions_per_seq)
+            train_data = pretraining_dataset(data_file, args.max_predictions_per_seq,
+                                             masked_positions_only=args.masked_positions_only,
+                                             packed=args.packed_sequences)
             train_sampler = RandomSampler(train_data)
             train_dataloader = DataLoader(train_data, sampler=train_sampler,
                                           batch_size=args.train_batch_size * args.n_gpu, num_workers=4,
@@ -577,10 +642,19 @@ def main():
                         start = time.time()
 
                     batch = [t.to(device) for t in batch]
-                    input_ids, segment_ids, input_mask, masked_lm_labels, next_sentence_labels = batch
-                    loss = model(input_ids=input_ids, token_type_ids=segment_ids, attention_mask=input_mask,
+                    input_ids, segment_ids, input_mask, masked_lm_labels, next_sentence_labels = batch[:5]
+                    masked_lm_positions = batch[5] if args.masked_positions_only or args.packed_sequences else None
+                    if args.packed_sequences:
+                        position_ids, next_sentence_positions = batch[6:]
+                        attention_mask = packed_attention_mask(input_mask)
+                    else:
+                        position_ids, next_sentence_positions = None, None
+                        attention_mask = input_mask
+                    loss = model(input_ids=input_ids, token_type_ids=segment_ids, attention_mask=attention_mask,
                                     masked_lm_labels=masked_lm_labels, next_sentence_label=next_sentence_labels,
-                                    checkpoint_activations=args.checkpoint_activations)
+                                    checkpoint_activations=args.checkpoint_activations,
+                                    masked_lm_positions=masked_lm_positions, position_ids=position_ids,
+                                    next_sentence_positions=next_sentence_positions)
                     if args.n_gpu > 1:
                         loss = loss.mean()  # mean() to average on multi-gpu.
 
@@ -640,33 +714,40 @@ def main():
                             benchmark_stats['seq_length'].append(args.max_seq_length)
                             benchmark_stats['batch_size'].append(args.train_batch_size * args.world_size)
                             benchmark_stats['num_tokens'].append(args.max_seq_length * args.train_batch_size * args.world_size)
+                            benchmark_stats['num_real_tokens'].append((input_mask > 0).sum().item() * args.world_size)
                             benchmark_stats['elapsed_time'].append(elapsed * args.log_interval)
                             benchmark_stats['log_interval'].append(args.log_interval)
 
                     if global_step >= args.max_steps or training_steps % (
                             args.num_steps_per_checkpoint * args.gradient_accumulation_steps) == 0:
+                        sharded = args.shard_checkpoint and torch.distributed.is_initialized()
                         if is_main_process():
                             print("total iteration time used: {}".format(time.time() - start))
                             # Save a trained model
                             logger.info("** ** * Saving fine - tuned model ** ** * ")
+                        if (is_main_process() or sharded) and args.do_train:
                             model_to_save = model.module if hasattr(model,
                                                                     'module') else model  # Only save the model it-self
                             if args.resume_step < 0 or not args.phase2:
                                 output_save_file = os.path.join(args.output_dir, "ckpt_{}.pt".format(global_step))
                             else:
                                 output_save_file = os.path.join(args.output_dir, "ckpt_{}.pt".format(global_step + args.phase1_end_step))
-                            if args.do_train:
-                                torch.save({'model': model_to_save.state_dict(),
-                                            'optimizer': optimizer.state_dict(),
-                                            'master params': list(amp.master_params(optimizer)),
-                                            'files': [f_id] + files}, output_save_file)
-
-                                most_recent_ckpts_paths.append(output_save_file)
-                                if len(most_recent_ckpts_paths) > 3:
-                                    ckpt_to_be_removed = most_recent_ckpts_paths.pop(0)
-                                    os.remove(ckpt_to_be_removed)
+                            state = {'model': model_to_save.state_dict() if is_main_process() else None,
+                                     'optimizer': optimizer.state_dict(),
+                                     'master params': list(amp.master_params(optimizer)),
+                                     'files': [f_id] + files}
+                            if sharded:
+                                state, shard = shard_checkpoint(
+                                    state, get_rank(), torch.distributed.get_world_size())
+                                save_files = {shard_path(output_save_file, get_rank()): shard}
+                                if is_main_process():
+                                    save_files[output_save_file] = state
+                            else:
+                                save_files = {output_save_file: state}
+                            checkpoint_writer.save(save_files)
 
                         if global_step >= args.max_steps:
+                            checkpoint_writer.wait()
                             del train_dataloader
                             # thread.join()
                             if args.benchmark and is_main_process():
@@ -676,7 +757,10 @@ def main():
                                 print(benchmark_csv)
                                 benchmark_csv['weight_update_time'] = args.log_interval * np.array(benchmark_csv['weight_update_time'])
                                 benchmark_csv['token_throughput'] = np.array(benchmark_csv['num_tokens']) * np.array(benchmark_csv['log_interval']) / np.array(benchmark_csv['elapsed_time'])
+                                benchmark_csv['real_token_throughput'] = np.array(benchmark_csv['num_real_tokens']) * np.array(benchmark_csv['log_interval']) / np.array(benchmark_csv['elapsed_time'])
+                                benchmark_csv['packed_sequences'] = args.packed_sequences
                                 benchmark_csv['precision'] = [ 'fp16' if args.fp16 else 'fp32' ]
+                                benchmark_csv['masked_positions_only'] = args.masked_positions_only
                                 benchmark_csv['gradient_accumulation'] = args.gradient_accumulation_steps
                                 benchmark_csv['optimizer'] = args.optimizer,
                                 benchmark_csv['world_size'] = args.world_size,
@@ -694,13 +778,15 @@ def main():
                                 df = pd.DataFrame.from_dict(benchmark_csv)
                                 df.to_csv(os.path.join(
                                     save_dir,
-                                    "nvidia_benchmark_{nodes}_nodes_{partition}_batch_size_{batch_size}_seq_len_{seq_len}_{precision}_grad_acc_{gradient_accumulation}.csv".format(
+                                    "nvidia_benchmark_{nodes}_nodes_{partition}_batch_size_{batch_size}_seq_len_{seq_len}_{precision}_grad_acc_{gradient_accumulation}{mlm_head}{packed}.csv".format(
                                         nodes=args.nodes,
                                         partition=args.benchmark_partition,
                                         batch_size=args.train_batch_size,
                                         seq_len=args.max_seq_length,
                                         precision='fp16' if args.fp16 else 'fp32',
-                                        gradient_accumulation=args.gradient_accumulation_steps
+                                        gradient_accumulation=args.gradient_accumulation_steps,
+                                        mlm_head='_masked_positions_only' if args.masked_positions_only else '',
+                                        packed='_packed' if args.packed_sequences else ''
                                     )
                                 ))
                             return args
@@ -22,15 +22,14 @@ import collections
 import json
 import logging
 import math
+import multiprocessing
 import os
 import random
-import sys
 from io import open
 
 import numpy as np
 import torch
-from torch.utils.data import (DataLoader, RandomSampler, SequentialSampler,
-                              TensorDataset)
+from torch.utils.data import DataLoader, Dataset, RandomSampler, SequentialSampler
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm, trange
 
@@ -40,12 +39,7 @@ from file_utils import PYTORCH_PRETRAINED_BERT_CACHE
 from modeling import BertForQuestionAnswering, BertConfig, WEIGHTS_NAME, CONFIG_NAME
 from optimization import BertAdam, warmup_linear
 from tokenization import (BasicTokenizer, BertTokenizer, whitespace_tokenize)
-from utils import is_main_process
-
-if sys.version_info[0] == 2:
-    import cPickle as pickle
-else:
-    import pickle
+from utils import LengthBucketSampler, ThroughputMeter, get_rank, get_world_size, is_main_process, trim_batch
 
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
                     datefmt='%m/%d/%Y %H:%M:%S',
@@ -202,13 +196,13 @@ def read_squad_examples(input_file, is_training, version_2_with_negative):
 
 
 def convert_examples_to_features(examples, tokenizer, max_seq_length,
-                                 doc_stride, max_query_length, is_training):
+                                 doc_stride, max_query_length, is_training, first_example_index=0):
     """Loads a data file into a list of `InputBatch`s."""
 
     unique_id = 1000000000
 
     features = []
-    for (example_index, example) in enumerate(examples):
+    for (example_index, example) in enumerate(examples, first_example_index):
         query_tokens = tokenizer.tokenize(example.question_text)
 
         if len(query_tokens) > max_query_length:
@@ -364,6 +358,154 @@ def convert_examples_to_features(examples, tokenizer, max_seq_length,
     return features
 
 
+def _convert_chunk(args):
+    examples, first_example_index, kwargs = args
+    return convert_examples_to_features(examples, first_example_index=first_example_index, **kwargs)
+
+
+def convert_examples_to_features_parallel(examples, num_workers, **kwargs):
+    """Runs `convert_examples_to_features` on chunks of the examples in a pool
+    of `num_workers` processes. The features are the same as when converting
+    all examples at once."""
+    if num_workers <= 1:
+        return convert_examples_to_features(examples, **kwargs)
+
+    chunk_size = max(1, int(math.ceil(len(examples) / (num_workers * 4))))
+    chunks = [(examples[i:i + chunk_size], i, kwargs) for i in range(0, len(examples), chunk_size)]
+    with multiprocessing.Pool(num_workers) as pool:
+        features = [f for chunk in pool.imap(_convert_chunk, chunks) for f in chunk]
+    for (i, feature) in enumerate(features):
+        feature.unique_id = 1000000000 + i
+    return features
+
+
+def features_to_arrays(features, is_training):
+    """Converts a list of `InputFeatures` into a dict of numpy arrays.
+
+    The token_to_orig_map and token_is_max_context dicts of all features are
+    stored in flat arrays: the entries of feature i are at positions
+    map_offsets[i] to map_offsets[i + 1], and describe the tokens from
+    map_start[i] on. The wordpiece tokens are not stored, they are recovered
+    from the input ids.
+    """
+    arrays = {
+        'unique_id': np.array([f.unique_id for f in features], dtype=np.int64),
+        'example_index': np.array([f.example_index for f in features], dtype=np.int32),
+        'doc_span_index': np.array([f.doc_span_index for f in features], dtype=np.int32),
+        'input_ids': np.array([f.input_ids for f in features], dtype=np.int32),
+        'input_mask': np.array([f.input_mask for f in features], dtype=np.int16),
+        'segment_ids': np.array([f.segment_ids for f in features], dtype=np.int16),
+        'map_start': np.array([min(f.token_to_orig_map) for f in features], dtype=np.int16),
+        'map_offsets': np.cumsum([0] + [len(f.token_to_orig_map) for f in features]).astype(np.int64),
+        'token_to_orig': np.array([i for f in features for i in f.token_to_orig_map.values()], dtype=np.int32),
+        'token_is_max_context': np.array([c for f in features for c in f.token_is_max_context.values()],
+                                         dtype=np.bool_),
+        'is_impossible': np.array([bool(f.is_impossible) for f in features], dtype=np.bool_),
+    }
+    if is_training:
+        arrays['start_position'] = np.array([f.start_position for f in features], dtype=np.int16)
+        arrays['end_position'] = np.array([f.end_position for f in features], dtype=np.int16)
+    return arrays
+
+
+def save_feature_cache(cache_dir, arrays):
+    """Saves the feature arrays as .npy files of a directory, which is renamed
+    into place once complete."""
+    tmp_dir = '{}.tmp{}'.format(cache_dir, os.getpid())
+    os.makedirs(tmp_dir)
+    for name, array in arrays.items():
+        np.save(os.path.join(tmp_dir, name + '.npy'), array)
+    os.rename(tmp_dir, cache_dir)
+
+
+def load_feature_cache(cache_dir):
+    """Memory-maps the feature arrays saved by `save_feature_cache`."""
+    return {name[:-len('.npy')]: np.load(os.path.join(cache_dir, name), mmap_mode='r')
+            for name in os.listdir(cache_dir) if name.endswith('.npy')}
+
+
+class CachedFeatures(object):
+    """Sequence of `InputFeatures` built on access from feature arrays."""
+
+    def __init__(self, arrays, tokenizer, is_training):
+        self.arrays = arrays
+        self.tokenizer = tokenizer
+        self.is_training = is_training
+
+    def __len__(self):
+        return len(self.arrays['unique_id'])
+
+    def __getitem__(self, i):
+        a = self.arrays
+        map_start = int(a['map_start'][i])
+        start, end = a['map_offsets'][i], a['map_offsets'][i + 1]
+        positions = range(map_start, map_start + int(end - start))
+        input_ids = a['input_ids'][i].tolist()
+        input_mask = a['input_mask'][i].tolist()
+        return InputFeatures(
+            unique_id=int(a['unique_id'][i]),
+            example_index=int(a['example_index'][i]),
+            doc_span_index=int(a['doc_span_index'][i]),
+            tokens=self.tokenizer.convert_ids_to_tokens(input_ids[:sum(input_mask)]),
+            token_to_orig_map=dict(zip(positions, a['token_to_orig'][start:end].tolist())),
+            token_is_max_context=dict(zip(positions, a['token_is_max_context'][start:end].tolist())),
+            input_ids=input_ids,
+            input_mask=input_mask,
+            segment_ids=a['segment_ids'][i].tolist(),
+            start_position=int(a['start_position'][i]) if self.is_training else None,
+            end_position=int(a['end_position'][i]) if self.is_training else None,
+            is_impossible=bool(a['is_impossible'][i]))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+
+class FeatureDataset(Dataset):
+    """Dataset returning the given feature arrays of a feature as LongTensors.
+    The name 'index' stands for the index of the feature."""
+
+    def __init__(self, arrays, names):
+        self.arrays = arrays
+        self.names = names
+
+    def __len__(self):
+        return len(self.arrays['unique_id'])
+
+    def __getitem__(self, i):
+        return tuple(torch.tensor(i) if name == 'index' else torch.from_numpy(self.arrays[name][i].astype(np.int64))
+                     for name in self.names)
+
+
+def get_features(args, examples, tokenizer, input_file, is_training):
+    """Returns the feature arrays of the examples, from the cache next to the
+    input file if it exists, otherwise converting the examples and saving them
+    to the cache."""
+    cache_dir = input_file + '_{0}_{1}_{2}_{3}.{4}_features'.format(
+        list(filter(None, args.bert_model.split('/'))).pop(), str(args.max_seq_length), str(args.doc_stride),
+        str(args.max_query_length), 'train' if is_training else 'eval')
+    if os.path.isdir(cache_dir):
+        logger.info("  Loading features from cached directory %s", cache_dir)
+        return load_feature_cache(cache_dir)
+
+    features = convert_examples_to_features_parallel(
+        examples=examples,
+        num_workers=args.preprocessing_workers,
+        tokenizer=tokenizer,
+        max_seq_length=args.max_seq_length,
+        doc_stride=args.doc_stride,
+        max_query_length=args.max_query_length,
+        is_training=is_training)
+    arrays = features_to_arrays(features, is_training)
+    if args.local_rank == -1 or torch.distributed.get_rank() == 0:
+        logger.info("  Saving features into cached directory %s", cache_dir)
+        try:
+            save_feature_cache(cache_dir, arrays)
+        except OSError as e:
+            logger.warning("  Could not save features: %s", e)
+    return arrays
+
+
 def _improve_answer_span(doc_tokens, input_start, input_end, tokenizer,
                          orig_answer_text):
     """Returns tokenized answer spans that better match the annotated answer."""
@@ -442,132 +584,158 @@ RawResult = collections.namedtuple("RawResult",
                                    ["unique_id", "start_logits", "end_logits"])
 
 
-def write_predictions(all_examples, all_features, all_results, n_best_size,
-                      max_answer_length, do_lower_case, output_prediction_file,
-                      output_nbest_file, output_null_log_odds_file, verbose_logging,
-                      version_2_with_negative, null_score_diff_threshold):
-    """Write final predictions to the json file and log-odds of null if needed."""
-    logger.info("Writing predictions to: %s" % (output_prediction_file))
-    logger.info("Writing nbest to: %s" % (output_nbest_file))
+class SpanPredictor(object):
+    """Computes the n-best answers of the examples from the logits of their
+    features.
 
-    example_index_to_features = collections.defaultdict(list)
-    for feature in all_features:
-        example_index_to_features[feature.example_index].append(feature)
-
-    unique_id_to_result = {}
-    for result in all_results:
-        unique_id_to_result[result.unique_id] = result
-
-    _PrelimPrediction = collections.namedtuple(  # pylint: disable=invalid-name
-        "PrelimPrediction",
-        ["feature_index", "start_index", "end_index", "start_logit", "end_logit"])
-
-    all_predictions = collections.OrderedDict()
-    all_nbest_json = collections.OrderedDict()
-    scores_diff_json = collections.OrderedDict()
+    The candidate spans of a feature are the pairs of its n-best start and end
+    indexes. They are filtered with masks of the valid start and end positions
+    of all features, built from the feature arrays, and ranked by the sum of
+    their start and end logits. The ranking is the same as a stable sort of
+    all candidates, so the predictions do not depend on how the examples are
+    split between processes.
+    """
 
-    for (example_index, example) in enumerate(all_examples):
-        features = example_index_to_features[example_index]
+    def __init__(self, all_examples, all_features, all_results, n_best_size,
+                 max_answer_length, do_lower_case, verbose_logging,
+                 version_2_with_negative):
+        self.examples = all_examples
+        self.tokenizer = all_features.tokenizer
+        self.n_best_size = n_best_size
+        self.max_answer_length = max_answer_length
+        self.do_lower_case = do_lower_case
+        self.verbose_logging = verbose_logging
+        self.version_2_with_negative = version_2_with_negative
+
+        a = all_features.arrays
+        self.input_ids = a['input_ids']
+        self.map_start = a['map_start'].astype(np.int64)
+        self.map_offsets = a['map_offsets']
+        self.token_to_orig = a['token_to_orig']
+
+        # features of an example are consecutive
+        example_index = a['example_index']
+        bounds = np.searchsorted(example_index, np.arange(len(all_examples) + 1))
+        self.example_features = [range(bounds[i], bounds[i + 1]) for i in range(len(all_examples))]
+
+        unique_id_to_result = {}
+        for result in all_results:
+            unique_id_to_result[result.unique_id] = result
+        results = [unique_id_to_result[unique_id] for unique_id in a['unique_id'].tolist()]
+        self.start_logits = np.array([r.start_logits for r in results], dtype=np.float64)
+        self.end_logits = np.array([r.end_logits for r in results], dtype=np.float64)
+
+        # spans end on a document token and start on one which is in its
+        # maximum context
+        positions = np.arange(self.start_logits.shape[1])[None, :]
+        map_end = self.map_start + np.diff(self.map_offsets)
+        self.end_valid = (positions >= self.map_start[:, None]) & (positions < map_end[:, None])
+        self.start_valid = self.end_valid.copy()
+        self.start_valid[self.end_valid] = a['token_is_max_context']
+
+    def best_spans(self, feature_index):
+        """Returns the start and end indexes of the valid spans of a feature,
+        in the order of its n-best start indexes and then of its n-best end
+        indexes."""
+        start_indexes = _get_best_indexes(self.start_logits[feature_index], self.n_best_size)
+        end_indexes = _get_best_indexes(self.end_logits[feature_index], self.n_best_size)
+        length = end_indexes[None, :] - start_indexes[:, None] + 1
+        valid = (self.start_valid[feature_index, start_indexes][:, None]
+                 & self.end_valid[feature_index, end_indexes][None, :]
+                 & (length >= 1) & (length <= self.max_answer_length))
+        start_ranks, end_ranks = np.nonzero(valid)
+        return start_indexes[start_ranks], end_indexes[end_ranks]
+
+    def span_text(self, example, feature_index, start_index, end_index):
+        tok_tokens = self.tokenizer.convert_ids_to_tokens(
+            self.input_ids[feature_index, start_index:(end_index + 1)].tolist())
+        offset = self.map_offsets[feature_index] - self.map_start[feature_index]
+        orig_doc_start = int(self.token_to_orig[offset + start_index])
+        orig_doc_end = int(self.token_to_orig[offset + end_index])
+        orig_tokens = example.doc_tokens[orig_doc_start:(orig_doc_end + 1)]
+        tok_text = " ".join(tok_tokens)
+
+        # De-tokenize WordPieces that have been split off.
+        tok_text = tok_text.replace(" ##", "")
+        tok_text = tok_text.replace("##", "")
+
+        # Clean whitespace
+        tok_text = tok_text.strip()
+        tok_text = " ".join(tok_text.split())
+        orig_text = " ".join(orig_tokens)
+
+        return get_final_text(tok_text, orig_text, self.do_lower_case, self.verbose_logging)
+
+    def __call__(self, example_index):
+        """Returns the n-best predictions of an example as a list of dicts,
+        and the score of its null answer."""
+        example = self.examples[example_index]
 
-        prelim_predictions = []
         # keep track of the minimum score of null start+end of position 0
         score_null = 1000000  # large and positive
         min_null_feature_index = 0  # the paragraph slice with min mull score
         null_start_logit = 0  # the start logit at the slice with min null score
         null_end_logit = 0  # the end logit at the slice with min null score
-        for (feature_index, feature) in enumerate(features):
-            result = unique_id_to_result[feature.unique_id]
-            start_indexes = _get_best_indexes(result.start_logits, n_best_size)
-            end_indexes = _get_best_indexes(result.end_logits, n_best_size)
+        feature_indexes, start_indexes, end_indexes = [], [], []
+        for feature_index in self.example_features[example_index]:
             # if we could have irrelevant answers, get the min score of irrelevant
-            if version_2_with_negative:
-                feature_null_score = result.start_logits[0] + result.end_logits[0]
+            if self.version_2_with_negative:
+                feature_null_score = self.start_logits[feature_index, 0] + self.end_logits[feature_index, 0]
                 if feature_null_score < score_null:
-                    score_null = feature_null_score
+                    score_null = float(feature_null_score)
                     min_null_feature_index = feature_index
-                    null_start_logit = result.start_logits[0]
-                    null_end_logit = result.end_logits[0]
-            for start_index in start_indexes:
-                for end_index in end_indexes:
-                    # We could hypothetically create invalid predictions, e.g., predict
-                    # that the start of the span is in the question. We throw out all
-                    # invalid predictions.
-                    if start_index >= len(feature.tokens):
-                        continue
-                    if end_index >= len(feature.tokens):
-                        continue
-                    if start_index not in feature.token_to_orig_map:
-                        continue
-                    if end_index not in feature.token_to_orig_map:
-                        continue
-                    if not feature.token_is_max_context.get(start_index, False):
-                        continue
-                    if end_index < start_index:
-                        continue
-                    length = end_index - start_index + 1
-                    if length > max_answer_length:
-                        continue
-                    prelim_predictions.append(
-                        _PrelimPrediction(
-                            feature_index=feature_index,
-                            start_index=start_index,
-                            end_index=end_index,
-                            start_logit=result.start_logits[start_index],
-                            end_logit=result.end_logits[end_index]))
-        if version_2_with_negative:
-            prelim_predictions.append(
-                _PrelimPrediction(
-                    feature_index=min_null_feature_index,
-                    start_index=0,
-                    end_index=0,
-                    start_logit=null_start_logit,
-                    end_logit=null_end_logit))
-        prelim_predictions = sorted(
-            prelim_predictions,
-            key=lambda x: (x.start_logit + x.end_logit),
-            reverse=True)
+                    null_start_logit = float(self.start_logits[feature_index, 0])
+                    null_end_logit = float(self.end_logits[feature_index, 0])
+            starts, ends = self.best_spans(feature_index)
+            feature_indexes.append(np.full(len(starts), feature_index))
+            start_indexes.append(starts)
+            end_indexes.append(ends)
+        if self.version_2_with_negative:
+            feature_indexes.append(np.array([min_null_feature_index]))
+            start_indexes.append(np.zeros(1, dtype=np.int64))
+            end_indexes.append(np.zeros(1, dtype=np.int64))
+        feature_indexes = np.concatenate(feature_indexes or [np.zeros(0, dtype=np.int64)])
+        start_indexes = np.concatenate(start_indexes or [np.zeros(0, dtype=np.int64)])
+        end_indexes = np.concatenate(end_indexes or [np.zeros(0, dtype=np.int64)])
+        start_logits = self.start_logits[feature_indexes, start_indexes]
+        end_logits = self.end_logits[feature_indexes, end_indexes]
+        if self.version_2_with_negative:
+            start_logits[-1], end_logits[-1] = null_start_logit, null_end_logit
+        scores = start_logits + end_logits
 
         _NbestPrediction = collections.namedtuple(  # pylint: disable=invalid-name
             "NbestPrediction", ["text", "start_logit", "end_logit"])
 
         seen_predictions = {}
         nbest = []
-        for pred in prelim_predictions:
-            if len(nbest) >= n_best_size:
+        # rank all candidates only if duplicate texts leave the n-best incomplete
+        num_ranked = 0
+        for k in (2 * self.n_best_size, len(scores)):
+            order = _get_best_indexes(scores, k)
+            for i in order[num_ranked:].tolist():
+                if len(nbest) >= self.n_best_size:
+                    break
+                if start_indexes[i] > 0:  # this is a non-null prediction
+                    final_text = self.span_text(example, feature_indexes[i], start_indexes[i], end_indexes[i])
+                    if final_text in seen_predictions:
+                        continue
+
+                    seen_predictions[final_text] = True
+                else:
+                    final_text = ""
+                    seen_predictions[final_text] = True
+
+                nbest.append(
+                    _NbestPrediction(
+                        text=final_text,
+                        start_logit=float(start_logits[i]),
+                        end_logit=float(end_logits[i])))
+            num_ranked = len(order)
+            if len(nbest) >= self.n_best_size or num_ranked == len(scores):
                 break
-            feature = features[pred.feature_index]
-            if pred.start_index > 0:  # this is a non-null prediction
-                tok_tokens = feature.tokens[pred.start_index:(pred.end_index + 1)]
-                orig_doc_start = feature.token_to_orig_map[pred.start_index]
-                orig_doc_end = feature.token_to_orig_map[pred.end_index]
-                orig_tokens = example.doc_tokens[orig_doc_start:(orig_doc_end + 1)]
-                tok_text = " ".join(tok_tokens)
-
-                # De-tokenize WordPieces that have been split off.
-                tok_text = tok_text.replace(" ##", "")
-                tok_text = tok_text.replace("##", "")
-
-                # Clean whitespace
-                tok_text = tok_text.strip()
-                tok_text = " ".join(tok_text.split())
-                orig_text = " ".join(orig_tokens)
-
-                final_text = get_final_text(tok_text, orig_text, do_lower_case, verbose_logging)
-                if final_text in seen_predictions:
-                    continue
-
-                seen_predictions[final_text] = True
-            else:
-                final_text = ""
-                seen_predictions[final_text] = True
 
-            nbest.append(
-                _NbestPrediction(
-                    text=final_text,
-                    start_logit=pred.start_logit,
-                    end_logit=pred.end_logit))
         # if we didn't include the empty option in the n-best, include it
-        if version_2_with_negative:
+        if self.version_2_with_negative:
             if "" not in seen_predictions:
                 nbest.append(
                     _NbestPrediction(
@@ -590,12 +758,8 @@ def write_predictions(all_examples, all_features, all_results, n_best_size,
         assert len(nbest) >= 1
 
         total_scores = []
-        best_non_null_entry = None
         for entry in nbest:
             total_scores.append(entry.start_logit + entry.end_logit)
-            if not best_non_null_entry:
-                if entry.text:
-                    best_non_null_entry = entry
 
         probs = _compute_softmax(total_scores)
 
@@ -609,18 +773,60 @@ def write_predictions(all_examples, all_features, all_results, n_best_size,
             nbest_json.append(output)
 
         assert len(nbest_json) >= 1
+        return nbest_json, score_null
+
+
+def _init_span_predictor(span_predictor):
+    global _span_predictor
+    _span_predictor = span_predictor
 
+
+def _predict_chunk(example_indexes):
+    return [_span_predictor(i) for i in example_indexes]
+
+
+def write_predictions(all_examples, all_features, all_results, n_best_size,
+                      max_answer_length, do_lower_case, output_prediction_file,
+                      output_nbest_file, output_null_log_odds_file, verbose_logging,
+                      version_2_with_negative, null_score_diff_threshold, num_workers=1):
+    """Write final predictions to the json file and log-odds of null if needed.
+
+    `all_features` are the `CachedFeatures` of the examples. The examples are
+    processed by a pool of `num_workers` processes when it is larger than 1.
+    """
+    logger.info("Writing predictions to: %s" % (output_prediction_file))
+    logger.info("Writing nbest to: %s" % (output_nbest_file))
+
+    span_predictor = SpanPredictor(all_examples, all_features, all_results, n_best_size,
+                                   max_answer_length, do_lower_case, verbose_logging,
+                                   version_2_with_negative)
+    if num_workers <= 1:
+        predictions = [span_predictor(i) for i in range(len(all_examples))]
+    else:
+        chunk_size = max(1, int(math.ceil(len(all_examples) / (num_workers * 4))))
+        chunks = [range(i, min(i + chunk_size, len(all_examples)))
+                  for i in range(0, len(all_examples), chunk_size)]
+        with multiprocessing.Pool(num_workers, initializer=_init_span_predictor,
+                                  initargs=(span_predictor,)) as pool:
+            predictions = [p for chunk in pool.imap(_predict_chunk, chunks) for p in chunk]
+
+    all_predictions = collections.OrderedDict()
+    all_nbest_json = collections.OrderedDict()
+    scores_diff_json = collections.OrderedDict()
+
+    for (example, (nbest_json, score_null)) in zip(all_examples, predictions):
         if not version_2_with_negative:
             all_predictions[example.qas_id] = nbest_json[0]["text"]
         else:
+            best_non_null_entry = next(entry for entry in nbest_json if entry["text"])
             # predict "" iff the null score - the score of best non-null > threshold
-            score_diff = score_null - best_non_null_entry.start_logit - (
-                best_non_null_entry.end_logit)
+            score_diff = score_null - best_non_null_entry["start_logit"] - (
+                best_non_null_entry["end_logit"])
             scores_diff_json[example.qas_id] = score_diff
             if score_diff > null_score_diff_threshold:
                 all_predictions[example.qas_id] = ""
             else:
-                all_predictions[example.qas_id] = best_non_null_entry.text
+                all_predictions[example.qas_id] = best_non_null_entry["text"]
             all_nbest_json[example.qas_id] = nbest_json
 
     with open(output_prediction_file, "w") as writer:
@@ -732,15 +938,15 @@ def get_final_text(pred_text, orig_text, do_lower_case, verbose_logging=False):
 
 
 def _get_best_indexes(logits, n_best_size):
-    """Get the n-best logits from a list."""
-    index_and_score = sorted(enumerate(logits), key=lambda x: x[1], reverse=True)
-
-    best_indexes = []
-    for i in range(len(index_and_score)):
-        if i >= n_best_size:
-            break
-        best_indexes.append(index_and_score[i][0])
-    return best_indexes
+    """Get the indexes of the n-best logits of an array, in the order of a
+    stable sort by decreasing logit."""
+    if n_best_size < len(logits):
+        kth = logits[np.argpartition(-logits, n_best_size - 1)[n_best_size - 1]]
+        candidates = np.flatnonzero(logits >= kth)
+    else:
+        candidates = np.arange(len(logits))
+    order = np.argsort(-logits[candidates], kind='stable')
+    return candidates[order[:n_best_size]]
 
 
 def _compute_softmax(scores):
@@ -856,6 +1062,20 @@ def main():
                         type=str,
                         required=True,
                         help="The BERT model config")
+    parser.add_argument('--preprocessing_workers',
+                        type=int, default=1,
+                        help="Number of processes converting the examples to features when they are not cached.")
+    parser.add_argument('--postprocessing_workers',
+                        type=int, default=1,
+                        help="Number of processes extracting the n-best answers from the predicted logits.")
+    parser.add_argument('--flat_optimizer',
+                        action='store_true',
+                        help="Keep the parameters and the BertAdam state in contiguous buffers and update them "
+                             "with a few vectorized ops instead of several ops per parameter.")
+    parser.add_argument('--length_bucketing',
+                        action='store_true',
+                        help="Batch sequences of similar lengths together and cut each batch after its longest "
+                             "sequence, rounded up to a multiple of 8, instead of padding to max_seq_length.")
     parser.add_argument('--log_freq',
                         type=int, default=50,
                         help='frequency of logging loss.')
@@ -977,7 +1197,8 @@ def main():
             optimizer = BertAdam(optimizer_grouped_parameters,
                                     lr=args.learning_rate,
                                     warmup=args.warmup_proportion,
-                                    t_total=num_train_optimization_steps)
+                                    t_total=num_train_optimization_steps,
+                                    flat=args.flat_optimizer)
 
     #print(model)
     if args.local_rank != -1:
@@ -993,44 +1214,27 @@ def main():
 
     global_step = 0
     if args.do_train:
-        cached_train_features_file = args.train_file + '_{0}_{1}_{2}_{3}'.format(
-            list(filter(None, args.bert_model.split('/'))).pop(), str(args.max_seq_length), str(args.doc_stride),
-            str(args.max_query_length))
-        train_features = None
-        try:
-            with open(cached_train_features_file, "rb") as reader:
-                train_features = pickle.load(reader)
-        except:
-            train_features = convert_examples_to_features(
-                examples=train_examples,
-                tokenizer=tokenizer,
-                max_seq_length=args.max_seq_length,
-                doc_stride=args.doc_stride,
-                max_query_length=args.max_query_length,
-                is_training=True)
-            if args.local_rank == -1 or torch.distributed.get_rank() == 0:
-                logger.info("  Saving train features into cached file %s", cached_train_features_file)
-                with open(cached_train_features_file, "wb") as writer:
-                    pickle.dump(train_features, writer)
+        train_features = get_features(args, train_examples, tokenizer, args.train_file, is_training=True)
         logger.info("***** Running training *****")
         logger.info("  Num orig examples = %d", len(train_examples))
-        logger.info("  Num split examples = %d", len(train_features))
+        logger.info("  Num split examples = %d", len(train_features['unique_id']))
         logger.info("  Batch size = %d", args.train_batch_size)
         logger.info("  Num steps = %d", num_train_optimization_steps)
-        all_input_ids = torch.tensor([f.input_ids for f in train_features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in train_features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in train_features], dtype=torch.long)
-        all_start_positions = torch.tensor([f.start_position for f in train_features], dtype=torch.long)
-        all_end_positions = torch.tensor([f.end_position for f in train_features], dtype=torch.long)
-        train_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids,
-                                   all_start_positions, all_end_positions)
-        if args.local_rank == -1:
-            train_sampler = RandomSampler(train_data)
+        train_data = FeatureDataset(train_features, ['input_ids', 'input_mask', 'segment_ids',
+                                                     'start_position', 'end_position'])
+        if args.length_bucketing:
+            train_sampler = LengthBucketSampler(train_features['input_mask'].sum(-1), args.train_batch_size,
+                                                num_replicas=get_world_size(), rank=get_rank(), seed=args.seed)
+            train_dataloader = DataLoader(train_data, batch_sampler=train_sampler, collate_fn=trim_batch)
         else:
-            train_sampler = DistributedSampler(train_data)
-        train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size)
+            if args.local_rank == -1:
+                train_sampler = RandomSampler(train_data)
+            else:
+                train_sampler = DistributedSampler(train_data)
+            train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size)
 
         model.train()
+        train_meter = ThroughputMeter()
         for _ in trange(int(args.num_train_epochs), desc="Epoch"):
             for step, batch in enumerate(tqdm(train_dataloader, desc="Iteration")):
                 # Terminate early for benchmarking
@@ -1038,6 +1242,7 @@ def main():
                 if args.max_steps > 0 and global_step > args.max_steps:
                     break
 
+                train_meter.update(batch[1])
                 if n_gpu == 1:
                     batch = tuple(t.to(device) for t in batch)  # multi-gpu does scattering it-self
                 input_ids, input_mask, segment_ids, start_positions, end_positions = batch
@@ -1075,6 +1280,7 @@ def main():
                     # logger.info("Step {}: Loss {}, LR {} ".format(global_step, loss.item(), lr_this_step))
                     logger.info(
                         "Step {}: Loss {}, LR {} ".format(global_step, loss.item(), optimizer.param_groups[0]['lr']))
+        logger.info("Training throughput: %s", train_meter.summary())
 
     if args.do_train:
         # Save a trained model and the associated configuration
@@ -1100,47 +1306,53 @@ def main():
 
         eval_examples = read_squad_examples(
             input_file=args.predict_file, is_training=False, version_2_with_negative=args.version_2_with_negative)
-        eval_features = convert_examples_to_features(
-            examples=eval_examples,
-            tokenizer=tokenizer,
-            max_seq_length=args.max_seq_length,
-            doc_stride=args.doc_stride,
-            max_query_length=args.max_query_length,
-            is_training=False)
+        eval_features = CachedFeatures(
+            get_features(args, eval_examples, tokenizer, args.predict_file, is_training=False),
+            tokenizer, is_training=False)
 
         logger.info("***** Running predictions *****")
         logger.info("  Num orig examples = %d", len(eval_examples))
         logger.info("  Num split examples = %d", len(eval_features))
         logger.info("  Batch size = %d", args.predict_batch_size)
 
-        all_input_ids = torch.tensor([f.input_ids for f in eval_features], dtype=torch.long)
-        all_input_mask = torch.tensor([f.input_mask for f in eval_features], dtype=torch.long)
-        all_segment_ids = torch.tensor([f.segment_ids for f in eval_features], dtype=torch.long)
-        all_example_index = torch.arange(all_input_ids.size(0), dtype=torch.long)
-        eval_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_example_index)
+        eval_data = FeatureDataset(eval_features.arrays, ['input_ids', 'input_mask', 'segment_ids', 'index'])
         # Run prediction for full data
-        eval_sampler = SequentialSampler(eval_data)
-        eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.predict_batch_size)
+        if args.length_bucketing:
+            eval_sampler = LengthBucketSampler(eval_features.arrays['input_mask'].sum(-1), args.predict_batch_size,
+                                               shuffle=False)
+            eval_dataloader = DataLoader(eval_data, batch_sampler=eval_sampler, collate_fn=trim_batch)
+        else:
+            eval_sampler = SequentialSampler(eval_data)
+            eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.predict_batch_size)
 
         model.eval()
         all_results = []
+        eval_meter = ThroughputMeter()
         logger.info("Start evaluating")
         for input_ids, input_mask, segment_ids, example_indices in tqdm(eval_dataloader, desc="Evaluating"):
             if len(all_results) % 1000 == 0:
                 logger.info("Processing example: %d" % (len(all_results)))
+            eval_meter.update(input_mask)
             input_ids = input_ids.to(device)
             input_mask = input_mask.to(device)
             segment_ids = segment_ids.to(device)
             with torch.no_grad():
                 batch_start_logits, batch_end_logits = model(input_ids, segment_ids, input_mask)
+            if batch_start_logits.size(1) < args.max_seq_length:
+                # positions cut from the batch are never predicted
+                pad = (0, args.max_seq_length - batch_start_logits.size(1))
+                batch_start_logits = torch.nn.functional.pad(batch_start_logits, pad, value=-10000.)
+                batch_end_logits = torch.nn.functional.pad(batch_end_logits, pad, value=-10000.)
             for i, example_index in enumerate(example_indices):
                 start_logits = batch_start_logits[i].detach().cpu().tolist()
                 end_logits = batch_end_logits[i].detach().cpu().tolist()
-                eval_feature = eval_features[example_index.item()]
-                unique_id = int(eval_feature.unique_id)
+                unique_id = int(eval_features.arrays['unique_id'][example_index.item()])
                 all_results.append(RawResult(unique_id=unique_id,
                                              start_logits=start_logits,
                                              end_logits=end_logits))
+        logger.info("Evaluation throughput: %s", eval_meter.summary())
+        # back to the order of the features, which are numbered consecutively
+        all_results.sort(key=lambda result: result.unique_id)
         output_prediction_file = os.path.join(args.output_dir, "predictions.json")
         output_nbest_file = os.path.join(args.output_dir, "nbest_predictions.json")
         output_null_log_odds_file = os.path.join(args.output_dir, "null_odds.json")
@@ -1148,7 +1360,8 @@ def main():
                           args.n_best_size, args.max_answer_length,
                           args.do_lower_case, output_prediction_file,
                           output_nbest_file, output_null_log_odds_file, args.verbose_logging,
-                          args.version_2_with_negative, args.null_score_diff_threshold)
+                          args.version_2_with_negative, args.null_score_diff_threshold,
+                          args.postprocessing_workers)
 
 
 if __name__ == "__main__":
@@ -34,6 +34,7 @@ from file_utils import PYTORCH_PRETRAINED_BERT_CACHE
 from modeling import BertForMultipleChoice, BertConfig, WEIGHTS_NAME, CONFIG_NAME
 from optimization import BertAdam, warmup_linear
 from tokenization import BertTokenizer
+from utils import LengthBucketSampler, ThroughputMeter, get_rank, get_world_size, trim_batch
 
 logging.basicConfig(format = '%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
                     datefmt = '%m/%d/%Y %H:%M:%S',
@@ -326,6 +327,14 @@ def main():
                         help="Loss scaling to improve fp16 numeric stability. Only used when fp16 set to True.\n"
                              "0 (default value): dynamic loss scaling.\n"
                              "Positive power of 2: static loss scaling value.\n")
+    parser.add_argument('--flat_optimizer',
+                        action='store_true',
+                        help="Keep the parameters and the BertAdam state in contiguous buffers and update them "
+                             "with a few vectorized ops instead of several ops per parameter.")
+    parser.add_argument('--length_bucketing',
+                        action='store_true',
+                        help="Batch sequences of similar lengths together and cut each batch after its longest "
+                             "sequence, rounded up to a multiple of 8, instead of padding to max_seq_length.")
 
     args = parser.parse_args()
 
@@ -374,7 +383,7 @@ def main():
 
     # Prepare model
     model = BertForMultipleChoice.from_pretrained(args.bert_model,
-        cache_dir=os.path.join(PYTORCH_PRETRAINED_BERT_CACHE, 'distributed_{}'.format(args.local_rank)),
+        cache_dir=PYTORCH_PRETRAINED_BERT_CACHE,
         num_choices=4)
     model.load_state_dict(torch.load(args.init_checkpoint, map_location='cpu'), strict=False)
 
@@ -422,7 +431,8 @@ def main():
         optimizer = BertAdam(optimizer_grouped_parameters,
                              lr=args.learning_rate,
                              warmup=args.warmup_proportion,
-                             t_total=num_train_optimization_steps)
+                             t_total=num_train_optimization_steps,
+                             flat=args.flat_optimizer)
 
     global_step = 0
     if args.do_train:
@@ -437,13 +447,21 @@ def main():
         all_segment_ids = torch.tensor(select_field(train_features, 'segment_ids'), dtype=torch.long)
         all_label = torch.tensor([f.label for f in train_features], dtype=torch.long)
         train_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label)
-        if args.local_rank == -1:
-            train_sampler = RandomSampler(train_data)
+        if args.length_bucketing:
+            # the longest of the choices of an example
+            lengths = all_input_mask.sum(-1).max(-1)[0].numpy()
+            train_sampler = LengthBucketSampler(lengths, args.train_batch_size,
+                                                num_replicas=get_world_size(), rank=get_rank(), seed=args.seed)
+            train_dataloader = DataLoader(train_data, batch_sampler=train_sampler, collate_fn=trim_batch)
         else:
-            train_sampler = DistributedSampler(train_data)
-        train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size)
+            if args.local_rank == -1:
+                train_sampler = RandomSampler(train_data)
+            else:
+                train_sampler = DistributedSampler(train_data)
+            train_dataloader = DataLoader(train_data, sampler=train_sampler, batch_size=args.train_batch_size)
 
         model.train()
+        train_meter = ThroughputMeter()
         for _ in trange(int(args.num_train_epochs), desc="Epoch"):
             tr_loss = 0
             nb_tr_examples, nb_tr_steps = 0, 0
@@ -452,6 +470,7 @@ def main():
                 if args.max_steps > 0 and global_step > args.max_steps:
                     break
 
+                train_meter.update(batch[1])
                 batch = tuple(t.to(device) for t in batch)
                 input_ids, input_mask, segment_ids, label_ids = batch
                 loss = model(input_ids, segment_ids, input_mask, label_ids)
@@ -481,6 +500,7 @@ def main():
                     optimizer.step()
                     optimizer.zero_grad()
                     global_step += 1
+        logger.info("Training throughput: %s", train_meter.summary())
 
 
     if args.do_train:
@@ -515,13 +535,20 @@ def main():
         all_label = torch.tensor([f.label for f in eval_features], dtype=torch.long)
         eval_data = TensorDataset(all_input_ids, all_input_mask, all_segment_ids, all_label)
         # Run prediction for full data
-        eval_sampler = SequentialSampler(eval_data)
-        eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.eval_batch_size)
+        if args.length_bucketing:
+            lengths = all_input_mask.sum(-1).max(-1)[0].numpy()
+            eval_sampler = LengthBucketSampler(lengths, args.eval_batch_size, shuffle=False)
+            eval_dataloader = DataLoader(eval_data, batch_sampler=eval_sampler, collate_fn=trim_batch)
+        else:
+            eval_sampler = SequentialSampler(eval_data)
+            eval_dataloader = DataLoader(eval_data, sampler=eval_sampler, batch_size=args.eval_batch_size)
 
         model.eval()
         eval_loss, eval_accuracy = 0, 0
         nb_eval_steps, nb_eval_examples = 0, 0
+        eval_meter = ThroughputMeter()
         for input_ids, input_mask, segment_ids, label_ids in tqdm(eval_dataloader, desc="Evaluating"):
+            eval_meter.update(input_mask)
             input_ids = input_ids.to(device)
             input_mask = input_mask.to(device)
             segment_ids = segment_ids.to(device)
@@ -541,6 +568,8 @@ def main():
             nb_eval_examples += input_ids.size(0)
             nb_eval_steps += 1
 
+        logger.info("Evaluation throughput: %s", eval_meter.summary())
+
         eval_loss = eval_loss / nb_eval_steps
         eval_accuracy = eval_accuracy / nb_eval_examples
 
@@ -0,0 +1,111 @@
+# coding=utf-8
+# Copyright (c) 2019 NVIDIA CORPORATION. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import torch
+
+from optimization import BertAdam, BertLAMB
+
+
+def _make_params(dtypes):
+    torch.manual_seed(1)
+    return [torch.nn.Parameter(torch.randn(*shape).to(dtype))
+            for shape, dtype in zip(((4, 3), (3,), (2, 5), (5,)), dtypes)]
+
+
+def _set_grads(params, step):
+    torch.manual_seed(100 + step)
+    for p in params:
+        p.grad = torch.randn(p.shape).to(p.dtype)
+
+
+def _param_groups(params):
+    # two groups with different weight decay
+    return [{'params': params[:2], 'weight_decay': 0.01},
+            {'params': params[2:], 'weight_decay': 0.0}]
+
+
+def _lamb_reference(params, num_steps, lr, b1, b2, e, max_grad_norm, warmup, t_total):
+    """LAMB applied to each parameter separately, with a global gradient norm
+    over all of them."""
+    masters = [p.detach().float().clone() for p in params]
+    momentum = [torch.zeros_like(m) for m in masters]
+    velocity = [torch.zeros_like(m) for m in masters]
+    decays = [group['weight_decay'] for group in _param_groups(params) for _ in group['params']]
+    dtypes = [p.dtype for p in params]
+    for step in range(1, num_steps + 1):
+        _set_grads(params, step)
+        grads = [p.grad.float() for p in params]
+        global_grad_norm = torch.norm(torch.stack([torch.norm(g) for g in grads])).item()
+        clip = global_grad_norm / max_grad_norm if global_grad_norm > max_grad_norm else 1.0
+        x = step / t_total
+        lr_scheduled = lr * (x / warmup if x < warmup else (1.0 - x) ** 0.5)
+        for master, m, v, g, decay, dtype in zip(masters, momentum, velocity, grads, decays, dtypes):
+            g = g / clip
+            m.mul_(b1).add_(g, alpha=1 - b1)
+            v.mul_(b2).addcmul_(g, g, value=1 - b2)
+            # the LAMB kernels correct the bias with the number of the step after this one
+            update = (m / (1 - b1 ** (step + 1))) / ((v / (1 - b2 ** (step + 1))).sqrt() + e)
+            update += decay * master
+            # the update of fp16 parameters is stored in their fp16 weights
+            update = update.to(dtype).float()
+            param_norm, update_norm = master.norm(), update.norm()
+            ratio = lr_scheduled * param_norm / update_norm if param_norm > 0 and update_norm > 0 else lr_scheduled
+            master.sub_(ratio * update)
+    return masters
+
+
+class TestBertAdam(unittest.TestCase):
+
+    def test_flat_matches_per_parameter(self):
+        results = []
+        for flat in (False, True):
+            params = _make_params([torch.float32] * 4)
+            optimizer = BertAdam(_param_groups(params), lr=1e-2, warmup=0.1, t_total=20,
+                                 max_grad_norm=1.0, flat=flat)
+            for step in range(6):
+                _set_grads(params, step)
+                optimizer.step()
+            results.append([p.detach().clone() for p in params])
+        for expected, actual in zip(*results):
+            self.assertTrue(torch.equal(expected, actual))
+
+
+class TestBertLAMB(unittest.TestCase):
+
+    def _check_flat_matches_reference(self, dtypes, atol):
+        hyperparams = dict(lr=1e-2, b1=0.9, b2=0.999, e=1e-6, max_grad_norm=1.0, warmup=0.1, t_total=20)
+        expected = _lamb_reference(_make_params(dtypes), num_steps=6, **hyperparams)
+
+        params = _make_params(dtypes)
+        optimizer = BertLAMB(_param_groups(params), flat=True, **hyperparams)
+        for step in range(1, 7):
+            _set_grads(params, step)
+            optimizer.step()
+        for p, master in zip(params, expected):
+            self.assertTrue(torch.allclose(p.float(), master.to(p.dtype).float(), rtol=0, atol=atol))
+            if p.dtype == torch.float16:
+                self.assertTrue(torch.allclose(optimizer.state[p]['master_param'], master, rtol=0, atol=1e-6))
+
+    def test_flat_matches_reference_fp32(self):
+        self._check_flat_matches_reference([torch.float32] * 4, atol=1e-6)
+
+    def test_flat_matches_reference_mixed_precision(self):
+        self._check_flat_matches_reference([torch.float16, torch.float32] * 2, atol=1e-3)
+
+
+if __name__ == '__main__':
+    unittest.main()
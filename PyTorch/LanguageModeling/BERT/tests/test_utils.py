@@ -0,0 +1,66 @@
+# coding=utf-8
+# Copyright (c) 2019 NVIDIA CORPORATION. All rights reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import unittest
+
+import torch
+
+from utils import AsyncCheckpointWriter
+
+
+def _checkpoint(step):
+    return {'model': {'weight': torch.full((3, 2), float(step))}, 'step': step}
+
+
+class TestAsyncCheckpointWriter(unittest.TestCase):
+
+    def _save_checkpoints(self, tmpdir, async_write):
+        writer = AsyncCheckpointWriter(keep=2, async_write=async_write)
+        paths = []
+        for step in range(4):
+            path = os.path.join(tmpdir, 'ckpt_{}.pt'.format(step))
+            checkpoint = _checkpoint(step)
+            writer.save({path: checkpoint, path + '.shard0': {'step': step}})
+            # the state may change as soon as save returns
+            checkpoint['model']['weight'].fill_(-1)
+            paths.append(path)
+        writer.wait()
+        return writer, paths
+
+    def _check_retention(self, tmpdir, paths):
+        self.assertEqual(sorted(os.listdir(tmpdir)),
+                         sorted(os.path.basename(p + suffix) for p in paths[-2:] for suffix in ('', '.shard0')))
+        for step, path in enumerate(paths[-2:], len(paths) - 2):
+            checkpoint = torch.load(path)
+            self.assertEqual(checkpoint['step'], step)
+            self.assertTrue(torch.equal(checkpoint['model']['weight'], torch.full((3, 2), float(step))))
+
+    def test_sync_write_does_not_copy_state(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            writer, paths = self._save_checkpoints(tmpdir, async_write=False)
+            self.assertEqual(writer._buffers, {})
+            self._check_retention(tmpdir, paths)
+
+    def test_async_write_keeps_newest_checkpoints(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            writer, paths = self._save_checkpoints(tmpdir, async_write=True)
+            self.assertTrue(writer._buffers)
+            self._check_retention(tmpdir, paths)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -10,9 +10,16 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import copy
+import os
+import queue
+import threading
 import time
+import numpy as np
 import torch
 import torch.distributed as dist
+from torch.utils.data import Sampler
+from torch.utils.data.dataloader import default_collate
 
 def get_rank():
     if not dist.is_available():
@@ -21,6 +28,13 @@ def get_rank():
         return 0
     return dist.get_rank()
 
+def get_world_size():
+    if not dist.is_available():
+        return 1
+    if not dist.is_initialized():
+        return 1
+    return dist.get_world_size()
+
 def is_main_process():
     return get_rank() == 0
 
@@ -87,4 +101,215 @@ class Timers:
             elapsed_time = self.timers[name].elapsed(
                 reset=reset) * 1000.0/ normalizer
             string += ' | {}: {:.2f}'.format(name, elapsed_time)
-        print_rank_0(string)
\ No newline at end of file
+        print_rank_0(string)
+
+class AsyncCheckpointWriter:
+    """Writes checkpoints to disk on a background thread.
+
+    With `async_write`, `save` copies all tensors of the checkpoint to pinned
+    CPU buffers, which are reused between checkpoints, and returns as soon as
+    the copies are enqueued on the current CUDA stream. Otherwise the live
+    state is saved directly and `save` returns once it is on disk. The files
+    are written to a temporary name and renamed once complete, so that an
+    interrupted write never leaves a truncated checkpoint behind. Only the
+    `keep` most recent checkpoints are retained.
+
+    At most one checkpoint is being written at a time: `save` first waits for
+    the previous one, which also surfaces any error raised while writing it.
+    """
+
+    def __init__(self, keep=3, async_write=True):
+        self.keep = keep
+        self.async_write = async_write
+        self._buffers = {}
+        self._saved = []
+        self._error = None
+        self._queue = queue.Queue(maxsize=1)
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _snapshot(self, obj, key=()):
+        if torch.is_tensor(obj):
+            buf = self._buffers.get(key)
+            if buf is None or buf.shape != obj.shape or buf.dtype != obj.dtype:
+                buf = torch.empty(obj.shape, dtype=obj.dtype, pin_memory=obj.is_cuda)
+                self._buffers[key] = buf
+            buf.copy_(obj.detach(), non_blocking=True)
+            return buf
+        if isinstance(obj, dict):
+            return type(obj)((k, self._snapshot(v, key + (k,))) for k, v in obj.items())
+        if isinstance(obj, (list, tuple)):
+            return type(obj)(self._snapshot(v, key + (i,)) for i, v in enumerate(obj))
+        return copy.deepcopy(obj)
+
+    def _run(self):
+        while True:
+            files, copied = self._queue.get()
+            try:
+                if copied is not None:
+                    copied.synchronize()
+                for path, state in files.items():
+                    tmp_path = path + '.tmp'
+                    torch.save(state, tmp_path)
+                    os.replace(tmp_path, path)
+                self._saved.append(list(files))
+                while len(self._saved) > self.keep:
+                    for path in self._saved.pop(0):
+                        if os.path.exists(path):
+                            os.remove(path)
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def save(self, files):
+        """Save a checkpoint made of one or more files.
+
+        Args:
+            files: dict mapping file paths to the objects saved in them
+        """
+        self.wait()
+        if not self.async_write:
+            # the state is not modified before the write completes, so it needs no copy
+            self._queue.put((files, None))
+            self.wait()
+            return
+        # buffers are keyed by the position of the file, as paths change between checkpoints
+        files = {path: self._snapshot(state, (i,)) for i, (path, state) in enumerate(files.items())}
+        copied = None
+        if torch.cuda.is_available():
+            copied = torch.cuda.Event()
+            copied.record()
+        self._queue.put((files, copied))
+
+    def wait(self):
+        """Block until the pending checkpoint is on disk."""
+        self._queue.join()
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+
+def shard_checkpoint(checkpoint, rank, world_size):
+    """Split the optimizer state and the master params of a checkpoint across
+    ranks.
+
+    Returns the checkpoint without the sharded entries (to be saved by rank 0)
+    and the shard of this rank.
+    """
+    optimizer = checkpoint['optimizer']
+    shard = {
+        'optimizer state': {k: v for k, v in optimizer['state'].items() if k % world_size == rank},
+        'master params': {i: p for i, p in enumerate(checkpoint['master params']) if i % world_size == rank},
+    }
+    checkpoint = dict(checkpoint)
+    checkpoint['optimizer'] = {'state': {}, 'param_groups': optimizer['param_groups']}
+    checkpoint['master params'] = []
+    checkpoint['num_shards'] = world_size
+    return checkpoint, shard
+
+
+def shard_path(path, rank):
+    return '{}.shard{}'.format(path, rank)
+
+
+def load_checkpoint(path):
+    """Load a checkpoint saved by rank 0, merging in the shards of all ranks
+    if it was sharded."""
+    checkpoint = torch.load(path, map_location="cpu")
+    num_shards = checkpoint.pop('num_shards', None)
+    if num_shards is not None:
+        master_params = {}
+        for rank in range(num_shards):
+            shard = torch.load(shard_path(path, rank), map_location="cpu")
+            checkpoint['optimizer']['state'].update(shard['optimizer state'])
+            master_params.update(shard['master params'])
+        checkpoint['master params'] = [master_params[i] for i in range(len(master_params))]
+    return checkpoint
+
+
+class LengthBucketSampler(Sampler):
+    """Batch sampler grouping sequences of similar lengths, to be used with
+    `trim_batch` so that batches carry little padding.
+
+    When shuffling, the indices are shuffled and split into pools of
+    `pool_batches` batches; each pool is sorted by length and cut into
+    batches, and the batches of all pools are shuffled again. Otherwise all
+    indices are sorted by decreasing length. With several replicas, every
+    replica gets every `num_replicas`-th batch, and batches are repeated so
+    that all replicas run the same number of steps.
+    """
+
+    def __init__(self, lengths, batch_size, shuffle=True, pool_batches=100,
+                 num_replicas=1, rank=0, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.pool_batches = pool_batches
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+
+    def _num_batches(self):
+        return (len(self.lengths) + self.batch_size - 1) // self.batch_size
+
+    def __iter__(self):
+        if self.shuffle:
+            # all replicas draw the same batches in the same epoch
+            rng = np.random.RandomState(self.seed + self.epoch)
+            self.epoch += 1
+            order = rng.permutation(len(self.lengths))
+            pool_size = self.batch_size * self.pool_batches
+            order = np.concatenate(
+                [pool[np.argsort(-self.lengths[pool], kind='stable')]
+                 for pool in np.split(order, range(pool_size, len(order), pool_size))])
+        else:
+            order = np.argsort(-self.lengths, kind='stable')
+        batches = [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        num_batches = len(self) * self.num_replicas
+        batches = (batches * self.num_replicas)[:num_batches]
+        for batch in batches[self.rank::self.num_replicas]:
+            yield batch.tolist()
+
+    def __len__(self):
+        return (self._num_batches() + self.num_replicas - 1) // self.num_replicas
+
+
+def trim_batch(batch, mask_index=1, seq_fields=(0, 1, 2), multiple_of=8):
+    """Collate function cutting the sequence fields of a batch after its
+    longest sequence, rounded up to a multiple of `multiple_of`.
+
+    Args:
+        mask_index: position of the input mask among the fields of a sample
+        seq_fields: positions of the fields whose last dimension is the
+            sequence
+    """
+    batch = default_collate(batch)
+    input_mask = batch[mask_index]
+    length = int(input_mask.sum(-1).max()) if input_mask.numel() else 0
+    length = min((length + multiple_of - 1) // multiple_of * multiple_of, input_mask.size(-1))
+    return [t[..., :length].contiguous() if i in seq_fields else t for i, t in enumerate(batch)]
+
+
+class ThroughputMeter:
+    """Counts the real tokens and the sequence positions (real tokens and
+    padding) processed per second."""
+
+    def __init__(self):
+        self.tokens = 0
+        self.positions = 0
+        self.start_time = time.time()
+
+    def update(self, input_mask):
+        self.tokens += int(input_mask.sum())
+        self.positions += input_mask.numel()
+
+    def summary(self):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        elapsed = time.time() - self.start_time
+        return '{:.1f} tokens/s, {:.1f}% of the processed positions are padding'.format(
+            self.tokens / elapsed, 100. * (1 - self.tokens / max(self.positions, 1)))
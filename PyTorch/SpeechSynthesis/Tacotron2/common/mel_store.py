@@ -0,0 +1,130 @@
+# *****************************************************************************
+#  Copyright (c) 2018, NVIDIA CORPORATION.  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions are met:
+#      * Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#      * Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#      * Neither the name of the NVIDIA CORPORATION nor the
+#        names of its contributors may be used to endorse or promote products
+#        derived from this software without specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+#  ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+#  WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+#  DISCLAIMED. IN NO EVENT SHALL NVIDIA CORPORATION BE LIABLE FOR ANY
+#  DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+#  (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+#  LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+#  ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+#  (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+#  SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# *****************************************************************************
+
+import os
+import numpy as np
+import torch
+
+
+def mel_store_key(path):
+    """
+    Store key of an utterance: its file name without directory and extension,
+    so that the audio and mel file lists of an utterance share its key. File
+    names must be unique across the store.
+    """
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+class MelStoreWriter():
+    """
+    Appends mel-spectrograms to a single float16 file, frames stored
+    contiguously per utterance, and writes an offset index on close().
+    """
+
+    def __init__(self, path, n_mel_channels):
+        self.path = path
+        self.n_mel_channels = n_mel_channels
+        self.keys = []
+        self.key_set = set()
+        self.lengths = []
+        self.data = open(path + '.bin.tmp', 'wb')
+
+    def add(self, key, mel):
+        assert mel.size(0) == self.n_mel_channels, (
+            'Mel dimension mismatch: given {}, expected {}'.format(
+                mel.size(0), self.n_mel_channels))
+        if key in self.key_set:
+            raise ValueError(
+                'Duplicate mel store key {}: utterances in different '
+                'directories have the same file name'.format(key))
+        self.key_set.add(key)
+        frames = mel.t().contiguous().numpy().astype(np.float16)
+        self.data.write(frames.tobytes())
+        self.keys.append(key)
+        self.lengths.append(frames.shape[0])
+
+    def close(self):
+        self.data.close()
+        lengths = np.array(self.lengths, dtype=np.int64)
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        os.replace(self.path + '.bin.tmp', self.path + '.bin')
+        with open(self.path + '.idx.tmp', 'wb') as f:
+            np.savez(f, keys=np.array(self.keys), offsets=offsets,
+                     n_mel_channels=self.n_mel_channels)
+        os.replace(self.path + '.idx.tmp', self.path + '.idx')
+
+
+class MelStore():
+    """
+    Read-only view of a store written by MelStoreWriter.
+
+    The data file is memory-mapped on first access in each process, so the
+    store can be created before DataLoader workers are forked.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path + '.idx', 'rb') as f:
+            index = np.load(f)
+            keys = index['keys']
+            self.offsets = index['offsets']
+            self.n_mel_channels = int(index['n_mel_channels'])
+        self.key_to_id = {str(k): i for i, k in enumerate(keys)}
+        if len(self.key_to_id) != len(keys):
+            raise ValueError('{} has duplicate keys'.format(path + '.idx'))
+        self._data = None
+
+    def __len__(self):
+        return len(self.key_to_id)
+
+    def __contains__(self, path):
+        return mel_store_key(path) in self.key_to_id
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = np.memmap(self.path + '.bin', dtype=np.float16,
+                                   mode='r').reshape(-1, self.n_mel_channels)
+        return self._data
+
+    def num_frames(self, path):
+        i = self.key_to_id[mel_store_key(path)]
+        return int(self.offsets[i+1] - self.offsets[i])
+
+    def get(self, path, start=0, length=None):
+        """
+        Returns frames [start, start+length) of the utterance as a float32
+        tensor of shape n_mel_channels x frames.
+        """
+        i = self.key_to_id[mel_store_key(path)]
+        begin = self.offsets[i] + start
+        end = self.offsets[i+1]
+        if length is not None:
+            end = min(end, begin + length)
+        frames = np.array(self.data[begin:end], dtype=np.float32)
+        return torch.from_numpy(frames).t().contiguous()
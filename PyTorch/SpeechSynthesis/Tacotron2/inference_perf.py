@@ -54,6 +54,15 @@ def parse_args(parser):
     parser.add_argument('-bs', '--batch-size', type=int, default=1)
     parser.add_argument('--log-file', type=str, default='nvlog.json',
                         help='Filename for logging')
+    parser.add_argument('--chunk-size', type=int, default=0,
+                        help='WaveGlow: vocode in chunks of this many mel frames '
+                        '(0 disables chunking)')
+    parser.add_argument('--chunk-context', type=int, default=None,
+                        help='WaveGlow: mel frames of context on each side of a chunk '
+                        '(default: the receptive field of WaveGlow, smaller values '
+                        'are faster but only approximate the unchunked audio)')
+    parser.add_argument('--chunk-overlap', type=int, default=256,
+                        help='WaveGlow: audio samples crossfaded between chunks')
 
     return parser
 
@@ -81,6 +90,11 @@ def main():
                            metric_scope=dllg.TRAIN_ITER_SCOPE)
     LOGGER.register_metric("latency",
                            metric_scope=dllg.TRAIN_ITER_SCOPE)
+    if args.model_name == 'WaveGlow':
+        LOGGER.register_metric("time_to_first_chunk",
+                               metric_scope=dllg.TRAIN_ITER_SCOPE)
+        LOGGER.register_metric("rtf",
+                               metric_scope=dllg.TRAIN_ITER_SCOPE)
 
     log_hardware()
     log_args(args)
@@ -112,14 +126,32 @@ def main():
             if args.amp_run:
                 mel_padded = mel_padded.half()
 
-            with torch.no_grad(), MeasureTime(measurements, "inference_time"):
-                audios = model.infer(mel_padded)
-                audios = audios.float()
+            if args.chunk_size > 0:
+                with torch.no_grad(), MeasureTime(measurements, "inference_time"):
+                    chunks = model.infer_chunked(mel_padded,
+                                                 chunk_size=args.chunk_size,
+                                                 context=args.chunk_context,
+                                                 overlap=args.chunk_overlap)
+                    with MeasureTime(measurements, "time_to_first_chunk"):
+                        audios = [next(chunks).float()]
+                    audios += [chunk.float() for chunk in chunks]
+                    audios = torch.cat(audios, 1)
+            else:
+                with torch.no_grad(), MeasureTime(measurements, "inference_time"):
+                    audios = model.infer(mel_padded)
+                    audios = audios.float()
+                measurements['time_to_first_chunk'] = measurements['inference_time']
             num_items = audios.size(0)*audios.size(1)
+            measurements['rtf'] = (measurements['inference_time'] /
+                                   (audios.size(1)/args.sampling_rate))
 
         if i >= warmup_iters:
             LOGGER.log(key="items_per_sec", value=(num_items/measurements['inference_time']))
             LOGGER.log(key="latency", value=measurements['inference_time'])
+            if args.model_name == 'WaveGlow':
+                LOGGER.log(key="time_to_first_chunk",
+                           value=measurements['time_to_first_chunk'])
+                LOGGER.log(key="rtf", value=measurements['rtf'])
             LOGGER.iteration_stop()
 
     LOGGER.finish()
@@ -0,0 +1,321 @@
+# *****************************************************************************
+#  Copyright (c) 2018, NVIDIA CORPORATION.  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions are met:
+#      * Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#      * Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#      * Neither the name of the NVIDIA CORPORATION nor the
+#        names of its contributors may be used to endorse or promote products
+#        derived from this software without specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+#  ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+#  WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+#  DISCLAIMED. IN NO EVENT SHALL NVIDIA CORPORATION BE LIABLE FOR ANY
+#  DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+#  (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+#  LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+#  ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+#  (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+#  SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# *****************************************************************************
+
+from tacotron2.text import text_to_sequence
+import torch
+import argparse
+import numpy as np
+from scipy.io.wavfile import write
+
+import io
+import json
+import queue
+import threading
+import time
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+from inference import load_and_setup_model
+from waveglow.denoiser import Denoiser
+
+
+def parse_args(parser):
+    """
+    Parse commandline arguments.
+    """
+    parser.add_argument('--tacotron2', type=str,
+                        help='full path to the Tacotron2 model checkpoint file')
+    parser.add_argument('--waveglow', type=str,
+                        help='full path to the WaveGlow model checkpoint file')
+    parser.add_argument('-s', '--sigma-infer', default=0.9, type=float)
+    parser.add_argument('-d', '--denoising-strength', default=0.01, type=float)
+    parser.add_argument('-sr', '--sampling-rate', default=22050, type=int,
+                        help='Sampling rate')
+    parser.add_argument('--amp-run', action='store_true',
+                        help='inference with AMP')
+    parser.add_argument('--stft-hop-length', type=int, default=256,
+                        help='STFT hop length for estimating audio length from mel size')
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='Address to listen on')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='Port to listen on')
+    parser.add_argument('--max-batch-size', type=int, default=8,
+                        help='Maximum number of texts synthesized together')
+    parser.add_argument('--max-wait-ms', type=float, default=10.0,
+                        help='Maximum time a request waits for a batch to fill up')
+    parser.add_argument('--latency-window', type=int, default=1000,
+                        help='Number of most recent requests used for latency percentiles')
+
+    return parser
+
+
+class Request():
+    def __init__(self, text):
+        self.sequence = torch.IntTensor(
+            text_to_sequence(text, ['english_cleaners'])[:])
+        self.arrival = time.perf_counter()
+        self.done = threading.Event()
+        self.wav = None
+        self.error = None
+
+
+class Metrics():
+    def __init__(self, latency_window):
+        self.lock = threading.Lock()
+        self.batch_sizes = Counter()
+        self.latencies = deque(maxlen=latency_window)
+        self.num_requests = 0
+        self.num_samples = 0
+
+    def add_batch(self, requests, num_samples):
+        now = time.perf_counter()
+        with self.lock:
+            self.batch_sizes[len(requests)] += 1
+            self.latencies.extend(now - r.arrival for r in requests)
+            self.num_requests += len(requests)
+            self.num_samples += num_samples
+
+    def summary(self, queue_depth):
+        with self.lock:
+            latencies = list(self.latencies)
+            summary = {"queue_depth": queue_depth,
+                       "num_requests": self.num_requests,
+                       "num_samples": self.num_samples,
+                       "batch_size_histogram": dict(sorted(self.batch_sizes.items()))}
+        if latencies:
+            summary["latency_p50"] = float(np.percentile(latencies, 50))
+            summary["latency_p99"] = float(np.percentile(latencies, 99))
+        return summary
+
+
+class DynamicBatcher():
+    """
+    Groups incoming requests into batches of similar text length.
+
+    A batch is formed as soon as max_batch_size requests are pending or the
+    oldest pending request has waited max_wait seconds. Batches are padded on
+    the CPU by a batching thread and handed to the inference thread through a
+    single-slot queue, so the next batch is prepared while the GPU works.
+    """
+
+    def __init__(self, tacotron2, waveglow, denoiser, args, metrics):
+        self.tacotron2 = tacotron2
+        self.waveglow = waveglow
+        self.denoiser = denoiser
+        self.args = args
+        self.metrics = metrics
+        self.max_wait = args.max_wait_ms / 1000.0
+        self.requests = queue.Queue()
+        self.batches = queue.Queue(maxsize=1)
+        self.pending = []
+
+        for target in (self._batching_loop, self._inference_loop):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+
+    def submit(self, text):
+        request = Request(text)
+        self.requests.put(request)
+        request.done.wait()
+        if request.error is not None:
+            raise request.error
+        return request.wav
+
+    def queue_depth(self):
+        return self.requests.qsize() + len(self.pending)
+
+    def _next_batch(self):
+        if not self.pending:
+            self.pending.append(self.requests.get())
+        deadline = self.pending[0].arrival + self.max_wait
+        while len(self.pending) < self.args.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                self.pending.append(self.requests.get(timeout=timeout))
+            except queue.Empty:
+                break
+        while True:
+            try:
+                self.pending.append(self.requests.get_nowait())
+            except queue.Empty:
+                break
+
+        # the oldest request always goes out, together with the requests
+        # closest to it in length
+        oldest = self.pending[0]
+        by_length = sorted(self.pending[1:], key=lambda r: abs(
+            r.sequence.size(0) - oldest.sequence.size(0)))
+        batch = [oldest] + by_length[:self.args.max_batch_size - 1]
+        self.pending = [r for r in self.pending if r not in batch]
+
+        # Tacotron2 expects the inputs sorted by decreasing length
+        batch.sort(key=lambda r: r.sequence.size(0), reverse=True)
+        return batch
+
+    @staticmethod
+    def _pad_batch(batch):
+        # Right zero-pad the text sequences in the order of the batch, so that
+        # the outputs stay aligned with the requests
+        input_lengths = torch.LongTensor([r.sequence.size(0) for r in batch])
+        text_padded = torch.zeros(len(batch), int(input_lengths[0]),
+                                  dtype=torch.long)
+        for i, request in enumerate(batch):
+            text_padded[i, :request.sequence.size(0)] = request.sequence
+        return text_padded, input_lengths
+
+    def _batching_loop(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                text_padded, input_lengths = self._pad_batch(batch)
+                if torch.cuda.is_available():
+                    text_padded = text_padded.pin_memory()
+                    input_lengths = input_lengths.pin_memory()
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+                    request.done.set()
+                continue
+            self.batches.put((batch, text_padded, input_lengths))
+
+    def _inference_loop(self):
+        while True:
+            batch, text_padded, input_lengths = self.batches.get()
+            try:
+                audios, audio_lengths = self._infer(text_padded, input_lengths)
+                for request, audio, length in zip(batch, audios, audio_lengths):
+                    request.wav = self._to_wav(audio[:length])
+                self.metrics.add_batch(batch, int(sum(audio_lengths)))
+            except Exception as e:
+                for request in batch:
+                    request.error = e
+            for request in batch:
+                request.done.set()
+
+    def _infer(self, text_padded, input_lengths):
+        if torch.cuda.is_available():
+            text_padded = text_padded.cuda(non_blocking=True)
+            input_lengths = input_lengths.cuda(non_blocking=True)
+        with torch.no_grad():
+            _, mel, _, _, mel_lengths = self.tacotron2.infer(
+                text_padded.long(), input_lengths.long())
+            audios = self.waveglow.infer(mel, sigma=self.args.sigma_infer)
+            audios = audios.float()
+            audios = self.denoiser(
+                audios, strength=self.args.denoising_strength).squeeze(1)
+        audio_lengths = (mel_lengths * self.args.stft_hop_length).tolist()
+        return audios.cpu(), audio_lengths
+
+    def _to_wav(self, audio):
+        peak = torch.max(torch.abs(audio)) if audio.numel() > 0 else 0
+        if peak > 0:  # silent audio is written as is
+            audio = audio/peak
+        buf = io.BytesIO()
+        write(buf, self.args.sampling_rate, audio.numpy())
+        return buf.getvalue()
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(batcher, metrics):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_POST(self):
+            if self.path != '/synthesize':
+                self.send_error(404)
+                return
+            length = int(self.headers.get('Content-Length', 0))
+            text = self.rfile.read(length).decode('utf-8').strip()
+            if not text:
+                self.send_error(400, 'empty text')
+                return
+            try:
+                wav = batcher.submit(text)
+            except Exception as e:
+                self.send_error(500, str(e))
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', 'audio/wav')
+            self.send_header('Content-Length', str(len(wav)))
+            self.end_headers()
+            self.wfile.write(wav)
+
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = json.dumps(metrics.summary(batcher.queue_depth())).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    return Handler
+
+
+def main():
+    """
+    Launches a text to speech server.
+    POST /synthesize with the text as the request body returns a WAV file,
+    GET /metrics returns queue depth, batch size histogram and latencies.
+    Inference is executed on a single GPU.
+    """
+    parser = argparse.ArgumentParser(
+        description='PyTorch Tacotron 2 Inference Server')
+    parser = parse_args(parser)
+    args, _ = parser.parse_known_args()
+
+    tacotron2 = load_and_setup_model('Tacotron2', parser, args.tacotron2,
+                                     args.amp_run)
+    waveglow = load_and_setup_model('WaveGlow', parser, args.waveglow,
+                                    args.amp_run)
+    denoiser = Denoiser(waveglow).cuda()
+
+    metrics = Metrics(args.latency_window)
+    batcher = DynamicBatcher(tacotron2, waveglow, denoiser, args, metrics)
+
+    server = ThreadingHTTPServer((args.host, args.port),
+                                 make_handler(batcher, metrics))
+    print("Serving on {}:{}".format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    server.server_close()
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,11 @@
 import argparse
 import torch
+from contextlib import contextmanager
+from multiprocessing import Pool
 
-from tacotron2.data_function import TextMelLoader
-from common.utils import load_filepaths_and_text
+import common.layers as layers
+from common.mel_store import MelStoreWriter, mel_store_key
+from common.utils import load_wav_to_torch, load_filepaths_and_text
 
 def parse_args(parser):
     """
@@ -10,10 +13,15 @@ def parse_args(parser):
     """
     parser.add_argument('-d', '--dataset-path', type=str,
                         default='./', help='Path to dataset')
-    parser.add_argument('--wav-files', required=True,
-                        type=str, help='Path to filelist with audio paths and text')
-    parser.add_argument('--mel-files', required=True,
-                        type=str, help='Path to filelist with mel paths and text')
+    parser.add_argument('--wav-files', required=True, nargs='+',
+                        type=str, help='Path to filelist(s) with audio paths and text')
+    parser.add_argument('--mel-files', type=str, default=None, nargs='+',
+                        help='Path to filelist(s) with mel paths and text')
+    parser.add_argument('--mel-store', type=str, default=None,
+                        help='Write all mels into a single memory-mappable store '
+                        '(<mel-store>.bin and <mel-store>.idx) instead of per-file')
+    parser.add_argument('-j', '--workers', type=int, default=1,
+                        help='Number of processes computing the mels')
     parser.add_argument('--text-cleaners', nargs='*',
                         default=['english_cleaners'], type=str,
                         help='Type of text cleaners for input text')
@@ -37,28 +45,95 @@ def parse_args(parser):
     return parser
 
 
+_stft = None
+_max_wav_value = None
+
+
+def _init_worker(args):
+    global _stft, _max_wav_value
+    torch.set_num_threads(1)
+    _max_wav_value = args.max_wav_value
+    _stft = layers.TacotronSTFT(
+        args.filter_length, args.hop_length, args.win_length,
+        args.n_mel_channels, args.sampling_rate, args.mel_fmin,
+        args.mel_fmax)
+
+
+# same as tacotron2/data_function.py:TextMelLoader.get_mel
+def _compute_mel(filename):
+    audio, sampling_rate = load_wav_to_torch(filename)
+    if sampling_rate != _stft.sampling_rate:
+        raise ValueError("{} {} SR doesn't match target {} SR".format(
+            sampling_rate, _stft.sampling_rate))
+    audio_norm = audio / _max_wav_value
+    audio_norm = audio_norm.unsqueeze(0)
+    audio_norm = torch.autograd.Variable(audio_norm, requires_grad=False)
+    melspec = _stft.mel_spectrogram(audio_norm)
+    melspec = torch.squeeze(melspec, 0)
+    return melspec
+
+
+def _compute_and_save_mel(paths):
+    audiopath, melpath = paths
+    torch.save(_compute_mel(audiopath), melpath)
+
+
+@contextmanager
+def _map(args, func, items):
+    if args.workers > 1:
+        # the workers are terminated when leaving the block, also on errors
+        with Pool(args.workers, initializer=_init_worker, initargs=(args,)) as pool:
+            yield pool.imap(func, items, chunksize=16)
+    else:
+        _init_worker(args)
+        yield map(func, items)
+
+
 def audio2mel(dataset_path, audiopaths_and_text, melpaths_and_text, args):
 
     melpaths_and_text_list = load_filepaths_and_text(dataset_path, melpaths_and_text)
     audiopaths_and_text_list = load_filepaths_and_text(dataset_path, audiopaths_and_text)
 
-    data_loader = TextMelLoader(dataset_path, audiopaths_and_text, args)
+    paths = [(audiopaths_and_text_list[i][0], melpaths_and_text_list[i][0])
+             for i in range(len(melpaths_and_text_list))]
+
+    with _map(args, _compute_and_save_mel, paths) as results:
+        for i, _ in enumerate(results):
+            if i%100 == 0:
+                print("done", i, "/", len(paths))
+
+
+def audio2mel_store(dataset_path, audiopaths_and_text_files, mel_store, args):
+
+    audiopaths = []
+    for audiopaths_and_text in audiopaths_and_text_files:
+        audiopaths_and_text_list = load_filepaths_and_text(dataset_path, audiopaths_and_text)
+        audiopaths += [audiopath for audiopath, _ in audiopaths_and_text_list]
 
-    for i in range(len(melpaths_and_text_list)):
-        if i%100 == 0:
-            print("done", i, "/", len(melpaths_and_text_list))
+    writer = MelStoreWriter(mel_store, args.n_mel_channels)
+    with _map(args, _compute_mel, audiopaths) as mels:
+        for i, mel in enumerate(mels):
+            if i%100 == 0:
+                print("done", i, "/", len(audiopaths))
+            writer.add(mel_store_key(audiopaths[i]), mel)
+    writer.close()
 
-        mel = data_loader.get_mel(audiopaths_and_text_list[i][0])
-        torch.save(mel, melpaths_and_text_list[i][0])
 
 def main():
 
     parser = argparse.ArgumentParser(description='PyTorch Tacotron 2 Training')
     parser = parse_args(parser)
     args = parser.parse_args()
-    args.load_mel_from_disk = False
 
-    audio2mel(args.dataset_path, args.wav_files, args.mel_files, args)
+    if args.mel_store is not None:
+        audio2mel_store(args.dataset_path, args.wav_files, args.mel_store, args)
+    elif args.mel_files is not None:
+        if len(args.mel_files) != len(args.wav_files):
+            parser.error('--mel-files and --wav-files differ in length')
+        for wav_files, mel_files in zip(args.wav_files, args.mel_files):
+            audio2mel(args.dataset_path, wav_files, mel_files, args)
+    else:
+        parser.error('one of --mel-files or --mel-store is required')
 
 if __name__ == '__main__':
     main()
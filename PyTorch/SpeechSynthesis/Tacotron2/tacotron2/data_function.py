@@ -31,8 +31,9 @@ import torch
 import torch.utils.data
 
 import common.layers as layers
+from common.mel_store import MelStore
 from common.utils import load_wav_to_torch, load_filepaths_and_text, to_gpu
-from tacotron2.text import text_to_sequence
+from tacotron2.text import text_to_sequence, texts_to_sequences
 
 class TextMelLoader(torch.utils.data.Dataset):
     """
@@ -46,23 +47,36 @@ class TextMelLoader(torch.utils.data.Dataset):
         self.max_wav_value = args.max_wav_value
         self.sampling_rate = args.sampling_rate
         self.load_mel_from_disk = args.load_mel_from_disk
+        self.mel_store = None
+        if getattr(args, 'mel_store', None) is not None:
+            self.mel_store = MelStore(args.mel_store)
         self.stft = layers.TacotronSTFT(
             args.filter_length, args.hop_length, args.win_length,
             args.n_mel_channels, args.sampling_rate, args.mel_fmin,
             args.mel_fmax)
         random.seed(1234)
         random.shuffle(self.audiopaths_and_text)
+        # clean the transcripts once instead of on every epoch
+        self.text_ids, self.text_offsets = texts_to_sequences(
+            [text for _, text in self.audiopaths_and_text], self.text_cleaners,
+            getattr(args, 'text_cache_dir', None))
 
-    def get_mel_text_pair(self, audiopath_and_text):
+    def get_mel_text_pair(self, index):
         # separate filename and text
-        audiopath, text = audiopath_and_text[0], audiopath_and_text[1]
+        audiopath, text = self.audiopaths_and_text[index]
         len_text = len(text)
-        text = self.get_text(text)
+        text = torch.from_numpy(
+            self.text_ids[self.text_offsets[index]:self.text_offsets[index+1]])
         mel = self.get_mel(audiopath)
         return (text, mel, len_text)
 
     def get_mel(self, filename):
-        if not self.load_mel_from_disk:
+        if self.mel_store is not None:
+            melspec = self.mel_store.get(filename)
+            assert melspec.size(0) == self.stft.n_mel_channels, (
+                'Mel dimension mismatch: given {}, expected {}'.format(
+                    melspec.size(0), self.stft.n_mel_channels))
+        elif not self.load_mel_from_disk:
             audio, sampling_rate = load_wav_to_torch(filename)
             if sampling_rate != self.stft.sampling_rate:
                 raise ValueError("{} {} SR doesn't match target {} SR".format(
@@ -85,7 +99,7 @@ class TextMelLoader(torch.utils.data.Dataset):
         return text_norm
 
     def __getitem__(self, index):
-        return self.get_mel_text_pair(self.audiopaths_and_text[index])
+        return self.get_mel_text_pair(index)
 
     def __len__(self):
         return len(self.audiopaths_and_text)
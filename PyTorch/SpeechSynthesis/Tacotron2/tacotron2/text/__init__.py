@@ -1,5 +1,11 @@
 """ from https://github.com/keithito/tacotron """
+import hashlib
+import os
 import re
+from functools import lru_cache
+
+import numpy as np
+
 from tacotron2.text import cleaners
 from tacotron2.text.symbols import symbols
 
@@ -24,7 +30,19 @@ def text_to_sequence(text, cleaner_names):
 
     Returns:
       List of integers corresponding to the symbols in the text
+
+    Results are memoized in an LRU cache keyed by the text and cleaner names.
   '''
+  return list(_cached_text_to_sequence(text, tuple(cleaner_names)))
+
+
+@lru_cache(maxsize=65536)
+def _cached_text_to_sequence(text, cleaner_names):
+  return tuple(_text_to_sequence(text, cleaner_names))
+
+
+def _text_to_sequence(text, cleaner_names):
+  '''Uncached implementation of text_to_sequence.'''
   sequence = []
 
   # Check for curly braces and treat their contents as ARPAbet:
@@ -40,6 +58,41 @@ def text_to_sequence(text, cleaner_names):
   return sequence
 
 
+def texts_to_sequences(texts, cleaner_names, cache_dir=None):
+  '''Converts a list of texts to symbol IDs, optionally cached on disk.
+
+    The cache file name is derived from the texts and cleaner names, so a
+    filelist is cleaned once and later runs only load the result.
+
+    Args:
+      texts: list of strings to convert
+      cleaner_names: names of the cleaner functions to run the text through
+      cache_dir: directory for the on-disk cache, None disables it
+
+    Returns:
+      (ids, offsets) numpy arrays, the IDs of texts[i] are ids[offsets[i]:offsets[i+1]]
+  '''
+  cache_path = None
+  if cache_dir is not None:
+    key = hashlib.sha1('\n'.join(list(cleaner_names) + ['\0'] + list(texts)).encode('utf-8'))
+    cache_path = os.path.join(cache_dir, 'text_ids_{}.npz'.format(key.hexdigest()))
+    if os.path.isfile(cache_path):
+      cached = np.load(cache_path)
+      return cached['ids'], cached['offsets']
+
+  sequences = [_text_to_sequence(text, cleaner_names) for text in texts]
+  offsets = np.zeros(len(sequences) + 1, dtype=np.int64)
+  np.cumsum([len(seq) for seq in sequences], out=offsets[1:])
+  ids = np.fromiter((i for seq in sequences for i in seq), dtype=np.int32, count=offsets[-1])
+
+  if cache_path is not None:
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = '{}.{}.tmp.npz'.format(cache_path[:-len('.npz')], os.getpid())
+    np.savez(tmp_path, ids=ids, offsets=offsets)
+    os.replace(tmp_path, cache_path)
+  return ids, offsets
+
+
 def sequence_to_text(sequence):
   '''Converts a sequence of IDs back to a string'''
   result = ''
@@ -63,7 +116,7 @@ def _clean_text(text, cleaner_names):
 
 
 def _symbols_to_sequence(symbols):
-  return [_symbol_to_id[s] for s in symbols if _should_keep_symbol(s)]
+  return [_kept_symbol_to_id[s] for s in symbols if s in _kept_symbol_to_id]
 
 
 def _arpabet_to_sequence(text):
@@ -71,4 +124,8 @@ def _arpabet_to_sequence(text):
 
 
 def _should_keep_symbol(s):
-  return s in _symbol_to_id and s is not '_' and s is not '~'
+  return s in _symbol_to_id and s != '_' and s != '~'
+
+
+# Symbols that survive _should_keep_symbol, looked up once per character:
+_kept_symbol_to_id = {s: i for s, i in _symbol_to_id.items() if _should_keep_symbol(s)}
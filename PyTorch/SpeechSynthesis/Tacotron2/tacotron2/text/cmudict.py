@@ -1,5 +1,7 @@
 """ from https://github.com/keithito/tacotron """
 
+import os
+import pickle
 import re
 
 
@@ -17,37 +19,73 @@ _valid_symbol_set = set(valid_symbols)
 
 
 class CMUDict:
-  '''Thin wrapper around CMUDict data. http://www.speech.cs.cmu.edu/cgi-bin/cmudict'''
+  '''Thin wrapper around CMUDict data. http://www.speech.cs.cmu.edu/cgi-bin/cmudict
+
+  When constructed from a path, the dictionary is only loaded on first use, from a
+  binary index written next to the dictionary file (rebuilt if the file is newer).
+  '''
   def __init__(self, file_or_path, keep_ambiguous=True):
+    self._keep_ambiguous = keep_ambiguous
+    self._entries = None
+    self._path = None
     if isinstance(file_or_path, str):
-      with open(file_or_path, encoding='latin-1') as f:
-        entries = _parse_cmudict(f)
+      self._path = file_or_path
     else:
-      entries = _parse_cmudict(file_or_path)
-    if not keep_ambiguous:
-      entries = {word: pron for word, pron in entries.items() if len(pron) == 1}
-    self._entries = entries
+      self._entries = self._filter(_parse_cmudict(file_or_path))
 
 
   def __len__(self):
-    return len(self._entries)
+    return len(self.entries)
+
+
+  @property
+  def entries(self):
+    if self._entries is None:
+      self._entries = self._filter(_load_cmudict(self._path))
+    return self._entries
 
 
   def lookup(self, word):
     '''Returns list of ARPAbet pronunciations of the given word.'''
-    return self._entries.get(word.upper())
+    return self.entries.get(word.upper())
+
+
+  def _filter(self, entries):
+    if not self._keep_ambiguous:
+      entries = {word: pron for word, pron in entries.items() if len(pron) == 1}
+    return entries
 
 
 
 _alt_re = re.compile(r'\([0-9]+\)')
 
 
+def _load_cmudict(path):
+  index_path = path + '.idx'
+  if os.path.isfile(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(path):
+    with open(index_path, 'rb') as f:
+      return pickle.load(f)
+
+  with open(path, encoding='latin-1') as f:
+    entries = _parse_cmudict(f)
+  try:
+    tmp_path = '{}.{}.tmp'.format(index_path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+      pickle.dump(entries, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, index_path)
+  except OSError:
+    pass
+  return entries
+
+
 def _parse_cmudict(file):
   cmudict = {}
   for line in file:
     if len(line) and (line[0] >= 'A' and line[0] <= 'Z' or line[0] == "'"):
       parts = line.split('  ')
-      word = re.sub(_alt_re, '', parts[0])
+      word = parts[0]
+      if '(' in word:
+        word = re.sub(_alt_re, '', word)
       pronunciation = _get_pronunciation(parts[1])
       if pronunciation:
         if word in cmudict:
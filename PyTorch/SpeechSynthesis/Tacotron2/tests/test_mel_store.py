@@ -0,0 +1,66 @@
+# *****************************************************************************
+#  Copyright (c) 2018, NVIDIA CORPORATION.  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions are met:
+#      * Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#      * Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#      * Neither the name of the NVIDIA CORPORATION nor the
+#        names of its contributors may be used to endorse or promote products
+#        derived from this software without specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+#  ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+#  WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+#  DISCLAIMED. IN NO EVENT SHALL NVIDIA CORPORATION BE LIABLE FOR ANY
+#  DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+#  (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+#  LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+#  ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+#  (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+#  SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# *****************************************************************************
+
+import os
+import tempfile
+import unittest
+
+import torch
+
+from common.mel_store import MelStore, MelStoreWriter, mel_store_key
+
+
+class TestMelStore(unittest.TestCase):
+
+    def test_round_trip(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'mels')
+            mels = [torch.rand(4, 3), torch.rand(4, 5)]
+            writer = MelStoreWriter(path, 4)
+            writer.add(mel_store_key('wavs/a.wav'), mels[0])
+            writer.add(mel_store_key('wavs/b.wav'), mels[1])
+            writer.close()
+
+            store = MelStore(path)
+            self.assertEqual(len(store), 2)
+            # mel file lists find the mels of the audio files
+            self.assertIn('mels/b.pt', store)
+            self.assertEqual(store.num_frames('mels/b.pt'), 5)
+            self.assertTrue(torch.allclose(store.get('mels/b.pt', start=1, length=2),
+                                           mels[1][:, 1:3].half().float()))
+
+    def test_duplicate_key(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            writer = MelStoreWriter(os.path.join(tmpdir, 'mels'), 4)
+            writer.add(mel_store_key('speaker1/a.wav'), torch.rand(4, 3))
+            with self.assertRaises(ValueError):
+                writer.add(mel_store_key('speaker2/a.wav'), torch.rand(4, 3))
+            writer.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
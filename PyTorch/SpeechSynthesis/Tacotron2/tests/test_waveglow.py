@@ -0,0 +1,88 @@
+# *****************************************************************************
+#  Copyright (c) 2018, NVIDIA CORPORATION.  All rights reserved.
+#
+#  Redistribution and use in source and binary forms, with or without
+#  modification, are permitted provided that the following conditions are met:
+#      * Redistributions of source code must retain the above copyright
+#        notice, this list of conditions and the following disclaimer.
+#      * Redistributions in binary form must reproduce the above copyright
+#        notice, this list of conditions and the following disclaimer in the
+#        documentation and/or other materials provided with the distribution.
+#      * Neither the name of the NVIDIA CORPORATION nor the
+#        names of its contributors may be used to endorse or promote products
+#        derived from this software without specific prior written permission.
+#
+#  THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS" AND
+#  ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+#  WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+#  DISCLAIMED. IN NO EVENT SHALL NVIDIA CORPORATION BE LIABLE FOR ANY
+#  DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+#  (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+#  LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+#  ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+#  (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+#  SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# *****************************************************************************
+
+import unittest
+
+import torch
+
+from waveglow.model import WaveGlow
+
+
+def _make_waveglow():
+    torch.manual_seed(1)
+    model = WaveGlow(n_mel_channels=4, n_flows=4, n_group=8, n_early_every=2,
+                     n_early_size=2,
+                     WN_config=dict(n_layers=3, n_channels=8, kernel_size=3))
+    # the end layers are initialized to zero, which would make the flows
+    # ignore their context
+    for wn in model.WN:
+        torch.nn.init.normal_(wn.end.weight, std=0.1)
+    return model.eval()
+
+
+def _chunked_error(model, spect, **kwargs):
+    """Max absolute difference between chunked and unchunked audio with the
+    same noise."""
+    with torch.no_grad():
+        torch.manual_seed(2)
+        audio = model.infer(spect, sigma=0.6)
+        torch.manual_seed(2)
+        chunks = list(model.infer_chunked(spect, sigma=0.6, **kwargs))
+    chunked = torch.cat(chunks, 1)
+    assert chunked.shape == audio.shape
+    return (chunked - audio).abs().max().item()
+
+
+class TestWaveGlowChunked(unittest.TestCase):
+
+    def test_receptive_field(self):
+        model = _make_waveglow()
+        # 4 flows of (1 + 2 + 4) groups, 32 groups per frame
+        self.assertEqual(model.receptive_field(), 1)
+
+    def test_default_context_matches_infer(self):
+        model = _make_waveglow()
+        spect = torch.randn(2, 4, 20)
+        self.assertLess(_chunked_error(model, spect, chunk_size=3), 1e-5)
+
+    def test_small_context_is_approximate(self):
+        # with a deeper WN the receptive field is 4 frames, (1 + ... + 16) groups per flow
+        torch.manual_seed(1)
+        model = WaveGlow(n_mel_channels=4, n_flows=4, n_group=8, n_early_every=2,
+                         n_early_size=2,
+                         WN_config=dict(n_layers=5, n_channels=8, kernel_size=3))
+        for wn in model.WN:
+            torch.nn.init.normal_(wn.end.weight, std=0.1)
+        model.eval()
+        self.assertEqual(model.receptive_field(), 4)
+        spect = torch.randn(1, 4, 20)
+        self.assertLess(_chunked_error(model, spect, chunk_size=5), 1e-5)
+        self.assertGreater(_chunked_error(model, spect, chunk_size=5, context=0), 1e-3)
+
+
+if __name__ == '__main__':
+    unittest.main()
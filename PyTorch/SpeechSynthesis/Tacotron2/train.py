@@ -126,6 +126,10 @@ def parse_args(parser):
     dataset.add_argument('--text-cleaners', nargs='*',
                          default=['english_cleaners'], type=str,
                          help='Type of text cleaners for input text')
+    dataset.add_argument('--mel-store', type=str, default=None,
+                         help='Reads mel spectrograms from a store written by preprocess_audio2mel.py --mel-store')
+    dataset.add_argument('--text-cache-dir', type=str, default=None,
+                         help='Directory for caching the symbol ids of cleaned transcripts')
 
     # audio parameters
     audio = parser.add_argument_group('audio parameters')
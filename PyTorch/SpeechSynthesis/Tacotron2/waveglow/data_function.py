@@ -25,9 +25,11 @@
 #
 # *****************************************************************************\
 
+import math
 import torch
 import random
 import common.layers as layers
+from common.mel_store import MelStore
 from common.utils import load_wav_to_torch, load_filepaths_and_text, to_gpu
 
 
@@ -46,6 +48,10 @@ class MelAudioLoader(torch.utils.data.Dataset):
             args.n_mel_channels, args.sampling_rate, args.mel_fmin,
             args.mel_fmax)
         self.segment_length = args.segment_length
+        self.hop_length = args.hop_length
+        self.mel_store = None
+        if getattr(args, 'mel_store', None) is not None:
+            self.mel_store = MelStore(args.mel_store)
         random.seed(1234)
         random.shuffle(self.audiopaths_and_text)
 
@@ -56,6 +62,9 @@ class MelAudioLoader(torch.utils.data.Dataset):
             raise ValueError("{} {} SR doesn't match target {} SR".format(
                 sampling_rate, self.stft.sampling_rate))
 
+        if self.mel_store is not None:
+            return self.get_stored_mel_audio_pair(filename, audio)
+
         # Take segment
         if audio.size(0) >= self.segment_length:
             max_audio_start = audio.size(0) - self.segment_length
@@ -73,6 +82,31 @@ class MelAudioLoader(torch.utils.data.Dataset):
 
         return (melspec, audio, len(audio))
 
+    def get_stored_mel_audio_pair(self, filename, audio):
+        # Take a hop-aligned segment, so that its mel frames can be sliced
+        # out of the precomputed mel of the whole utterance
+        n_frames = self.segment_length // self.hop_length + 1
+        if audio.size(0) >= self.segment_length:
+            max_frame_start = (audio.size(0) - self.segment_length) // self.hop_length
+            frame_start = random.randint(0, max_frame_start)
+            audio_start = frame_start * self.hop_length
+            audio = audio[audio_start:audio_start+self.segment_length]
+        else:
+            frame_start = 0
+            audio = torch.nn.functional.pad(
+                audio, (0, self.segment_length - audio.size(0)), 'constant').data
+
+        melspec = self.mel_store.get(filename, frame_start, n_frames)
+        if melspec.size(1) < n_frames:
+            # frames of silence, as dynamic_range_compression clips at 1e-5
+            melspec = torch.nn.functional.pad(
+                melspec, (0, n_frames - melspec.size(1)), 'constant',
+                math.log(1e-5))
+
+        audio = audio / self.max_wav_value
+
+        return (melspec, audio, len(audio))
+
     def __getitem__(self, index):
         return self.get_mel_audio_pair(self.audiopaths_and_text[index][0])
 
@@ -65,3 +65,36 @@ class Denoiser(torch.nn.Module):
         audio_spec_denoised = torch.clamp(audio_spec_denoised, 0.0)
         audio_denoised = self.stft.inverse(audio_spec_denoised, audio_angles)
         return audio_denoised
+
+    def denoise_chunked(self, chunks, strength=0.1):
+        """
+        Streaming counterpart of forward() for WaveGlow.infer_chunked().
+
+        Audio is held back by filter_length samples, so that every emitted
+        sample is denoised with full STFT context on both sides, and the
+        processed windows start on hop boundaries of the whole utterance.
+        """
+        context = self.stft.filter_length
+        hop = self.stft.hop_length
+        history = None
+        pending = None
+
+        for chunk in chunks:
+            chunk = chunk.cuda().float()
+            pending = chunk if pending is None else torch.cat([pending, chunk], 1)
+            ready = (pending.size(1) - context) // hop * hop
+            if ready <= 0:
+                continue
+
+            left = 0 if history is None else history.size(1)
+            audio = pending if history is None else torch.cat([history, pending], 1)
+            denoised = self(audio, strength)[:, 0]
+            yield denoised[:, left:left + ready]
+
+            history = audio[:, max(0, left + ready - context):left + ready]
+            pending = pending[:, ready:]
+
+        if pending is not None:
+            left = 0 if history is None else history.size(1)
+            audio = pending if history is None else torch.cat([history, pending], 1)
+            yield self(audio, strength)[:, 0, left:]
@@ -233,6 +233,100 @@ class WaveGlow(torch.nn.Module):
         return torch.cat(output_audio, 1), log_s_list, log_det_W_list
 
     def infer(self, spect, sigma=1.0):
+        spect = self._upsample_and_group(spect)
+
+        z = self._sample_noise(spect.size(0), spect.size(2), sigma,
+                               spect.device, spect.dtype)
+        z = torch.autograd.Variable(z)
+
+        audio = self._infer_from_noise(spect, z)
+        audio = audio.permute(
+            0, 2, 1).contiguous().view(
+            audio.size(0), -1).data
+        return audio
+
+    def receptive_field(self):
+        """
+        Mel frames on each side of a frame which the audio of that frame
+        depends on through the WN layers of all flows.
+        """
+        groups = sum((layer.kernel_size[0] - 1) // 2 * layer.dilation[0]
+                     for wn in self.WN for layer in wn.in_layers)
+        groups_per_frame = self.upsample.stride[0] // self.n_group
+        return -(-groups // groups_per_frame)
+
+    def infer_chunked(self, spect, sigma=1.0, chunk_size=32, context=None,
+                      overlap=256):
+        """
+        Generator version of infer() for streaming synthesis.
+
+        The mel is vocoded in windows of chunk_size frames, each extended by
+        context frames on both sides, plus the upsampling kernel overlap on
+        the left and the crossfaded overlap on the right. The noise is sampled
+        once for the whole utterance, so the windows see the same latent in
+        their shared regions; the first overlap samples of every chunk are
+        crossfaded with the samples which follow the previous one.
+
+        By default the context is the receptive field of the model, and the
+        audio is the same as infer(spect) with the same seed, up to floating
+        point error. A smaller context makes every chunk cheaper (with the
+        default model the receptive field is about 96 frames), but the audio
+        is then only an approximation of infer(spect) close to the chunk
+        boundaries, which the crossfade smooths out.
+
+        Yields audio tensors of shape batch x samples whose concatenation has
+        the same length as infer(spect).
+        """
+        hop = self.upsample.stride[0]
+        groups_per_frame = hop // self.n_group
+        n_frames = spect.size(2)
+        if context is None:
+            context = self.receptive_field()
+        left_context = context + self.upsample.kernel_size[0] // hop - 1
+        right_context = context + -(-overlap // hop)
+
+        z = self._sample_noise(spect.size(0), n_frames * groups_per_frame,
+                               sigma, spect.device, spect.dtype)
+        fade_in = torch.linspace(0, 1, overlap + 2, device=spect.device,
+                                 dtype=spect.dtype)[1:-1].unsqueeze(0)
+        tail = None
+
+        for start in range(0, n_frames, chunk_size):
+            end = min(start + chunk_size, n_frames)
+            win_start = max(0, start - left_context)
+            win_end = min(n_frames, end + right_context)
+
+            window = self._upsample_and_group(spect[:, :, win_start:win_end])
+            audio = self._infer_from_noise(
+                window,
+                z[:, :, win_start * groups_per_frame:win_end * groups_per_frame])
+            audio = audio.permute(0, 2, 1).contiguous().view(audio.size(0), -1)
+
+            offset = (start - win_start) * hop
+            length = (end - start) * hop
+            chunk = audio[:, offset:offset + length]
+
+            if tail is not None:
+                n = tail.size(1)
+                chunk = chunk.clone()
+                chunk[:, :n] = (tail * (1 - fade_in[:, :n]) +
+                                chunk[:, :n] * fade_in[:, :n])
+            tail = audio[:, offset + length:offset + length + overlap]
+
+            yield chunk.data
+
+    def _sample_noise(self, batch_size, n_groups, sigma, device, dtype):
+        # draw the early outputs' noise in the order the reverse flows
+        # consume it, so sampling matches the original interleaved draws
+        noise = [torch.randn(batch_size, self.n_remaining_channels, n_groups,
+                             device=device).to(dtype)]
+        for k in reversed(range(self.n_flows)):
+            if k % self.n_early_every == 0 and k > 0:
+                noise.append(torch.randn(batch_size, self.n_early_size,
+                                         n_groups, device=device).to(dtype))
+        return sigma * torch.cat(noise, 1)
+
+    def _upsample_and_group(self, spect):
         spect = self.upsample(spect)
         # trim conv artifacts. maybe pad spec to kernel multiple
         time_cutoff = self.upsample.kernel_size[0] - self.upsample.stride[0]
@@ -241,12 +335,11 @@ class WaveGlow(torch.nn.Module):
         spect = spect.unfold(2, self.n_group, self.n_group).permute(0, 2, 1, 3)
         spect = spect.contiguous().view(spect.size(0), spect.size(1), -1)
         spect = spect.permute(0, 2, 1)
+        return spect
 
-        audio = torch.randn(spect.size(0),
-                            self.n_remaining_channels,
-                            spect.size(2), device=spect.device).to(spect.dtype)
-
-        audio = torch.autograd.Variable(sigma * audio)
+    def _infer_from_noise(self, spect, z):
+        audio = z[:, :self.n_remaining_channels, :]
+        z_offset = self.n_remaining_channels
 
         for k in reversed(range(self.n_flows)):
             n_half = int(audio.size(1) / 2)
@@ -262,13 +355,10 @@ class WaveGlow(torch.nn.Module):
             audio = self.convinv[k](audio, reverse=True)
 
             if k % self.n_early_every == 0 and k > 0:
-                z = torch.randn(spect.size(0), self.n_early_size, spect.size(
-                    2), device=spect.device).to(spect.dtype)
-                audio = torch.cat((sigma * z, audio), 1)
+                early = z[:, z_offset:z_offset + self.n_early_size, :]
+                z_offset += self.n_early_size
+                audio = torch.cat((early, audio), 1)
 
-        audio = audio.permute(
-            0, 2, 1).contiguous().view(
-            audio.size(0), -1).data
         return audio
 
     @staticmethod
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+import argparse
+import logging
+import os
+
+import torch
+
+from seq2seq.data.tokenizer import Tokenizer
+from seq2seq.inference.shortlist import Shortlist
+
+
+def parse_args():
+    """
+    Parse commandline arguments.
+    """
+    parser = argparse.ArgumentParser(
+        description='GNMT vocabulary shortlist builder',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+
+    parser.add_argument('-m', '--model', required=True,
+                        help='full path to the model checkpoint file (the \
+                        vocabulary is taken from its tokenizer)')
+    parser.add_argument('--dataset-dir', default='data/wmt16_de_en',
+                        help='path to the directory with training data')
+    parser.add_argument('--train-src',
+                        default='train.tok.clean.bpe.32000.en',
+                        help='path to the training source data file \
+                        (relative to DATASET_DIR directory)')
+    parser.add_argument('--train-tgt',
+                        default='train.tok.clean.bpe.32000.de',
+                        help='path to the training target data file \
+                        (relative to DATASET_DIR directory)')
+    parser.add_argument('--topk', default=50, type=int,
+                        help='number of translations kept per source token')
+    parser.add_argument('--num-frequent', default=2000, type=int,
+                        help='number of most frequent target tokens which \
+                        are always in the shortlist')
+    parser.add_argument('--max-pairs', default=50000000, type=int,
+                        help='max number of distinct token pairs counted in \
+                        memory')
+    parser.add_argument('-o', '--output', required=True,
+                        help='full path to the output shortlist file')
+    return parser.parse_args()
+
+
+def read_sentences(fname, tokenizer):
+    with open(fname) as f:
+        for line in f:
+            yield tokenizer.segment(line)
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.INFO,
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    logging.info(f'Run arguments: {args}')
+
+    checkpoint = torch.load(args.model, map_location={'cuda:0': 'cpu'})
+    tokenizer = Tokenizer()
+    tokenizer.set_state(checkpoint['tokenizer'])
+
+    src_fname = os.path.join(args.dataset_dir, args.train_src)
+    tgt_fname = os.path.join(args.dataset_dir, args.train_tgt)
+    shortlist = Shortlist.build(read_sentences(src_fname, tokenizer),
+                                read_sentences(tgt_fname, tokenizer),
+                                tokenizer.vocab_size,
+                                topk=args.topk,
+                                num_frequent=args.num_frequent,
+                                max_pairs=args.max_pairs)
+    shortlist.save(args.output)
+    logging.info(f'Saved shortlist with {args.topk} translations per token '
+                 f'and {shortlist.frequent.numel()} frequent tokens to '
+                 f'{args.output}')
+
+
+if __name__ == '__main__':
+    main()
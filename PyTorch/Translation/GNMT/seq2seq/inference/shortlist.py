@@ -0,0 +1,135 @@
+import logging
+
+import numpy as np
+import torch
+
+import seq2seq.data.config as config
+
+
+class Shortlist:
+    """
+    Candidate target vocabulary for a batch of source sentences.
+
+    The candidates are the union of the lexical translations of all source
+    tokens in the batch, the most frequent target tokens and the special
+    tokens. Candidates are sorted, so the special tokens (the first entries of
+    the vocabulary) keep their indices within the shortlist.
+    """
+    nspecial = config.EOS + 1
+
+    def __init__(self, table, frequent, vocab_size):
+        """
+        Constructor for the Shortlist.
+
+        :param table: tensor (vocab_size, k) with the k most likely
+            translations of every source token
+        :param frequent: tensor with the most frequent target tokens
+        :param vocab_size: size of the vocabulary
+        """
+        self.table = table
+        self.frequent = frequent
+        self.vocab_size = vocab_size
+
+    @classmethod
+    def load(cls, path):
+        state = torch.load(path)
+        return cls(state['table'], state['frequent'], state['vocab_size'])
+
+    def save(self, path):
+        torch.save({'table': self.table,
+                    'frequent': self.frequent,
+                    'vocab_size': self.vocab_size}, path)
+
+    def to(self, device):
+        self.table = self.table.to(device)
+        self.frequent = self.frequent.to(device)
+        return self
+
+    def candidates(self, src):
+        """
+        Returns sorted indices of the target tokens allowed for a batch.
+
+        :param src: tensor with source tokens of the batch
+        """
+        mask = torch.zeros(self.vocab_size, dtype=torch.uint8,
+                           device=src.device)
+        mask[:self.nspecial] = 1
+        mask[self.frequent] = 1
+        mask[self.table.index_select(0, src.view(-1)).view(-1)] = 1
+        return mask.nonzero().squeeze(-1)
+
+    @classmethod
+    def build(cls, src_sents, tgt_sents, vocab_size, topk=50,
+              num_frequent=2000, max_pairs=50000000, chunk_size=100000):
+        """
+        Builds a shortlist from a sentence aligned bitext.
+
+        Source and target tokens are paired by sentence co-occurrence and the
+        pairs are scored with the Dice coefficient. Whenever there are more
+        than max_pairs distinct pairs, only the max_pairs / 2 most frequent
+        ones are kept.
+
+        :param src_sents: iterable with lists of source token indices
+        :param tgt_sents: iterable with lists of target token indices
+        :param vocab_size: size of the (shared) vocabulary
+        :param topk: number of translations kept per source token
+        :param num_frequent: number of most frequent target tokens which are
+            always in the shortlist
+        :param max_pairs: max number of distinct pairs kept in memory
+        :param chunk_size: number of sentences counted between merges
+        """
+        src_df = np.zeros(vocab_size, dtype=np.int64)
+        tgt_df = np.zeros(vocab_size, dtype=np.int64)
+        tgt_count = np.zeros(vocab_size, dtype=np.int64)
+        pair_keys = np.zeros(0, dtype=np.int64)
+        pair_counts = np.zeros(0, dtype=np.int64)
+
+        def merge(chunk):
+            nonlocal pair_keys, pair_counts
+            keys, inverse = np.unique(np.concatenate([pair_keys] + chunk),
+                                      return_inverse=True)
+            weights = np.ones(len(inverse), dtype=np.int64)
+            weights[:len(pair_counts)] = pair_counts
+            counts = np.bincount(inverse, weights=weights).astype(np.int64)
+            if len(keys) > max_pairs:
+                keep = np.argpartition(-counts, max_pairs // 2)
+                keep = np.sort(keep[:max_pairs // 2])
+                keys, counts = keys[keep], counts[keep]
+            pair_keys, pair_counts = keys, counts
+
+        chunk = []
+        for idx, (src, tgt) in enumerate(zip(src_sents, tgt_sents)):
+            if idx % 1000000 == 0:
+                logging.info(f'Processed {idx} sentence pairs')
+            src = np.asarray(src, dtype=np.int64)
+            tgt = np.asarray(tgt, dtype=np.int64)
+            np.add.at(tgt_count, tgt, 1)
+            src = np.unique(src[src >= cls.nspecial])
+            tgt = np.unique(tgt[tgt >= cls.nspecial])
+            src_df[src] += 1
+            tgt_df[tgt] += 1
+            chunk.append((src[:, None] * vocab_size + tgt[None, :]).ravel())
+            if len(chunk) == chunk_size:
+                merge(chunk)
+                chunk = []
+        if chunk:
+            merge(chunk)
+
+        src_ids = pair_keys // vocab_size
+        tgt_ids = pair_keys % vocab_size
+        dice = 2. * pair_counts / (src_df[src_ids] + tgt_df[tgt_ids])
+
+        # topk best translations of every source token
+        order = np.lexsort((-dice, src_ids))
+        src_ids, tgt_ids = src_ids[order], tgt_ids[order]
+        rank = np.arange(len(src_ids)) - np.searchsorted(src_ids, src_ids)
+        keep = rank < topk
+        table = np.full((vocab_size, topk), config.PAD, dtype=np.int64)
+        table[src_ids[keep], rank[keep]] = tgt_ids[keep]
+
+        tgt_count[:cls.nspecial] = 0
+        frequent = np.argsort(-tgt_count, kind='mergesort')[:num_frequent]
+        frequent = frequent[tgt_count[frequent] > 0]
+
+        return cls(torch.from_numpy(table), torch.from_numpy(frequent),
+                   vocab_size)
@@ -1,5 +1,7 @@
 import logging
+import queue
 import subprocess
+import threading
 import time
 
 import torch
@@ -7,9 +9,13 @@ import torch.distributed as dist
 
 import seq2seq.data.config as config
 import seq2seq.utils as utils
+from seq2seq.data.dataset import build_collate_fn
 from seq2seq.inference.beam_search import SequenceGenerator
 
 
+_STOP = object()
+
+
 def gather_predictions(preds):
     world_size = utils.get_world_size()
     if world_size > 1:
@@ -51,6 +57,7 @@ class Translator:
                  max_seq_len=50,
                  print_freq=1,
                  reference=None,
+                 shortlist=None,
                  ):
 
         self.model = model
@@ -63,6 +70,7 @@ class Translator:
         self.beam_size = beam_size
         self.print_freq = print_freq
         self.reference = reference
+        self.shortlist = shortlist
 
         self.distributed = (utils.get_world_size() > 1)
 
@@ -74,6 +82,21 @@ class Translator:
             len_norm_const=len_norm_const,
             cov_penalty_factor=cov_penalty_factor)
 
+    def set_shortlist(self, src):
+        """
+        Restricts the output vocabulary of the model to the shortlist
+        candidates of the given source batch (no-op without a shortlist).
+
+        :param src: source batch, None restores the full vocabulary
+        """
+        if self.shortlist is None:
+            return
+        if src is None:
+            self.model.decoder.classifier.set_shortlist(None)
+        else:
+            candidates = self.shortlist.to(src.device).candidates(src)
+            self.model.decoder.classifier.set_shortlist(candidates)
+
     def run(self, calc_bleu=True, epoch=None, iteration=None, eval_path=None,
             summary=False, warmup=0, reference_path=None):
         """
@@ -171,7 +194,9 @@ class Translator:
             with torch.no_grad():
                 context = self.model.encode(src, src_length)
                 context = [context, src_length, None]
+                self.set_shortlist(src)
                 preds, lengths, counter = generator(batch_size, bos, context)
+                self.set_shortlist(None)
 
             stats['total_dec_len'] = lengths.sum().item()
             stats['iters'] = counter
@@ -236,3 +261,100 @@ class Translator:
         eval_stats['throughputs'] = tot_tok_per_sec.vals
 
         return output, eval_stats
+
+    def translate_stream(self, lines, batch_size, queue_size=4):
+        """
+        Translates an iterable of raw text lines, yields translations in the
+        order of the input lines.
+
+        Tokenization (Moses + BPE), beam search and detokenization run in
+        separate threads connected by bounded queues, so the GPU does not wait
+        for Python text processing of the neighbouring batches.
+
+        :param lines: iterable of raw text lines
+        :param batch_size: max number of sentences per beam search call
+        :param queue_size: max number of batches buffered between stages
+        """
+        device = next(self.model.parameters()).device
+        collate_fn = build_collate_fn(self.batch_first, parallel=False,
+                                      sort=True)
+        if self.beam_size == 1:
+            generator = self.generator.greedy_search
+        else:
+            generator = self.generator.beam_search
+
+        src_queue = queue.Queue(queue_size)
+        pred_queue = queue.Queue(queue_size)
+        out_queue = queue.Queue(queue_size * batch_size)
+        errors = []
+
+        def stage(target, out):
+            def run():
+                try:
+                    target()
+                except Exception as e:
+                    errors.append(e)
+                finally:
+                    out.put(_STOP)
+            thread = threading.Thread(target=run, daemon=True)
+            thread.start()
+            return thread
+
+        def tokenize():
+            batch = []
+            for idx, line in enumerate(lines):
+                batch.append((idx, self.tokenizer.tokenize(line)))
+                if len(batch) == batch_size:
+                    src_queue.put(batch)
+                    batch = []
+            if batch:
+                src_queue.put(batch)
+
+        def translate():
+            for batch in iter(src_queue.get, _STOP):
+                line_ids, seqs = zip(*batch)
+                (src, src_length), indices = collate_fn(seqs)
+                src = src.to(device)
+                src_length = src_length.to(device)
+                n = len(seqs)
+
+                bos = [self.insert_target_start] * (n * self.beam_size)
+                bos = torch.tensor(bos, dtype=torch.int64, device=device)
+                if self.batch_first:
+                    bos = bos.view(-1, 1)
+                else:
+                    bos = bos.view(1, -1)
+
+                with torch.no_grad():
+                    context = self.model.encode(src, src_length)
+                    context = [context, src_length, None]
+                    self.set_shortlist(src)
+                    preds, _, _ = generator(n, bos, context)
+                    self.set_shortlist(None)
+
+                indices = torch.tensor(indices).to(preds)
+                preds = preds.scatter(0, indices.unsqueeze(1).expand_as(preds),
+                                      preds)
+                pred_queue.put((line_ids, preds.cpu()))
+
+        def detokenize():
+            for line_ids, preds in iter(pred_queue.get, _STOP):
+                for idx, pred in zip(line_ids, preds):
+                    out_queue.put((idx, self.tokenizer.detokenize(pred.tolist())))
+
+        self.model.eval()
+        stage(tokenize, src_queue)
+        stage(translate, pred_queue)
+        stage(detokenize, out_queue)
+
+        # restore input order
+        pending = {}
+        next_idx = 0
+        for idx, output in iter(out_queue.get, _STOP):
+            pending[idx] = output
+            while next_idx in pending:
+                yield pending.pop(next_idx)
+                next_idx += 1
+
+        if errors:
+            raise errors[0]
@@ -2,6 +2,7 @@ import itertools
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 import seq2seq.data.config as config
 from seq2seq.models.attention import BahdanauAttention
@@ -78,6 +79,22 @@ class Classifier(nn.Module):
         self.classifier = nn.Linear(in_features, out_features)
         nn.init.uniform_(self.classifier.weight.data, -init_weight, init_weight)
         nn.init.uniform_(self.classifier.bias.data, -init_weight, init_weight)
+        self.shortlist = None
+
+    def set_shortlist(self, shortlist):
+        """
+        Restricts outputs to the given vocabulary entries (for inference).
+
+        :param shortlist: sorted tensor with vocabulary indices, None restores
+            the full vocabulary
+        """
+        self.shortlist = shortlist
+        if shortlist is None:
+            self.shortlist_weight = None
+            self.shortlist_bias = None
+        else:
+            self.shortlist_weight = self.classifier.weight.index_select(0, shortlist)
+            self.shortlist_bias = self.classifier.bias.index_select(0, shortlist)
 
     def forward(self, x):
         """
@@ -85,6 +102,8 @@ class Classifier(nn.Module):
 
         :param x: output from decoder
         """
+        if self.shortlist is not None:
+            return F.linear(x, self.shortlist_weight, self.shortlist_bias)
         out = self.classifier(x)
         return out
 
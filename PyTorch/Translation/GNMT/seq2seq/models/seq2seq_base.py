@@ -61,4 +61,8 @@ class Seq2Seq(nn.Module):
         logits, scores, new_context = self.decode(inputs, context, True)
         logprobs = log_softmax(logits, dim=-1)
         logprobs, words = logprobs.topk(beam_size, dim=-1)
+        shortlist = self.decoder.classifier.shortlist
+        if shortlist is not None:
+            # logits cover only the shortlisted part of the vocabulary
+            words = shortlist[words]
         return words, logprobs, scores, new_context
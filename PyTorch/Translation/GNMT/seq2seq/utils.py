@@ -162,13 +162,15 @@ def timer(name, ndigits=2, sync_gpu=True):
     logging.info(f'TIMER {name} {elapsed}')
 
 
-def setup_logging(log_all_ranks=True, log_file=os.devnull):
+def setup_logging(log_all_ranks=True, log_file=os.devnull, console=None):
     """
     Configures logging.
     By default logs from all workers are printed to the console, entries are
     prefixed with "N: " where N is the rank of the worker. Logs printed to the
     console don't include timestaps.
     Full logs with timestamps are saved to the log_file file.
+
+    :param console: stream for console logs, defaults to sys.stdout
     """
     class RankFilter(logging.Filter):
         def __init__(self, rank, log_all_ranks):
@@ -191,7 +193,9 @@ def setup_logging(log_all_ranks=True, log_file=os.devnull):
                         datefmt="%Y-%m-%d %H:%M:%S",
                         filename=log_file,
                         filemode='w')
-    console = logging.StreamHandler(sys.stdout)
+    if console is None:
+        console = sys.stdout
+    console = logging.StreamHandler(console)
     console.setLevel(logging.INFO)
     formatter = logging.Formatter('%(rank)s: %(message)s')
     console.setFormatter(formatter)
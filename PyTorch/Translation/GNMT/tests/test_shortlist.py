@@ -0,0 +1,63 @@
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+import seq2seq.data.config as config
+from seq2seq.inference.shortlist import Shortlist
+
+
+class TestShortlist(unittest.TestCase):
+
+    def setUp(self):
+        # source token i + 4 is always translated as target token i + 10,
+        # target token 9 appears in every sentence
+        rng = np.random.RandomState(0)
+        self.src_sents, self.tgt_sents = [], []
+        for _ in range(200):
+            words = rng.choice(6, size=3, replace=False)
+            self.src_sents.append(np.concatenate([words + 4, [config.EOS]]))
+            self.tgt_sents.append(np.concatenate([[config.BOS], words + 10,
+                                                  [9, config.EOS]]))
+
+    def build(self, **kwargs):
+        return Shortlist.build(self.src_sents, self.tgt_sents, vocab_size=16,
+                               **kwargs)
+
+    def test_build(self):
+        shortlist = self.build(topk=1, num_frequent=1, chunk_size=7)
+        self.assertEqual(shortlist.table[4:10].view(-1).tolist(),
+                         list(range(10, 16)))
+        # tokens which never appear in the source have no translations
+        self.assertEqual(shortlist.table[10:].view(-1).tolist(),
+                         [config.PAD] * 6)
+        self.assertEqual(shortlist.frequent.tolist(), [9])
+
+    def test_build_with_pruning(self):
+        # 42 distinct pairs, only the most frequent ones are kept
+        shortlist = self.build(topk=1, num_frequent=1, chunk_size=7,
+                               max_pairs=40)
+        self.assertEqual(shortlist.table[4:10].view(-1).tolist(),
+                         list(range(10, 16)))
+
+    def test_candidates(self):
+        shortlist = self.build(topk=1, num_frequent=1)
+        src = torch.LongTensor([[2, 4, 6, 3], [5, 4, 4, 3]])
+        self.assertEqual(shortlist.candidates(src).tolist(),
+                         [0, 1, 2, 3, 9, 10, 11, 12])
+
+    def test_save_load(self):
+        shortlist = self.build(topk=2, num_frequent=1)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'shortlist.pt')
+            shortlist.save(path)
+            loaded = Shortlist.load(path)
+        self.assertTrue(torch.equal(shortlist.table, loaded.table))
+        self.assertTrue(torch.equal(shortlist.frequent, loaded.frequent))
+        self.assertEqual(loaded.vocab_size, 16)
+
+
+if __name__ == '__main__':
+    unittest.main()
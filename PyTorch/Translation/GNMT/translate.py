@@ -3,6 +3,7 @@ import argparse
 import logging
 import itertools
 import sys
+import time
 import warnings
 from itertools import product
 
@@ -11,6 +12,7 @@ import torch
 import seq2seq.utils as utils
 from seq2seq.data.dataset import RawTextDataset
 from seq2seq.data.tokenizer import Tokenizer
+from seq2seq.inference.shortlist import Shortlist
 from seq2seq.inference.translator import Translator
 from seq2seq.models.gnmt import GNMT
 from seq2seq.inference import tables
@@ -45,7 +47,7 @@ def parse_args():
     dataset.add_argument('-m', '--model', required=True,
                          help='full path to the model checkpoint file')
 
-    source = dataset.add_mutually_exclusive_group(required=True)
+    source = dataset.add_mutually_exclusive_group(required=False)
     source.add_argument('-i', '--input', required=False,
                         help='full path to the input file (raw text)')
     source.add_argument('-t', '--input-text', nargs='+', required=False,
@@ -53,6 +55,11 @@ def parse_args():
 
     exclusive_group(group=dataset, name='sort', default=False,
                     help='sorts dataset by sequence length')
+    exclusive_group(group=dataset, name='stream', default=False,
+                    help='translates line by line from the input (stdin if \
+                    no input is specified) to the output (stdout if no \
+                    output is specified), tokenization, beam search and \
+                    detokenization run in a pipeline')
 
     # parameters
     params = parser.add_argument_group('inference setup')
@@ -68,6 +75,15 @@ def parse_args():
                         help='coverage penalty factor')
     params.add_argument('--len-norm-const', default=5.0, type=float,
                         help='length normalization constant')
+    params.add_argument('--shortlist', default=None, type=str,
+                        help='full path to the vocabulary shortlist (built \
+                        with build_shortlist.py), restricts the output \
+                        vocabulary of every batch to the lexical \
+                        translations of its source tokens and the most \
+                        frequent target tokens')
+    params.add_argument('--queue-size', default=4, type=int,
+                        help='number of batches buffered between the stages \
+                        of the --stream pipeline')
     # general setup
     general = parser.add_argument_group('general setup')
     general.add_argument('--math', nargs='+', default=['fp16'],
@@ -128,9 +144,18 @@ def parse_args():
 
     args = parser.parse_args()
 
-    if args.input_text:
+    if not args.stream and not (args.input or args.input_text):
+        parser.error('one of the arguments -i/--input -t/--input-text is '
+                     'required')
+
+    if args.input_text or args.stream:
         args.bleu = False
 
+    if args.stream:
+        if len(list(product(args.math, args.batch_size, args.beam_size))) > 1:
+            parser.error('--stream supports a single --math, --batch-size and '
+                         '--beam-size')
+
     if args.bleu and args.reference is None:
         parser.error('--bleu requires --reference')
 
@@ -158,7 +183,8 @@ def main():
     device = utils.set_device(args.cuda, args.local_rank)
     utils.init_distributed(args.cuda)
     args.rank = utils.get_rank()
-    utils.setup_logging()
+    # translations go to stdout in the streaming mode
+    utils.setup_logging(console=sys.stderr if args.stream else None)
 
     if args.env:
         utils.log_env_info()
@@ -182,6 +208,11 @@ def main():
     model = GNMT(**model_config)
     model.load_state_dict(checkpoint['state_dict'])
 
+    shortlist = Shortlist.load(args.shortlist) if args.shortlist else None
+
+    if args.stream:
+        return stream(args, model, tokenizer, device, shortlist)
+
     # construct the dataset
     if args.input:
         data = RawTextDataset(raw_datafile=args.input,
@@ -229,6 +260,7 @@ def main():
             len_norm_const=args.len_norm_const,
             cov_penalty_factor=args.cov_penalty_factor,
             print_freq=args.print_freq,
+            shortlist=shortlist,
             )
 
         # execute the inference
@@ -276,6 +308,49 @@ def main():
     return passed
 
 
+def stream(args, model, tokenizer, device, shortlist=None):
+    """
+    Translates the input line by line in the streaming mode, writes
+    translations in the input order as soon as they are ready.
+    """
+    dtype = {'fp32': torch.FloatTensor, 'fp16': torch.HalfTensor}
+    model.type(dtype[args.math[0]])
+    model = model.to(device)
+    model.eval()
+
+    translator = Translator(
+        model=model,
+        tokenizer=tokenizer,
+        beam_size=args.beam_size[0],
+        max_seq_len=args.max_seq_len,
+        len_norm_factor=args.len_norm_factor,
+        len_norm_const=args.len_norm_const,
+        cov_penalty_factor=args.cov_penalty_factor,
+        shortlist=shortlist,
+        )
+
+    infile = open(args.input) if args.input else sys.stdin
+    outfile = open(args.output, 'w') if args.output else sys.stdout
+
+    start = time.time()
+    lines = 0
+    for output in translator.translate_stream(infile, args.batch_size[0],
+                                              args.queue_size):
+        outfile.write(output + '\n')
+        outfile.flush()
+        lines += 1
+    elapsed = time.time() - start
+
+    if args.input:
+        infile.close()
+    if args.output:
+        outfile.close()
+
+    logging.info(f'Lines translated: {lines}\t'
+                 f'Sentences/s: {lines / max(elapsed, 1e-9):.1f}')
+    return True
+
+
 if __name__ == '__main__':
     passed = main()
     if not passed:
@@ -21,14 +21,186 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import math
+
 import numpy as np
 import torch
 
 from fairseq import data, options, progress_bar, tasks, utils
 from fairseq.meters import StopwatchMeter, TimeMeter
+from fairseq.models import FairseqIncrementalDecoder
 from fairseq.sequence_scorer import SequenceScorer
 
 
+def get_token_stream(dataset):
+    """Concatenate the targets of a :class:`MonolingualDataset` into a single
+    stream of tokens.
+
+    Returns the stream, preceded by the source token of the first block, and
+    the number of targets of every block.
+    """
+    targets = [dataset[i]['target'] for i in range(len(dataset))]
+    stream = torch.cat([dataset[0]['source'][:1]] + targets)
+    return stream, np.array([len(t) for t in targets], dtype=np.int64)
+
+
+def sliding_windows(num_tokens, window, stride):
+    """Return the (start, end, score_start) offsets of overlapping windows of
+    *window* tokens, *stride* tokens apart.
+
+    The first window scores all its tokens, the others only score the tokens
+    after the end of the previous window, so that every token is scored once
+    with at least ``window - stride`` tokens of context.
+    """
+    if num_tokens <= window:
+        ends = np.array([num_tokens], dtype=np.int64)
+    else:
+        ends = np.minimum(np.arange(window, num_tokens + stride, stride, dtype=np.int64), num_tokens)
+    starts = np.maximum(ends - window, 0)
+    score_starts = np.concatenate([[0], ends[:-1]])
+    return starts, ends, score_starts
+
+
+def make_batches(lengths, max_tokens, max_sentences):
+    """Group indices of items sorted by decreasing length into batches of at
+    most *max_tokens* (padded) tokens and *max_sentences* items."""
+    max_sentences = max_sentences or len(lengths)
+    batches = []
+    batch = []
+    for idx in np.argsort(-lengths, kind='mergesort'):
+        if batch and (len(batch) == max_sentences or (len(batch) + 1) * lengths[batch[0]] > max_tokens):
+            batches.append(batch)
+            batch = []
+        batch.append(idx)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def supports_incremental_eval(model):
+    """Whether the model can score a stream one token at a time. The decoder
+    state can only be carried over indefinitely by incremental decoders
+    without positional embeddings."""
+    decoder = getattr(model, 'decoder', None)
+    return isinstance(decoder, FairseqIncrementalDecoder) and \
+        getattr(decoder, 'embed_positions', None) is None
+
+
+def score_windows(args, scorer, stream, pad, use_cuda, timer):
+    """Score a token stream with overlapping windows of tokens_per_sample
+    tokens, batched by window length."""
+    num_tokens = len(stream) - 1
+    starts, ends, score_starts = sliding_windows(num_tokens, args.tokens_per_sample, args.stride)
+    batches = make_batches(ends - starts, args.max_tokens or 36000, args.max_sentences)
+    print('| scoring {} tokens with {} windows in {} batches'.format(num_tokens, len(starts), len(batches)))
+
+    pos_scores = torch.zeros(num_tokens)
+    with progress_bar.build_progress_bar(args, batches) as t:
+        wps_meter = TimeMeter()
+        for batch in t:
+            src_tokens = stream.new_full((len(batch), ends[batch[0]] - starts[batch[0]]), pad)
+            target = src_tokens.clone()
+            for j, i in enumerate(batch):
+                src_tokens[j, :ends[i] - starts[i]] = stream[starts[i]:ends[i]]
+                target[j, :ends[i] - starts[i]] = stream[starts[i] + 1:ends[i] + 1]
+            sample = {'net_input': {'src_tokens': src_tokens}, 'target': target}
+            if use_cuda:
+                sample = utils.move_to_cuda(sample)
+
+            timer.start()
+            scores = scorer.score(sample)[0].float().cpu()
+            ntokens = 0
+            for j, i in enumerate(batch):
+                pos_scores[score_starts[i]:ends[i]] = scores[j, score_starts[i] - starts[i]:ends[i] - starts[i]]
+                ntokens += ends[i] - score_starts[i]
+            timer.stop(ntokens)
+
+            wps_meter.update(ntokens)
+            t.log({'wps': round(wps_meter.avg)})
+    return pos_scores
+
+
+def score_incremental(args, models, stream, pad, use_cuda, timer):
+    """Score a token stream one token at a time, reusing the decoder state.
+
+    The stream is split into one segment per batch row. Every segment is
+    preceded by ``tokens_per_sample - stride`` tokens of context, which are
+    fed to the decoder but not scored.
+    """
+    num_tokens = len(stream) - 1
+    bsz = args.max_sentences or max(1, (args.max_tokens or 36000) // args.tokens_per_sample)
+    segment_len = math.ceil(num_tokens / bsz)
+    score_starts = np.arange(0, num_tokens, segment_len, dtype=np.int64)
+    ends = np.minimum(score_starts + segment_len, num_tokens)
+    starts = np.maximum(score_starts - (args.tokens_per_sample - args.stride), 0)
+    print('| scoring {} tokens incrementally in {} segments'.format(num_tokens, len(starts)))
+
+    src_tokens = stream.new_full((len(starts), (ends - starts).max()), pad)
+    target = src_tokens.clone()
+    for j in range(len(starts)):
+        src_tokens[j, :ends[j] - starts[j]] = stream[starts[j]:ends[j]]
+        target[j, :ends[j] - starts[j]] = stream[starts[j] + 1:ends[j] + 1]
+    if use_cuda:
+        src_tokens, target = src_tokens.cuda(), target.cuda()
+
+    timer.start()
+    scores = []
+    incremental_states = [{} for _ in models]
+    with torch.no_grad():
+        for step in range(src_tokens.size(1)):
+            sample = {'target': target[:, step:step + 1]}
+            avg_probs = None
+            for model, incremental_state in zip(models, incremental_states):
+                model.eval()
+                decoder_out = model.decoder(src_tokens[:, :step + 1], None, incremental_state=incremental_state)
+                probs = model.get_normalized_probs(decoder_out, log_probs=False, sample=sample)
+                avg_probs = probs if avg_probs is None else avg_probs.add_(probs)
+            avg_probs = avg_probs.div_(len(models)).log_()
+            scores.append(avg_probs.gather(dim=2, index=sample['target'].unsqueeze(-1)).view(-1))
+    scores = torch.stack(scores, dim=1).float().cpu()
+
+    pos_scores = torch.zeros(num_tokens)
+    for j in range(len(starts)):
+        pos_scores[score_starts[j]:ends[j]] = scores[j, score_starts[j] - starts[j]:ends[j] - starts[j]]
+    timer.stop(num_tokens)
+    return pos_scores
+
+
+def process_scores(args, task, tokens, pos_scores, bpe_toks, bpe_len):
+    """Return the sum of the scores of a sequence and the number of scored
+    tokens (words, if BPE is removed), and print word probabilities."""
+    skipped_toks = 0
+    if bpe_toks is not None:
+        for i in range(len(tokens) - 1):
+            if tokens[i].item() in bpe_toks:
+                skipped_toks += 1
+                pos_scores[i + 1] += pos_scores[i]
+                pos_scores[i] = 0
+
+    inf_scores = pos_scores.eq(float('inf')) | pos_scores.eq(float('-inf'))
+    if inf_scores.any():
+        print('| Skipping tokens with inf scores:',
+              task.target_dictionary.string(tokens[inf_scores.nonzero()]))
+        pos_scores = pos_scores[(~inf_scores).nonzero()]
+    score_sum = pos_scores.sum()
+    count = pos_scores.numel() - skipped_toks
+
+    if args.output_word_probs:
+        w = ''
+        word_prob = []
+        for i in range(len(tokens)):
+            w_ind = tokens[i].item()
+            w += task.dictionary[w_ind]
+            if bpe_toks is not None and w_ind in bpe_toks:
+                w = w[:-bpe_len]
+            else:
+                word_prob.append((w, pos_scores[i].item()))
+                w = ''
+        print('\t'.join('{} [{:2f}]'.format(x[0], x[1]) for x in word_prob))
+
+    return score_sum, count
+
+
 def main(args):
     assert args.path is not None, '--path required for evaluation!'
 
@@ -54,16 +226,6 @@ def main(args):
 
     assert len(models) > 0
 
-    itr = data.EpochBatchIterator(
-        dataset=task.dataset(args.gen_subset),
-        max_tokens=args.max_tokens or 36000,
-        max_sentences=args.max_sentences,
-        max_positions=models[0].max_positions(),
-        num_shards=args.num_shards,
-        shard_id=args.shard_id,
-        ignore_invalid_inputs=True,
-    ).next_epoch_itr(shuffle=False)
-
     gen_timer = StopwatchMeter()
     scorer = SequenceScorer(models, task.target_dictionary)
     if use_cuda:
@@ -80,44 +242,46 @@ def main(args):
         bpe_toks = None
         bpe_len = 0
 
-    with progress_bar.build_progress_bar(args, itr) as t:
-        results = scorer.score_batched_itr(t, cuda=use_cuda, timer=gen_timer)
-        wps_meter = TimeMeter()
-        for _, src_tokens, __, hypos in results:
-            for hypo in hypos:
-                pos_scores = hypo['positional_scores']
-
-                skipped_toks = 0
-                if bpe_toks is not None:
-                    for i in range(len(hypo['tokens']) - 1):
-                        if hypo['tokens'][i].item() in bpe_toks:
-                            skipped_toks += 1
-                            pos_scores[i + 1] += pos_scores[i]
-                            pos_scores[i] = 0
-
-                inf_scores = pos_scores.eq(float('inf')) | pos_scores.eq(float('-inf'))
-                if inf_scores.any():
-                    print('| Skipping tokens with inf scores:',
-                          task.target_dictionary.string(hypo['tokens'][inf_scores.nonzero()]))
-                    pos_scores = pos_scores[(~inf_scores).nonzero()]
-                score_sum += pos_scores.sum()
-                count += pos_scores.numel() - skipped_toks
-
-                if args.output_word_probs:
-                    w = ''
-                    word_prob = []
-                    for i in range(len(hypo['tokens'])):
-                        w_ind = hypo['tokens'][i].item()
-                        w += task.dictionary[w_ind]
-                        if bpe_toks is not None and w_ind in bpe_toks:
-                            w = w[:-bpe_len]
-                        else:
-                            word_prob.append((w, pos_scores[i].item()))
-                            w = ''
-                    print('\t'.join('{} [{:2f}]'.format(x[0], x[1]) for x in word_prob))
-
-            wps_meter.update(src_tokens.size(0))
-            t.log({'wps': round(wps_meter.avg)})
+    if args.stride > 0:
+        assert args.stride <= args.tokens_per_sample, '--stride must not exceed --tokens-per-sample'
+        dataset = task.dataset(args.gen_subset)
+        stream, block_sizes = get_token_stream(dataset)
+        pad = task.target_dictionary.pad()
+        if all(supports_incremental_eval(model) for model in models):
+            pos_scores = score_incremental(args, models, stream, pad, use_cuda, gen_timer)
+        else:
+            pos_scores = score_windows(args, scorer, stream, pad, use_cuda, gen_timer)
+
+        # process the scores block by block, as without --stride
+        offsets = np.concatenate([[0], np.cumsum(block_sizes)])
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            block_sum, block_count = process_scores(
+                args, task, stream[start + 1:end + 1], pos_scores[start:end], bpe_toks, bpe_len)
+            score_sum += block_sum
+            count += block_count
+    else:
+        itr = data.EpochBatchIterator(
+            dataset=task.dataset(args.gen_subset),
+            max_tokens=args.max_tokens or 36000,
+            max_sentences=args.max_sentences,
+            max_positions=models[0].max_positions(),
+            num_shards=args.num_shards,
+            shard_id=args.shard_id,
+            ignore_invalid_inputs=True,
+        ).next_epoch_itr(shuffle=False)
+
+        with progress_bar.build_progress_bar(args, itr) as t:
+            results = scorer.score_batched_itr(t, cuda=use_cuda, timer=gen_timer)
+            wps_meter = TimeMeter()
+            for _, src_tokens, __, hypos in results:
+                for hypo in hypos:
+                    hypo_sum, hypo_count = process_scores(
+                        args, task, hypo['tokens'], hypo['positional_scores'], bpe_toks, bpe_len)
+                    score_sum += hypo_sum
+                    count += hypo_count
+
+                wps_meter.update(src_tokens.size(0))
+                t.log({'wps': round(wps_meter.avg)})
 
     avg_nll_loss = -score_sum / count
     print('| Evaluated {} tokens in {:.1f}s ({:.2f} tokens/s)'.format(gen_timer.n, gen_timer.sum, 1. / gen_timer.avg))
@@ -127,4 +291,6 @@ def main(args):
 if __name__ == '__main__':
     parser = options.get_eval_lm_parser()
     args = options.parse_args_and_arch(parser)
+    if args.stride > 0 and args.num_shards > 1:
+        parser.error('--stride does not support --num-shards, the token stream is scored as a whole')
     main(args)
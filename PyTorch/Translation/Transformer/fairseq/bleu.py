@@ -7,17 +7,16 @@
 
 import ctypes
 import math
+
+import numpy as np
 import torch
 
 try:
     from fairseq import libbleu
-except ImportError as e:
-    import sys
-    sys.stderr.write('ERROR: missing libbleu.so. run `python setup.py install`\n')
-    raise e
-
-
-C = ctypes.cdll.LoadLibrary(libbleu.__file__)
+    C = ctypes.cdll.LoadLibrary(libbleu.__file__)
+except ImportError:
+    # fall back to the vectorized implementation in bleu_stats
+    C = None
 
 
 class BleuStat(ctypes.Structure):
@@ -35,6 +34,100 @@ class BleuStat(ctypes.Structure):
     ]
 
 
+def _to_padded_array(sents, pad):
+    if isinstance(sents, torch.Tensor):
+        return sents.cpu().numpy().astype(np.int64)
+    if isinstance(sents, np.ndarray):
+        return sents.astype(np.int64)
+    sents = [np.asarray(s, dtype=np.int64).reshape(-1) for s in sents]
+    lengths = np.array([len(s) for s in sents], dtype=np.int64)
+    arr = np.full((len(sents), lengths.max(initial=0)), pad, dtype=np.int64)
+    arr[np.arange(arr.shape[1]) < lengths[:, None]] = np.concatenate(sents) if sents else []
+    return arr
+
+
+def _trim(sents, pad, eos):
+    """Return the flattened tokens and lengths of padded sentences after
+    stripping the leading pads and the trailing pads/eos (like libbleu)."""
+    if sents.shape[1] == 0:
+        return sents.reshape(-1), np.zeros(len(sents), dtype=np.int64)
+    pos = np.arange(sents.shape[1])
+    nonpad = sents != pad
+    start = np.argmax(nonpad, axis=1)
+    keep = nonpad & (sents != eos) & (pos > start[:, None])
+    end = np.where(keep, pos, -1).max(axis=1, initial=-1)
+    end = np.where(end >= 0, end, start)
+    lengths = np.where(nonpad.any(axis=1), end - start + 1, 0)
+    mask = (pos >= start[:, None]) & (pos < (start + lengths)[:, None])
+    return sents[mask], lengths
+
+
+_FNV_OFFSET = np.uint64(14695981039346656037)
+_FNV_PRIME = np.uint64(0x100000001b3)
+
+
+def _hash_extend(h, tokens):
+    """Continue the libbleu (FNV-1) hashes *h* with one more token each."""
+    # libbleu hashes the bytes of the int tokens as (signed) chars
+    data = tokens.astype('<i4').view(np.int8).reshape(-1, 4).astype(np.int64).view(np.uint64)
+    for i in range(4):
+        h = (h ^ data[:, i]) * _FNV_PRIME
+    return h
+
+
+def bleu_stats(ref, pred, pad, eos, unk, order=4):
+    """Compute the BleuStat totals of a batch of sentence pairs.
+
+    Produces the same counts as adding the pairs one by one with
+    :func:`Scorer.add`, but the n-grams of all sentences are matched at once.
+    N-grams are hashed with the same hash function as libbleu (extending the
+    hashes of the (n-1)-grams by one token), and the clipped matches are the
+    sum of the element-wise minimum of the hypothesis and reference counts of
+    every (sentence, hash) pair.
+
+    Args:
+        ref, pred: 2D tensors/arrays padded with *pad* or lists of 1D
+            tensors/arrays with the reference and hypothesis tokens
+
+    Returns:
+        int64 array with (reflen, predlen, match1, count1, ..., match4,
+        count4)
+    """
+    ref, ref_lens = _trim(_to_padded_array(ref, pad), pad, eos)
+    pred, pred_lens = _trim(_to_padded_array(pred, pad), pad, eos)
+    assert len(ref_lens) == len(pred_lens), 'number of references and hypotheses differ'
+    assert not (ref < 0).any()
+    stats = np.zeros(2 + 2 * order, dtype=np.int64)
+    stats[0] = ref_lens.sum()
+    stats[1] = pred_lens.sum()
+
+    # don't match unknown words
+    ref = np.where(ref == unk, -999, ref)
+    tokens = np.concatenate([pred, ref])
+    lens = np.concatenate([pred_lens, ref_lens])
+    sent = np.repeat(np.concatenate([np.arange(len(pred_lens)), np.arange(len(ref_lens))]), lens)
+    seg_len = np.repeat(lens, lens)
+    seg_pos = np.arange(len(tokens)) - np.repeat(np.cumsum(lens) - lens, lens)
+    is_pred = np.arange(len(tokens)) < len(pred)
+
+    hashes = np.full(len(tokens), _FNV_OFFSET, dtype=np.uint64)
+    for n in range(1, order + 1):
+        valid = np.nonzero(seg_pos + n <= seg_len)[0]
+        hashes[valid] = _hash_extend(hashes[valid], tokens[valid + n - 1])
+        _, ids = np.unique(hashes[valid], return_inverse=True)
+        keys, ids = np.unique(sent[valid] * len(valid) + ids, return_inverse=True)
+        pred_valid = is_pred[valid]
+        pred_count = np.bincount(ids[pred_valid], minlength=len(keys))
+        ref_count = np.bincount(ids[~pred_valid], minlength=len(keys))
+        stats[2 * n] = np.minimum(pred_count, ref_count).sum()
+        stats[2 * n + 1] = pred_valid.sum()
+    return stats
+
+
+def _bleu_stats_star(args):
+    return bleu_stats(*args)
+
+
 class Scorer(object):
     def __init__(self, pad, eos, unk):
         self.stat = BleuStat()
@@ -44,7 +137,13 @@ class Scorer(object):
         self.reset()
 
     def reset(self, one_init=False):
-        if one_init:
+        if C is None:
+            for name, _ in BleuStat._fields_:
+                setattr(self.stat, name, 0)
+            if one_init:
+                self.stat.count2 = self.stat.count3 = self.stat.count4 = 1
+                self.stat.match2 = self.stat.match3 = self.stat.match4 = 1
+        elif one_init:
             C.bleu_one_init(ctypes.byref(self.stat))
         else:
             C.bleu_zero_init(ctypes.byref(self.stat))
@@ -57,6 +156,9 @@ class Scorer(object):
             raise TypeError('pred must be a torch.IntTensor(got {})'
                             .format(type(pred)))
 
+        if C is None:
+            return self.add_batch([ref], [pred])
+
         # don't match unknown words
         rref = ref.clone()
         assert not rref.lt(0).any()
@@ -74,6 +176,25 @@ class Scorer(object):
             ctypes.c_int(self.pad),
             ctypes.c_int(self.eos))
 
+    def add_batch(self, ref, pred, pool=None, chunk_size=10000):
+        """Add a batch of sentence pairs, see :func:`bleu_stats`.
+
+        Args:
+            ref, pred: 2D tensors padded with *pad* or lists of 1D tensors
+            pool: optional multiprocessing pool, the pairs are then scored
+                in chunks of *chunk_size* in parallel
+        """
+        if pool is None or len(ref) <= chunk_size:
+            stats = bleu_stats(ref, pred, self.pad, self.eos, self.unk)
+        else:
+            chunks = [
+                (ref[i:i + chunk_size], pred[i:i + chunk_size], self.pad, self.eos, self.unk)
+                for i in range(0, len(ref), chunk_size)
+            ]
+            stats = sum(pool.map(_bleu_stats_star, chunks))
+        for (name, _), value in zip(BleuStat._fields_, stats.tolist()):
+            setattr(self.stat, name, getattr(self.stat, name) + value)
+
     def score(self, order=4):
         psum = sum(math.log(p) if p > 0 else float('-Inf')
                    for p in self.precision()[:order])
@@ -122,6 +122,33 @@ class IndexedInMemoryDataset(IndexedDataset):
         return torch.from_numpy(a).long()
 
 
+class IndexedMMapDataset(IndexedDataset):
+    """Loader for TorchNet IndexedDataset, memory-maps the data file
+
+    Unlike :class:`IndexedInMemoryDataset`, *buffer* is read-only and holds
+    the raw (Lua indexed) values, *fix_lua_indexing* is only applied to the
+    items returned by ``__getitem__``.
+    """
+
+    def read_data(self, path):
+        self.buffer = np.memmap(
+            data_file_path(path), dtype=self.dtype, mode='r', shape=(self.data_offsets[-1],),
+        )
+
+    def __del__(self):
+        pass
+
+    def __getitem__(self, i):
+        self.check_index(i)
+        tensor_size = self.sizes[self.dim_offsets[i]:self.dim_offsets[i + 1]]
+        a = np.empty(tensor_size, dtype=self.dtype)
+        np.copyto(a, self.buffer[self.data_offsets[i]:self.data_offsets[i + 1]].reshape(tensor_size))
+        item = torch.from_numpy(a).long()
+        if self.fix_lua_indexing:
+            item -= 1  # subtract 1 for 0-based indexing
+        return item
+
+
 class IndexedRawTextDataset(IndexedDataset):
     """Takes a text file as input and binarizes it in memory at instantiation.
     Original lines are also kept in memory"""
@@ -20,7 +20,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import math
+import os
 
 import numpy as np
 import torch
@@ -42,57 +42,89 @@ class TokenBlockDataset(torch.utils.data.Dataset):
                 exceeded if some sentences exceed block_size
             - 'eos': each block contains one sentence (block_size is ignored)
         include_targets: return next tokens as targets
+        fix_lua_indexing: subtract 1 from the returned tokens (for the raw
+            buffer of an :class:`IndexedMMapDataset`)
+        cache_path: if set, the block boundaries are loaded from this file if
+            it exists, and saved to it otherwise (e.g. to share them between
+            the workers of a distributed run)
     """
 
-    def __init__(self, tokens, sizes, block_size, break_mode=None, include_targets=False):
+    def __init__(self, tokens, sizes, block_size, break_mode=None, include_targets=False,
+                 fix_lua_indexing=False, cache_path=None):
         super().__init__()
 
         self.tokens = tokens
         self.total_size = len(tokens)
         self.include_targets = include_targets
-        self.slice_indices = []
+        self.fix_lua_indexing = fix_lua_indexing
 
-        if break_mode is None or break_mode == 'none':
-            length = math.ceil(len(tokens) / block_size)
-
-            def block_at(i):
-                start = i * block_size
-                end = min(start + block_size, len(tokens))
-                return (start, end)
-
-            self.slice_indices = [block_at(i) for i in range(length)]
-        elif break_mode == 'complete':
-            assert sizes is not None and sum(sizes) == len(tokens), '{} != {}'.format(sum(sizes), len(tokens))
-            tok_idx = 0
-            sz_idx = 0
-            curr_size = 0
-            while sz_idx < len(sizes):
-                if curr_size + sizes[sz_idx] <= block_size or curr_size == 0:
-                    curr_size += sizes[sz_idx]
-                    sz_idx += 1
-                else:
-                    self.slice_indices.append((tok_idx, tok_idx + curr_size))
-                    tok_idx += curr_size
-                    curr_size = 0
-            if curr_size > 0:
-                self.slice_indices.append((tok_idx, tok_idx + curr_size))
-        elif break_mode == 'eos':
-            assert sizes is not None and sum(sizes) == len(tokens), '{} != {}'.format(sum(sizes), len(tokens))
-            curr = 0
-            for sz in sizes:
-                # skip samples with just 1 example (which would be just the eos token)
-                if sz > 1:
-                    self.slice_indices.append((curr, curr + sz))
-                curr += sz
+        if cache_path is not None and os.path.exists(cache_path):
+            self.slice_indices = np.load(cache_path)
         else:
-            raise ValueError('Invalid break_mode: ' + break_mode)
+            self.slice_indices = self.build_slice_indices(sizes, block_size, break_mode, self.total_size)
+            if cache_path is not None:
+                # write to a temporary file first, other workers may read it concurrently
+                tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+                with open(tmp_path, 'wb') as f:
+                    np.save(f, self.slice_indices)
+                os.replace(tmp_path, cache_path)
+
+        self.sizes = self.slice_indices[:, 1] - self.slice_indices[:, 0]
+
+    @staticmethod
+    def build_slice_indices(sizes, block_size, break_mode, total_size):
+        """Return an int64 array of size num_blocks x 2 with the (start, end)
+        token offsets of the blocks."""
+        if break_mode is None or break_mode == 'none':
+            starts = np.arange(0, total_size, block_size, dtype=np.int64)
+            ends = np.minimum(starts + block_size, total_size)
+            return np.stack([starts, ends], axis=1)
 
-        self.sizes = np.array([e - s for s, e in self.slice_indices])
+        if break_mode not in ('complete', 'eos'):
+            raise ValueError('Invalid break_mode: ' + break_mode)
+        assert sizes is not None
+        sizes = np.asarray(sizes, dtype=np.int64)
+        offsets = np.concatenate([[0], np.cumsum(sizes)])
+        assert offsets[-1] == total_size, '{} != {}'.format(offsets[-1], total_size)
+
+        if break_mode == 'eos':
+            # skip samples with just 1 example (which would be just the eos token)
+            keep = sizes > 1
+            return np.stack([offsets[:-1][keep], offsets[1:][keep]], axis=1)
+
+        # a block starting at sentence i ends at the last sentence boundary
+        # within block_size tokens, but contains at least one sentence
+        num_sents = len(sizes)
+        next_start = np.searchsorted(offsets, offsets + block_size, side='right') - 1
+        next_start = np.maximum(next_start, np.minimum(np.arange(1, num_sents + 2), num_sents))
+        # follow the chain of blocks from sentence 0 by pointer doubling:
+        # after k steps, path holds its first 2^k entries and jump skips 2^k blocks
+        path = np.zeros(1, dtype=np.int64)
+        jump = next_start
+        while path[-1] != num_sents:
+            path = np.concatenate([path, jump[path]])
+            jump = jump[jump]
+        path = np.unique(path)
+        starts, ends = offsets[path[:-1]], offsets[path[1:]]
+        keep = ends > starts
+        return np.stack([starts[keep], ends[keep]], axis=1)
+
+    def _as_tensor(self, block):
+        if torch.is_tensor(block):
+            item = block.long()
+        else:
+            block = np.asarray(block)
+            if block.dtype != np.int64 or not block.flags.writeable:
+                block = block.astype(np.int64)
+            item = torch.from_numpy(block)
+        if self.fix_lua_indexing:
+            item = item - 1  # subtract 1 for 0-based indexing
+        return item
 
     def __getitem__(self, index):
         s, e = self.slice_indices[index]
 
-        item = torch.LongTensor(self.tokens[s:e])
+        item = self._as_tensor(self.tokens[s:e])
 
         if self.include_targets:
             # target is the sentence, for source, rotate item one token to the left (would start with eos)
@@ -101,7 +133,7 @@ class TokenBlockDataset(torch.utils.data.Dataset):
             else:
                 source = self.tokens[s - 1:e - 1]
 
-            return torch.LongTensor(source), item
+            return self._as_tensor(source), item
         return item
 
     def __len__(self):
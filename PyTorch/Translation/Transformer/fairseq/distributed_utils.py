@@ -20,11 +20,13 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import pickle
 
+import numpy as np
 import torch.distributed
 
-from fairseq import utils
+from fairseq.meters import AverageMeter
 
 def is_master(args):
     return args.distributed_rank == 0
@@ -80,35 +82,204 @@ def suppress_output(main_args):
     else:
         __builtin__.print = print
 
-def all_gather_list(data, max_size=16384):
-    """Gathers arbitrary data from all nodes into a list."""
+def _comm_device():
+    return torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
+
+
+def all_gather_list(data, max_size=None):
+    """Gathers arbitrary data from all nodes into a list.
+
+    The sizes of the pickled data are exchanged first, then the data itself is
+    gathered into buffers which are reused (and grown) between calls, so there
+    is no limit on the size of the data.
+
+    Args:
+        data: picklable object
+        max_size: optional upper bound on the size (in bytes) of the pickled
+            data of this node
+    """
     world_size = torch.distributed.get_world_size()
-    if not hasattr(all_gather_list, '_in_buffer') or \
-            max_size != len(all_gather_list._in_buffer):
-        all_gather_list._in_buffer = torch.cuda.ByteTensor(max_size)
-        all_gather_list._out_buffers = [
-            torch.cuda.ByteTensor(max_size)
-            for i in range(world_size)
-        ]
-    in_buffer = all_gather_list._in_buffer
-    out_buffers = all_gather_list._out_buffers
+    device = _comm_device()
 
     enc = pickle.dumps(data)
     enc_size = len(enc)
-    if enc_size + 2 > max_size:
-        raise ValueError('encoded data exceeds max_size: {}'.format(enc_size + 2))
-    assert max_size < 255*256
-    in_buffer[0] = enc_size // 255  # this encoding works for max_size < 65k
-    in_buffer[1] = enc_size % 255
-    in_buffer[2:enc_size+2] = torch.ByteTensor(list(enc))
-
-    torch.distributed.all_gather(out_buffers, in_buffer.cuda())
-
-    result = []
-    for i in range(world_size):
-        out_buffer = out_buffers[i]
-        size = (255 * utils.item(out_buffer[0])) + utils.item(out_buffer[1])
-        result.append(
-            pickle.loads(bytes(out_buffer[2:size+2].tolist()))
-        )
-    return result
+    if max_size is not None and enc_size > max_size:
+        raise ValueError('encoded data exceeds max_size: {}'.format(enc_size))
+
+    # phase 1: exchange the sizes
+    size = torch.tensor([enc_size], dtype=torch.long, device=device)
+    sizes = [torch.zeros_like(size) for _ in range(world_size)]
+    torch.distributed.all_gather(sizes, size)
+    sizes = torch.cat(sizes).tolist()
+    max_enc_size = max(sizes)
+
+    # phase 2: gather the data padded to the largest size
+    buffer_size = 1 << max(max_enc_size - 1, 1).bit_length()
+    if not hasattr(all_gather_list, '_in_buffer') or \
+            buffer_size > len(all_gather_list._in_buffer) or \
+            all_gather_list._out_buffer.size(0) != world_size or \
+            all_gather_list._in_buffer.device != device:
+        all_gather_list._in_buffer = torch.empty(buffer_size, dtype=torch.uint8, device=device)
+        all_gather_list._out_buffer = torch.empty(world_size, buffer_size, dtype=torch.uint8, device=device)
+    in_buffer = all_gather_list._in_buffer[:max_enc_size]
+    out_buffer = all_gather_list._out_buffer[:, :max_enc_size]
+
+    in_buffer[:enc_size].copy_(torch.from_numpy(np.frombuffer(bytearray(enc), dtype=np.uint8)))
+    torch.distributed.all_gather(list(out_buffer.unbind(0)), in_buffer)
+
+    out = out_buffer.cpu().numpy()
+    return [pickle.loads(out[i, :sizes[i]].tobytes()) for i in range(world_size)]
+
+
+def all_reduce_dict(data, keys):
+    """Sums the numbers in *data* over all nodes with a single all_reduce.
+
+    Only the given keys are reduced, a missing key counts as 0.
+
+    Returns:
+        tuple of the dict with the sums and a flag telling whether any node
+        had keys which are not in *keys* (which are not reduced)
+    """
+    known_keys = set(keys)
+    has_extra_keys = any(k not in known_keys for k in data)
+    values = [float(data.get(k, 0)) for k in keys] + [float(has_extra_keys)]
+    buffer = torch.tensor(values, dtype=torch.double, device=_comm_device())
+    torch.distributed.all_reduce(buffer)
+    values = buffer.tolist()
+    return collections.OrderedDict(zip(keys, values[:-1])), values[-1] > 0
+
+
+class GradientBuckets(object):
+    """All-reduces the gradients of *params* in fixed buckets while the
+    backward pass runs.
+
+    Parameters are assigned to buckets up front. Gradients are produced
+    roughly in the reverse order in which the parameters were registered, so
+    buckets are filled starting from the last parameter. Each bucket is a
+    contiguous range of :attr:`flat_grads` holding at least *bucket_size*
+    elements (except maybe the last one).
+
+    Buckets are always all-reduced in the same order, a full bucket waits for
+    the buckets before it, so that all workers launch the same all-reduces
+    even when some parameters get no gradient on some of them. The squared
+    norm of each reduced bucket is computed right after its all-reduce.
+
+    With a CUDA *stream*, the all-reduces run asynchronously on it and their
+    time is measured in :attr:`meters` (in milliseconds). Without one, they
+    run synchronously when a bucket is full.
+
+    Call :func:`reset` before every backward pass, with ``enabled=True`` only
+    for the backward pass of the step which updates the parameters, then
+    :func:`finish` to get the norm of the reduced gradients.
+    """
+
+    def __init__(self, params, bucket_size, world_size, dtype=None, stream=None):
+        self.params = params
+        self.world_size = world_size
+        self.stream = stream
+        self.offsets = []
+        offset = 0
+        for p in params:
+            self.offsets.append(offset)
+            offset += p.numel()
+        self.flat_grads = params[0].new_zeros(offset, dtype=dtype)
+
+        self.buckets = []
+        self._param_bucket = [None] * len(params)
+        bucket_params = []
+        size = 0
+        for p_i in reversed(range(len(params))):
+            bucket_params.append(p_i)
+            self._param_bucket[p_i] = len(self.buckets)
+            size += params[p_i].numel()
+            if size >= bucket_size or p_i == 0:
+                start = self.offsets[p_i]
+                self.buckets.append({"start": start, "end": start + size, "params": bucket_params})
+                bucket_params = []
+                size = 0
+
+        self.sqnorms = self.flat_grads.new_zeros(len(self.buckets), dtype=torch.float32)
+        self.meters = [AverageMeter() for _ in self.buckets]
+        self._handles = []
+        self._events = []
+        self.reset(enabled=False)
+
+        for p_i, p in enumerate(params):
+            p.register_hook(lambda grad, p_i=p_i: self._add_grad(p_i, grad))
+
+    def reset(self, enabled):
+        """Forget the gradients of the previous backward pass, and reduce the
+        gradients of the next one only if *enabled*."""
+        # all-reduces which were launched but not finished still write to
+        # the flat buffer
+        for handle in self._handles:
+            handle.wait()
+        if self._handles and self.stream is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+        self.enabled = enabled
+        self._grads_generated = [False] * len(self.params)
+        self._pending = [len(b["params"]) for b in self.buckets]
+        self._next_bucket = 0
+        self._handles = []
+        self._events = []
+
+    def _add_grad(self, p_i, grad):
+        if not self.enabled:
+            return
+        p = self.params[p_i]
+        if p.grad is not None:
+            # the gradients of the previous backward passes (--update-freq)
+            # are accumulated into p.grad after this hook
+            grad = grad + p.grad
+        start = self.offsets[p_i]
+        torch.div(grad.view(-1), self.world_size, out=self.flat_grads[start:start + p.numel()])
+        self._grads_generated[p_i] = True
+        self._pending[self._param_bucket[p_i]] -= 1
+        while self._next_bucket < len(self.buckets) and self._pending[self._next_bucket] == 0:
+            self._launch(self._next_bucket)
+            self._next_bucket += 1
+
+    def _launch(self, bucket_i):
+        bucket = self.buckets[bucket_i]
+        grads = self.flat_grads[bucket["start"]:bucket["end"]]
+        if self.stream is None:
+            torch.distributed.all_reduce(grads)
+            self.sqnorms[bucket_i] = torch.norm(grads, 2, dtype=torch.float32) ** 2
+            return
+        start_event = torch.cuda.Event(enable_timing=True)
+        end_event = torch.cuda.Event(enable_timing=True)
+        self.stream.wait_stream(torch.cuda.current_stream())
+        with torch.cuda.stream(self.stream):
+            start_event.record()
+            handle = torch.distributed.all_reduce(grads, async_op=True)
+            handle.wait()
+            self.sqnorms[bucket_i] = torch.norm(grads, 2, dtype=torch.float32) ** 2
+            end_event.record()
+        self._handles.append(handle)
+        self._events.append((start_event, end_event))
+
+    def finish(self):
+        """Reduce the remaining buckets, wait for all of them and return the
+        norm of the reduced gradients."""
+        assert self.enabled, 'gradient buckets were not enabled for this backward pass'
+        for bucket_i in range(self._next_bucket, len(self.buckets)):
+            # some parameters did not receive a gradient in this step
+            for p_i in self.buckets[bucket_i]["params"]:
+                if not self._grads_generated[p_i]:
+                    start = self.offsets[p_i]
+                    self.flat_grads[start:start + self.params[p_i].numel()].zero_()
+            self._launch(bucket_i)
+        self._next_bucket = len(self.buckets)
+        for handle in self._handles:
+            handle.wait()
+        if self.stream is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+        grad_norm = self.sqnorms.sum().sqrt().item()
+
+        # the norm above synchronized the host, so the events have completed
+        for bucket_i, (start_event, end_event) in enumerate(self._events):
+            self.meters[bucket_i].update(start_event.elapsed_time(end_event))
+        self._handles = []
+        self._events = []
+        self.enabled = False
+        return grad_norm
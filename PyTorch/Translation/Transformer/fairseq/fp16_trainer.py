@@ -27,7 +27,7 @@ Train a network on multiple GPUs.
 import torch
 import ctypes
 
-from fairseq import optim, utils
+from fairseq import distributed_utils, optim, utils
 from fairseq.meters import AverageMeter
 from fairseq.optim import lr_scheduler
 from fairseq.trainer import Trainer
@@ -89,123 +89,36 @@ class FP16Trainer(Trainer):
         self.grad_denom = 1.0
 
         if self.args.enable_parallel_backward_allred_opt:
-            import numpy as np
-            self._reduction_stream = torch.cuda.Stream()
-
-            self._flat_grads_parallel = torch.tensor([], dtype=torch.float16).cuda()
-            self._grads_info = []
-            grads_size = 0
-            p_offset = 0
-            for p_i, p in enumerate([p for p in self.model.parameters() if p.requires_grad]):
-                p_grads_size = np.prod(list(p.size()))
-                grads_size += p_grads_size
-                # register hooks
-                def wrapper(param, param_i, param_grads_size, param_offset):
-                    def allreduce_hook(grad):
-                        self._do_allreduce(param_i, param_grads_size, param_offset, grad)
-
-                    if param.requires_grad:
-                        param.register_hook(allreduce_hook)
-                # print(p_i, p.size(), p_grads_size, p_offset)
-                self._grads_info.append({"param_grads_size":p_grads_size, "param_offset":p_offset})
-                wrapper(p, p_i, p_grads_size, p_offset)
-                p_offset += p_grads_size
-            self._flat_grads_parallel.resize_(grads_size)
-            # print(grads_size, len(self._flat_grads_parallel), self._flat_grads_parallel.dtype, self._flat_grads_parallel.get_device())
-
-            self._allreduce_flush_min_threshold = self.args.parallel_backward_allred_opt_threshold
-            print("| parallel all-reduce ENABLED. all-reduce threshold: " + str(self._allreduce_flush_min_threshold))
-            self._grads_generated = [False]*len(self._grads_info)
-            self._allreduce_processed_idx = len(self._grads_info)-1
-
-            if self.args.enable_parallel_backward_allred_opt_correctness_check:
-                self._num_grads_generated = 0
-                self._all_grads_generated = False
-                self._allreduce_schedule = []
-
-    def _get_flush_bucket(self):
-        # print([1 if x else 0 for x in self._grads_generated])
-        flush_bucket = []
-
-        size = 0
-        allreduce_processed_idx_list = []
-        allreduce_processed_end_idx = self._allreduce_processed_idx
-        remaining_grads_for_allreduce = self._grads_generated[allreduce_processed_end_idx-len(self._grads_generated)::-1]
-        # print([1 if x else 0 for x in remaining_grads_for_allreduce])
-        for s in remaining_grads_for_allreduce:
-            # print(s,allreduce_processed_end_idx,size)
-            if s:
-                allreduce_processed_idx_list.append(allreduce_processed_end_idx)
-                size += self._grads_info[allreduce_processed_end_idx]["param_grads_size"]
-                allreduce_processed_end_idx -= 1
+            params = [p for p in self.model.parameters() if p.requires_grad]
+            if self.args.allreduce_bucket_mb > 0:
+                bucket_size = int(self.args.allreduce_bucket_mb * 2**20) // 2  # FP16 gradients
             else:
-                break
-
-        # print(size, allreduce_processed_idx_list)
-        ignore_threshold = all(self._grads_generated)
-
-        if size >= self._allreduce_flush_min_threshold or ignore_threshold:
-            # for i in allreduce_processed_idx_list:
-            #     print(i, self._grads_info[i]["param_grads_size"], self._grads_info[i]["param_offset"],size)
-            if allreduce_processed_idx_list:
-                start = self._grads_info[(allreduce_processed_idx_list[-1])]["param_offset"]
-                end = start + size
-                # print("->", start, end)
-                flush_bucket = [start, end]
-
-            self._allreduce_processed_idx = allreduce_processed_end_idx
-            if self._allreduce_processed_idx < 0:
-                # reset
-                self._grads_generated = [False]*len(self._grads_info)
-                self._allreduce_processed_idx = len(self._grads_info)-1
-
-        return flush_bucket
-
-    def _do_allreduce(self, param_i, param_grads_size, param_offset, grad):
-        if self._last_step == False:
-
-            # # ----------------------
-            # # debugging: do all-reduce in the same stream
-            # print(self._last_step, self._grads_total, len(self._backward_grads_schedule), param_i, param_offset, param_grads_size, grad.size(), grad.numel(), grad.dtype)
-            # self._flat_grads_parallel[param_offset:param_offset+param_grads_size].copy_(grad.view(-1))
-            # self._flat_grads_parallel[param_offset:param_offset+param_grads_size].div_(self.args.distributed_world_size)
-            # torch.distributed.all_reduce(self._flat_grads_parallel[param_offset:param_offset+param_grads_size])
-            # # ----------------------
-
-            # # ----------------------
-            # # option #1: send per-layer gradients
-            # torch.div(grad.view(-1), self.args.distributed_world_size, out=self._flat_grads_parallel[param_offset:param_offset+param_grads_size])
-            # orig_stream = torch.cuda.current_stream()
-            # self._reduction_stream.wait_stream(orig_stream)
-            # with torch.cuda.stream(self._reduction_stream):
-            #     torch.distributed.all_reduce(self._flat_grads_parallel[param_offset:param_offset+param_grads_size])
-            # # ----------------------
-
-            # ----------------------
-            # option #2: bucket all-reduce based on threshold
-            torch.div(grad.view(-1), self.args.distributed_world_size, out=self._flat_grads_parallel[param_offset:param_offset+param_grads_size])
-            self._grads_generated[param_i]=True
-            flush_bucket = self._get_flush_bucket()
-            if flush_bucket:
-                start = flush_bucket[0]
-                end = flush_bucket[1]
-                # print("->", start, end)
-
-                if self.args.enable_parallel_backward_allred_opt_correctness_check and not self._all_grads_generated:
-                    self._allreduce_schedule.append(flush_bucket)
-
-                orig_stream = torch.cuda.current_stream()
-                self._reduction_stream.wait_stream(orig_stream)
-                with torch.cuda.stream(self._reduction_stream):
-                    torch.distributed.all_reduce(self._flat_grads_parallel[start:end])
-
-
-            if self.args.enable_parallel_backward_allred_opt_correctness_check:
-                self._num_grads_generated += 1
-                if self._num_grads_generated == len(self._grads_info):
-                    self._all_grads_generated = True
-            # ----------------------
-
+                bucket_size = self.args.parallel_backward_allred_opt_threshold
+            self._grad_buckets = distributed_utils.GradientBuckets(
+                params, bucket_size, self.args.distributed_world_size, dtype=torch.float16,
+                stream=torch.cuda.Stream())
+            print("| parallel all-reduce ENABLED. {} buckets of at least {} elements".format(
+                len(self._grad_buckets.buckets), bucket_size))
+            # all-reduce time of every bucket in milliseconds
+            self.bucket_meters = self._grad_buckets.meters
+
+    def _check_buckets(self):
+        """Compare the gradients reduced during backward with an all-reduce
+        of the same buckets done at the end of the step."""
+        out = self._get_flat_grads()
+        out.div_(self.args.distributed_world_size)
+        flat_grads_parallel = self._grad_buckets.flat_grads
+        for bucket in self._grad_buckets.buckets:
+            start, end = bucket["start"], bucket["end"]
+            torch.distributed.all_reduce(out[start:end])
+            is_parallel_grads_finite = torch.all(torch.isfinite(flat_grads_parallel[start:end]))
+            is_out_finite = torch.all(torch.isfinite(out[start:end]))
+            assert(is_out_finite == is_parallel_grads_finite)
+            if not is_out_finite:
+                print("| OVERLAP-CHECK: check inf/nan detected. this batch should be skipped")
+            elif not torch.all(torch.eq(out[start:end], flat_grads_parallel[start:end])):
+                print(start, end, out[start:end], flat_grads_parallel[start:end])
+                raise RuntimeError('w-gradients received in parallel vs. end differ')
 
     def _build_optimizer(self):
         # create FP32 copy of parameters and grads
@@ -249,6 +162,10 @@ class FP16Trainer(Trainer):
 
 
     def _backward(self, loss):
+        if self.args.enable_parallel_backward_allred_opt:
+            # only the backward pass of the step which updates the parameters
+            # is reduced, it includes the gradients of the buffered ones
+            self._grad_buckets.reset(enabled=self._update_params and not self._last_step)
         self.meters['loss_scale'].reset()
         self.meters['loss_scale'].update(self.scaler.loss_scale)
         if loss is not None:
@@ -260,10 +177,11 @@ class FP16Trainer(Trainer):
         # undo effect of dynamic loss scaling on gradients
         self.grad_denom = grad_denom * self.scaler.loss_scale
 
+        grad_norm = None
         if self.args.distributed_world_size > 1:
             self.grad_denom /= self.args.distributed_world_size - ooms
 
-            if not self.args.enable_parallel_backward_allred_opt or self._last_step:
+            if not self.args.enable_parallel_backward_allred_opt or not self._grad_buckets.enabled:
                 # flatten grads into a single buffer
 
                 self._flat_grads = self._get_flat_grads(out=None, has_grad = has_grad)
@@ -274,64 +192,19 @@ class FP16Trainer(Trainer):
                 # all-reduce flat grads
                 torch.distributed.all_reduce(self._flat_grads)
             else:
-                torch.cuda.current_stream().wait_stream(self._reduction_stream)
-                self._flat_grads = self._flat_grads_parallel
+                # norm of the flat buffer, accumulated bucket by bucket
+                grad_norm = self._grad_buckets.finish()
+                self._flat_grads = self._grad_buckets.flat_grads
 
                 if self.args.enable_parallel_backward_allred_opt_correctness_check:
-                    # # ----------------------
-                    # # option #1: send per-layer gradients
-                    # grads = self._get_grads()
-                    # offset = 0
-                    # for g in grads:
-                    #     numel = g.numel()
-                    #     out = grads[0].new(numel).zero_()
-                    #     out.copy_(g.view(-1))
-                    #     out.div_(self.args.distributed_world_size)
-                    #     torch.distributed.all_reduce(out)
-                    #     is_parallel_grads_finite = torch.all(torch.isfinite(self._flat_grads_parallel[offset:offset+numel]))
-                    #     is_out_finite = torch.all(torch.isfinite(out))
-                    #     assert(is_out_finite == is_parallel_grads_finite)
-                    #     if not is_out_finite:
-                    #         print("| OVERLAP-CHECK: check inf/nan detected. this batch should be skipped")
-                    #     else:
-                    #         if not torch.all(torch.eq(out, self._flat_grads_parallel[offset:offset+numel])):
-                    #             print(out[0:10], self._flat_grads_parallel[offset:offset+10])
-                    #             # for i,_ in enumerate(out):
-                    #             #     if out[i] != self._flat_grads_parallel[i]:
-                    #             #         print(i,out[i],self._flat_grads_parallel[i])
-                    #             raise RuntimeError('w-gradients received in parallel vs. end differ')
-                    #     offset += numel
-                    # # ----------------------
-
-                    # ----------------------
-                    # option #2: bucket all-reduce based on threshold
-                    # print(self._allreduce_schedule)
-                    out = self._get_flat_grads()
-                    out.div_(self.args.distributed_world_size)
-                    grads_size = 0
-                    for s in self._allreduce_schedule:
-                        start = s[0]
-                        end = s[1]
-                        assert(end > start)
-                        grads_size += (end - start)
-                        torch.distributed.all_reduce(out[start:end])
-                        is_parallel_grads_finite = torch.all(torch.isfinite(self._flat_grads_parallel[start:end]))
-                        is_out_finite = torch.all(torch.isfinite(out[start:end]))
-                        assert(is_out_finite == is_parallel_grads_finite)
-                        if not is_out_finite:
-                            print("| OVERLAP-CHECK: check inf/nan detected. this batch should be skipped")
-                        else:
-                            if not torch.all(torch.eq(out[start:end], self._flat_grads_parallel[start:end])):
-                                print(start, end, out[start:end], self._flat_grads_parallel[start:end])
-                                raise RuntimeError('w-gradients received in parallel vs. end differ')
-                    assert(grads_size == len(self._flat_grads_parallel))
-                    # ----------------------
+                    self._check_buckets()
         else:
             # flatten grads into a single buffer
             self._flat_grads = self._get_flat_grads(out=None, has_grad = has_grad)
 
         # rescale and clip grads
-        grad_norm = fused_norm(self._flat_grads)
+        if grad_norm is None:
+            grad_norm = fused_norm(self._flat_grads)
 
         # detect overflow and adjust loss scale
         overflow = DynamicLossScaler.has_overflow(grad_norm)
@@ -5,8 +5,11 @@
 # the root directory of this source tree. An additional grant of patent rights
 # can be found in the PATENTS file in the same directory.
 
+import collections
 import time
 
+import numpy as np
+
 
 class AverageMeter(object):
     """Computes and stores the average and current value"""
@@ -71,3 +74,21 @@ class StopwatchMeter(object):
     @property
     def avg(self):
         return self.sum / self.n
+
+
+class PercentileMeter(object):
+    """Computes percentiles of the most recent values"""
+    def __init__(self, window=10000):
+        self.window = window
+        self.reset()
+
+    def update(self, val):
+        self.values.append(val)
+
+    def reset(self):
+        self.values = collections.deque(maxlen=self.window)
+
+    def percentile(self, q):
+        if len(self.values) == 0:
+            return 0
+        return float(np.percentile(self.values, q))
@@ -381,13 +381,23 @@ class TransformerDecoder(FairseqIncrementalDecoder):
 
         if self.adaptive_softmax is None:
             # project back to size of vocabulary
-            if self.share_input_output_embed:
+            output_weight = utils.get_incremental_state(self, incremental_state, 'output_weight')
+            if output_weight is not None:
+                x = F.linear(x, output_weight)
+            elif self.share_input_output_embed:
                 x = F.linear(x, self.embed_tokens.weight)
             else:
                 x = F.linear(x, self.embed_out)
 
         return x, attn
 
+    def set_output_shortlist(self, incremental_state, shortlist):
+        """Restrict the output projection of the generation that owns
+        incremental_state to the dictionary entries in shortlist."""
+        assert self.adaptive_softmax is None, 'shortlist is not supported with adaptive softmax'
+        weight = self.embed_tokens.weight if self.share_input_output_embed else self.embed_out
+        utils.set_incremental_state(self, incremental_state, 'output_weight', weight.index_select(0, shortlist))
+
     def max_positions(self):
         """Maximum output length supported by the decoder."""
         if self.embed_positions is None:
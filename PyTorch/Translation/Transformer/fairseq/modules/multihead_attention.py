@@ -165,6 +165,10 @@ class MultiheadAttention(nn.Module):
 
     See "Attention Is All You Need" for more details.
     """
+
+    # initial number of time steps of the incremental key/value cache
+    min_cache_capacity = 64
+
     def __init__(self, embed_dim, num_heads, dropout=0., bias=False):
         super().__init__()
         self.embed_dim = embed_dim
@@ -173,6 +177,7 @@ class MultiheadAttention(nn.Module):
         self.head_dim = embed_dim // num_heads
         assert self.head_dim * num_heads == self.embed_dim, "embed_dim must be divisible by num_heads"
         self.scaling = self.head_dim**-0.5
+        self.beam_size = 1
         self._mask = None
 #        self.in_proj_weight = Parameter(torch.Tensor(3*embed_dim, embed_dim))
         self.in_proj_weight_q = Parameter(torch.Tensor(embed_dim, embed_dim))
@@ -226,14 +231,23 @@ class MultiheadAttention(nn.Module):
         assert list(query.size()) == [tgt_len, bsz, embed_dim]
         assert key.size() == value.size()
 
+        # number of consecutive batch rows (beams) that share one sentence,
+        # encoder keys/values are computed and cached only once per sentence
+        group = 1
         if incremental_state is not None:
             saved_state = self._get_input_buffer(incremental_state)
-            if 'prev_key' in saved_state:
-                # previous time steps are cached - no need to recompute
-                # key and value if they are static
-                if static_kv:
+            if static_kv:
+                if 'prev_key' in saved_state:
+                    # previous time steps are cached - no need to recompute
+                    # key and value if they are static
                     assert kv_same and not qkv_same
                     key = value = None
+                    group = saved_state['group']
+                elif self.beam_size > 1 and bsz % self.beam_size == 0:
+                    group = self.beam_size
+                    key = value = key[:, ::group].contiguous()
+                if key_padding_mask is not None and group > 1:
+                    key_padding_mask = key_padding_mask[::group]
         else:
             saved_state = None
 
@@ -263,26 +277,37 @@ class MultiheadAttention(nn.Module):
                 v = F.linear(value, self.in_proj_weight_v, self.in_proj_bias_v)
 
         if saved_state is not None:
-            if 'prev_key' in saved_state:
-                k = torch.cat((saved_state['prev_key'], k), dim=0)
-            if 'prev_value' in saved_state:
-                v = torch.cat((saved_state['prev_value'], v), dim=0)
-            saved_state['prev_key'] = k
-            saved_state['prev_value'] = v
+            if not static_kv:
+                k, v = self._append_to_cache(saved_state, k, v)
+            elif 'prev_key' in saved_state:
+                k = saved_state['prev_key']
+                v = saved_state['prev_value']
+            else:
+                saved_state['prev_key'] = k
+                saved_state['prev_value'] = v
+                saved_state['group'] = group
             self._set_input_buffer(incremental_state, saved_state)
 
         src_len = k.size(0)
+        # rows of the attention batch: one per sentence (and head); the
+        # queries of all beams of a sentence are attended together
+        attn_bsz = bsz // group
+        attn_len = group * tgt_len
 
         if key_padding_mask is not None:
-            assert key_padding_mask.size(0) == bsz
+            assert key_padding_mask.size(0) == attn_bsz
             assert key_padding_mask.size(1) == src_len
 
-        q = q.contiguous().view(tgt_len, bsz*self.num_heads, self.head_dim).transpose(0, 1)
-        k = k.contiguous().view(src_len, bsz*self.num_heads, self.head_dim).transpose(0, 1)
-        v = v.contiguous().view(src_len, bsz*self.num_heads, self.head_dim).transpose(0, 1)
+        if group > 1:
+            q = q.contiguous().view(tgt_len, attn_bsz, group, self.num_heads, self.head_dim)
+            q = q.permute(1, 3, 2, 0, 4).contiguous().view(attn_bsz*self.num_heads, attn_len, self.head_dim)
+        else:
+            q = q.contiguous().view(tgt_len, bsz*self.num_heads, self.head_dim).transpose(0, 1)
+        k = k.contiguous().view(src_len, attn_bsz*self.num_heads, self.head_dim).transpose(0, 1)
+        v = v.contiguous().view(src_len, attn_bsz*self.num_heads, self.head_dim).transpose(0, 1)
 
         attn_weights = strided_bmm1(q, k.transpose(1, 2))
-        assert list(attn_weights.size()) == [bsz * self.num_heads, tgt_len, src_len]
+        assert list(attn_weights.size()) == [attn_bsz * self.num_heads, attn_len, src_len]
 
         # only apply masking at training time (when incremental state is None)
         if mask_future_timesteps and incremental_state is None:
@@ -291,23 +316,28 @@ class MultiheadAttention(nn.Module):
             attn_weights += self.buffered_mask(attn_weights).unsqueeze(0)
         if key_padding_mask is not None:
             # don't attend to padding symbols
-            attn_weights = attn_weights.view(bsz, self.num_heads, tgt_len, src_len)
+            attn_weights = attn_weights.view(attn_bsz, self.num_heads, attn_len, src_len)
             attn_weights = attn_weights.float().masked_fill(
                 key_padding_mask.unsqueeze(1).unsqueeze(2),
                 float('-inf'),
             ).type_as(attn_weights)  # FP16 support: cast to float and back
-            attn_weights = attn_weights.view(bsz * self.num_heads, tgt_len, src_len)
+            attn_weights = attn_weights.view(attn_bsz * self.num_heads, attn_len, src_len)
         attn_weights = F.softmax(attn_weights, dim=-1)
         attn_weights = F.dropout(attn_weights, p=self.dropout, training=self.training)
         attn = strided_bmm2(attn_weights, v)
-        assert list(attn.size()) == [bsz * self.num_heads, tgt_len, self.head_dim]
-        attn = attn.transpose(0, 1).contiguous().view(tgt_len, bsz, embed_dim)
+        assert list(attn.size()) == [attn_bsz * self.num_heads, attn_len, self.head_dim]
+        if group > 1:
+            attn = attn.transpose(0, 1).contiguous().view(group, tgt_len, attn_bsz, embed_dim)
+            attn = attn.permute(1, 2, 0, 3).contiguous().view(tgt_len, bsz, embed_dim)
+        else:
+            attn = attn.transpose(0, 1).contiguous().view(tgt_len, bsz, embed_dim)
         attn = self.out_proj(attn)
 
         if need_weights:
             # average attention weights over heads
-            attn_weights = attn_weights.view(bsz, self.num_heads, tgt_len, src_len)
+            attn_weights = attn_weights.view(attn_bsz, self.num_heads, attn_len, src_len)
             attn_weights = attn_weights.sum(dim=1) / self.num_heads
+            attn_weights = attn_weights.view(bsz, tgt_len, src_len)
         else:
             attn_weights = None
 
@@ -349,12 +379,56 @@ class MultiheadAttention(nn.Module):
             self._mask = torch.triu(utils.fill_with_neg_inf(self._mask.resize_(dim, dim)), 1)
         return self._mask[:dim, :dim]
 
+    def _append_to_cache(self, saved_state, k, v):
+        """Write the keys/values of the new time steps into the preallocated
+        cache in place and return views of all cached time steps.
+
+        The cache grows by doubling, so a length T generation copies O(T)
+        data instead of the O(T^2) of concatenating at every step.
+        """
+        start = saved_state.get('cache_len', 0)
+        end = start + k.size(0)
+        if 'prev_key' not in saved_state or end > saved_state['prev_key'].size(0):
+            capacity = max(end, 2 * start, self.min_cache_capacity)
+            for name, x in (('prev_key', k), ('prev_value', v)):
+                buf = x.new_empty((capacity,) + x.size()[1:])
+                if start > 0:
+                    buf[:start] = saved_state[name][:start]
+                saved_state[name] = buf
+                saved_state.pop(name + '_spare', None)
+        saved_state['prev_key'][start:end] = k
+        saved_state['prev_value'][start:end] = v
+        saved_state['cache_len'] = end
+        return saved_state['prev_key'][:end], saved_state['prev_value'][:end]
+
+    def set_beam_size(self, beam_size):
+        self.beam_size = beam_size
+
     def reorder_incremental_state(self, incremental_state, new_order):
         """Reorder buffered internal state (for incremental generation)."""
         input_buffer = self._get_input_buffer(incremental_state)
-        if input_buffer is not None:
-            for k in input_buffer.keys():
-                input_buffer[k] = input_buffer[k].index_select(1, new_order)
+        if 'cache_len' in input_buffer:
+            # gather the filled part of the cache into a spare buffer and
+            # swap the two, instead of allocating a new cache every step
+            end = input_buffer['cache_len']
+            for name in ('prev_key', 'prev_value'):
+                buf = input_buffer[name]
+                spare = input_buffer.get(name + '_spare')
+                if spare is None or spare.size(1) != new_order.numel():
+                    spare = buf.new_empty((buf.size(0), new_order.numel(), buf.size(2)))
+                torch.index_select(buf[:end], 1, new_order, out=spare[:end])
+                input_buffer[name], input_buffer[name + '_spare'] = spare, buf
+            self._set_input_buffer(incremental_state, input_buffer)
+        elif 'prev_key' in input_buffer:
+            # static (encoder) keys/values are identical for all beams of a
+            # sentence, they only change when finished sentences are dropped
+            group = input_buffer['group']
+            if group > 1:
+                if new_order.numel() == input_buffer['prev_key'].size(1) * group:
+                    return
+                new_order = new_order.view(-1, group)[:, 0] // group
+            for name in ('prev_key', 'prev_value'):
+                input_buffer[name] = input_buffer[name].index_select(1, new_order)
             self._set_input_buffer(incremental_state, input_buffer)
 
     def _get_input_buffer(self, incremental_state):
@@ -205,6 +205,9 @@ def add_distributed_training_args(parser):
                        help='port number (not required if using --distributed-init-method)')
     group.add_argument('--device-id', default=0, type=int,
                        help='which GPU to use (usually configured automatically)')
+    group.add_argument('--fast-stat-sync', action='store_true',
+                       help='sum the logging outputs of all workers with a single all_reduce '
+                            'instead of gathering them (the criterion must aggregate them by summing)')
     return group
 
 
@@ -252,6 +255,9 @@ def add_optimization_args(parser):
                        help='enable all reduce of w-gradients in parallel with backward propagation (only for FP16 training)')
     group.add_argument('--parallel-backward-allred-opt-threshold', type=int, default=0, metavar='N',
                        help='min num of contiguous gradient elements before all-reduce is triggered')
+    group.add_argument('--allreduce-bucket-mb', type=float, default=0, metavar='MB',
+                       help='size of the gradient buckets all-reduced during backward, in MB '
+                            '(overrides --parallel-backward-allred-opt-threshold)')
     group.add_argument('--enable-parallel-backward-allred-opt-correctness-check', action='store_true',
                        help='compare w-gradient values obtained doing all-reduce in parallel vs. at the end')
 
@@ -294,6 +300,10 @@ def add_eval_lm_args(parser):
     add_common_eval_args(group)
     group.add_argument('--output-word-probs', action='store_true',
                        help='if set, outputs words and their predicted log probabilities to standard output')
+    group.add_argument('--stride', default=0, type=int, metavar='N',
+                       help='if set, score the split as one stream with overlapping windows of '
+                            'tokens-per-sample tokens, N tokens apart, scoring only the last N '
+                            'tokens of every window')
 
 
 def add_generation_args(parser):
@@ -345,6 +355,14 @@ def add_generation_args(parser):
                        help='ignore case druing online eval')
     group.add_argument('--bpe-codes', default=None, type=str, metavar='CODES',
                         help='file with bpe codes')
+    group.add_argument('--shortlist', default=None, type=str, metavar='FILE',
+                       help='restrict the output vocabulary of every batch to the lexical translations '
+                            'of its source tokens and the most frequent target tokens, read from this '
+                            'file (see scripts/build_shortlist.py)')
+    group.add_argument('--benchmark-lengths', default=None, type=str, metavar='LENS',
+                       help='comma separated list of output lengths; instead of translating the '
+                            'dataset, report generation speed (tokens/s) on its first batch with '
+                            'the output forced to each of these lengths')
     return group
 
 
@@ -352,6 +370,13 @@ def add_interactive_args(parser):
     group = parser.add_argument_group('Interactive')
     group.add_argument('--buffer-size', default=0, type=int, metavar='N',
                        help='read this many sentences into a buffer before processing them')
+    group.add_argument('--port', default=None, type=int, metavar='N',
+                       help='serve translations over HTTP on this port instead of reading stdin')
+    group.add_argument('--host', default='localhost', metavar='HOST',
+                       help='address the translation server listens on')
+    group.add_argument('--batch-timeout', default=10, type=float, metavar='MS',
+                       help='max time (in ms) a sentence sent to the server waits for its batch '
+                            'to fill up to --max-tokens/--max-sentences')
 
 
 def add_model_args(parser):
@@ -32,7 +32,7 @@ class SequenceGenerator(object):
     def __init__(
         self, models, tgt_dict, beam_size=1, minlen=1, maxlen=None, stop_early=True,
         normalize_scores=True, len_penalty=1, unk_penalty=0, retain_dropout=False,
-        sampling=False, sampling_topk=-1, sampling_temperature=1,
+        sampling=False, sampling_topk=-1, sampling_temperature=1, shortlist=None,
     ):
         """Generates translations of a given source sentence.
         Args:
@@ -42,6 +42,8 @@ class SequenceGenerator(object):
                 hypotheses, even though longer hypotheses might have better
                 normalized scores.
             normalize_scores: Normalize scores by the length of the output.
+            shortlist: restrict the output vocabulary of every batch to the
+                candidates of this fairseq.shortlist.Shortlist
         """
         self.models = models
         self.pad = tgt_dict.pad()
@@ -61,10 +63,13 @@ class SequenceGenerator(object):
         self.sampling = sampling
         self.sampling_topk = sampling_topk
         self.sampling_temperature = sampling_temperature
+        self.shortlist = shortlist
 
     def cuda(self):
         for model in self.models:
             model.cuda()
+        if self.shortlist is not None:
+            self.shortlist.cuda()
         return self
 
     def generate_batched_itr(
@@ -114,9 +119,21 @@ class SequenceGenerator(object):
         bsz, srclen = src_tokens.size()
         maxlen = min(maxlen, self.maxlen) if maxlen is not None else self.maxlen
 
+        # scores are computed only for the shortlisted part of the vocabulary,
+        # candidates are positions in the shortlist until mapped back below
+        shortlist = None
+        vocab_size = self.vocab_size
+        if self.shortlist is not None:
+            shortlist = self.shortlist.candidates(src_tokens, prefix_tokens)
+            vocab_size = shortlist.numel()
+            if prefix_tokens is not None:
+                position = shortlist.new_zeros(self.vocab_size)
+                position[shortlist] = torch.arange(0, vocab_size).type_as(shortlist)
+                prefix_tokens = position[prefix_tokens]
+
         # the max beam size is the dictionary size - 1, since we never select pad
         beam_size = beam_size if beam_size is not None else self.beam_size
-        beam_size = min(beam_size, self.vocab_size - 1)
+        beam_size = min(beam_size, vocab_size - 1)
 
         encoder_outs = []
         incremental_states = {}
@@ -125,7 +142,11 @@ class SequenceGenerator(object):
                 model.eval()
             if isinstance(model.decoder, FairseqIncrementalDecoder):
                 incremental_states[model] = {}
+                model.decoder.set_beam_size(beam_size)
+                if shortlist is not None:
+                    model.decoder.set_output_shortlist(incremental_states[model], shortlist)
             else:
+                assert shortlist is None, 'shortlist requires incremental decoders'
                 incremental_states[model] = None
 
             # compute the encoder output for each beam
@@ -144,10 +165,21 @@ class SequenceGenerator(object):
         attn, attn_buf = None, None
         nonpad_idxs = None
 
-        # list of completed sentences
-        finalized = [[] for i in range(bsz)]
-        finished = [False for i in range(bsz)]
-        worst_finalized = [{'idx': None, 'score': -math.inf} for i in range(bsz)]
+        # finalized hypotheses, stored on the device in preallocated buffers
+        # indexed by [sentence, slot]; row bsz is a scratch row that absorbs
+        # the writes of hypotheses that are dropped
+        fin_tokens = tokens.new(bsz + 1, beam_size, maxlen + 1).fill_(self.pad)
+        fin_pos_scores = scores.new(bsz + 1, beam_size, maxlen + 1).fill_(0)
+        fin_scores = scores.new(bsz + 1, beam_size).fill_(-math.inf)
+        fin_lens = tokens.new(bsz + 1, beam_size).fill_(0)
+        fin_attn = None
+        num_finalized = tokens.new(bsz + 1).fill_(0)
+        worst_finalized_score = scores.new(bsz + 1).fill_(-math.inf)
+        worst_finalized_idx = tokens.new(bsz + 1).fill_(-1)
+        scratch = tokens.new(1).fill_(bsz)
+        slot_range = torch.arange(0, beam_size).type_as(tokens)
+        # original sentence index of each row of the shrinking batch
+        sent_ids = torch.arange(0, bsz).type_as(tokens)
         num_remaining_sent = bsz
 
         # number of candidate hypos per step
@@ -165,24 +197,29 @@ class SequenceGenerator(object):
                 buffers[name] = type_of.new()
             return buffers[name]
 
-        def is_finished(sent, step, unfinalized_scores=None):
+        def is_finished(step, sents, unfinalized_scores=None):
             """
-            Check whether we've finished generation for a given sentence, by
-            comparing the worst score among finalized hypotheses to the best
-            possible score among unfinalized hypotheses.
+            Check whether we've finished generation for the given rows of the
+            batch, by comparing the worst score among finalized hypotheses to
+            the best possible score among unfinalized hypotheses.
             """
-            assert len(finalized[sent]) <= beam_size
-            if len(finalized[sent]) == beam_size:
-                if self.stop_early or step == maxlen or unfinalized_scores is None:
-                    return True
+            done = num_finalized[sent_ids].eq(beam_size)
+            if not (self.stop_early or step == maxlen or unfinalized_scores is None):
                 # stop if the best unfinalized score is worse than the worst
                 # finalized one
-                best_unfinalized_score = unfinalized_scores[sent].max()
+                best_unfinalized_score = unfinalized_scores.view(sent_ids.numel(), -1).max(dim=1)[0]
                 if self.normalize_scores:
                     best_unfinalized_score /= maxlen ** self.len_penalty
-                if worst_finalized[sent]['score'] >= best_unfinalized_score:
-                    return True
-            return False
+                done &= worst_finalized_score[sent_ids].ge(best_unfinalized_score.type_as(worst_finalized_score))
+            return (done & sents).nonzero().squeeze(-1)
+
+        def store_hypos(sent, slot, tokens_clone, pos_scores, eos_scores, attn_clone):
+            fin_tokens[sent, slot, :tokens_clone.size(1)] = tokens_clone
+            fin_pos_scores[sent, slot, :pos_scores.size(1)] = pos_scores
+            fin_scores[sent, slot] = eos_scores
+            fin_lens[sent, slot] = tokens_clone.size(1)
+            if attn_clone is not None:
+                fin_attn[sent, slot, :, :attn_clone.size(2)] = attn_clone
 
         def finalize_hypos(step, bbsz_idx, eos_scores, unfinalized_scores=None):
             """
@@ -199,7 +236,10 @@ class SequenceGenerator(object):
                     scores for each hypothesis
                 unfinalized_scores: A vector containing scores for all
                     unfinalized hypotheses
+            Returns:
+                A vector with the rows of the batch whose sentences are finished.
             """
+            nonlocal fin_attn
             assert bbsz_idx.numel() == eos_scores.numel()
 
             # clone relevant token and attention tensors
@@ -207,6 +247,8 @@ class SequenceGenerator(object):
             tokens_clone = tokens_clone[:, 1:step + 2]  # skip the first index, which is EOS
             tokens_clone[:, step] = self.eos
             attn_clone = attn.index_select(0, bbsz_idx)[:, :, 1:step+2] if attn is not None else None
+            if attn is not None and fin_attn is None:
+                fin_attn = attn.new(fin_scores.size(0), beam_size, attn.size(1), maxlen + 1).fill_(0)
 
             # compute scores per token position
             pos_scores = scores.index_select(0, bbsz_idx)[:, :step+1]
@@ -217,62 +259,62 @@ class SequenceGenerator(object):
             # normalize sentence-level scores
             if self.normalize_scores:
                 eos_scores /= (step + 1) ** self.len_penalty
-
-            cum_unfin = []
-            prev = 0
-            for f in finished:
-                if f:
-                    prev += 1
-                else:
-                    cum_unfin.append(prev)
-
-            sents_seen = set()
-            for i, (idx, score) in enumerate(zip(bbsz_idx.tolist(), eos_scores.tolist())):
-                unfin_idx = idx // beam_size
-                sent = unfin_idx + cum_unfin[unfin_idx]
-
-                sents_seen.add((sent, unfin_idx))
-
-                def get_hypo():
-
-                    if attn_clone is not None:
-                        # remove padding tokens from attn scores
-                        hypo_attn = attn_clone[i][nonpad_idxs[sent]]
-                        _, alignment = hypo_attn.max(dim=0)
-                    else:
-                        hypo_attn = None
-                        alignment = None
-
-                    return {
-                        'tokens': tokens_clone[i],
-                        'score': score,
-                        'attention': hypo_attn,  # src_len x tgt_len
-                        'alignment': alignment,
-                        'positional_scores': pos_scores[i],
-                    }
-
-                if len(finalized[sent]) < beam_size:
-                    finalized[sent].append(get_hypo())
-                elif not self.stop_early and score > worst_finalized[sent]['score']:
-                    # replace worst hypo for this sentence with new/better one
-                    worst_idx = worst_finalized[sent]['idx']
-                    if worst_idx is not None:
-                        finalized[sent][worst_idx] = get_hypo()
-
-                    # find new worst finalized hypo for this sentence
-                    idx, s = min(enumerate(finalized[sent]), key=lambda r: r[1]['score'])
-                    worst_finalized[sent] = {
-                        'score': s['score'],
-                        'idx': idx,
-                    }
-
-            newly_finished = []
-            for sent, unfin_idx in sents_seen:
-                # check termination conditions for this sentence
-                if not finished[sent] and is_finished(sent, step, unfinalized_scores):
-                    finished[sent] = True
-                    newly_finished.append(unfin_idx)
-            return newly_finished
+            eos_scores = eos_scores.type_as(fin_scores)
+            pos_scores = pos_scores.type_as(fin_pos_scores)
+
+            # rank of each hypothesis among the ones of the same sentence, in
+            # finalization order
+            num_hypos = bbsz_idx.numel()
+            unfin_idx = bbsz_idx // beam_size
+            hypo_range = torch.arange(0, num_hypos).type_as(bbsz_idx)
+            _, by_sent = (unfin_idx * num_hypos + hypo_range).sort()
+            counts = torch.bincount(unfin_idx, minlength=sent_ids.numel())
+            first = counts.cumsum(0) - counts
+            rank = torch.empty_like(unfin_idx)
+            rank[by_sent] = hypo_range - first[unfin_idx[by_sent]]
+            sent = sent_ids[unfin_idx]
+
+            if self.stop_early:
+                # the first hypotheses of a sentence fill its free slots, the
+                # rest are dropped
+                slot = num_finalized[sent] + rank
+                keep = slot.lt(beam_size)
+                num_finalized.index_add_(0, sent, keep.type_as(num_finalized))
+                store_hypos(
+                    torch.where(keep, sent, scratch), torch.where(keep, slot, slot.new_zeros(1)),
+                    tokens_clone, pos_scores, eos_scores, attn_clone,
+                )
+            else:
+                # hypotheses of a sentence are added one at a time, replacing
+                # the worst finalized one once all slots are taken, so process
+                # them in rounds by rank, each round in parallel over sentences
+                for r in range(beam_size):
+                    active = rank.eq(r)
+                    count = num_finalized[sent]
+                    append = active & count.lt(beam_size)
+                    replace = active & count.ge(beam_size) & eos_scores.gt(worst_finalized_score[sent])
+                    worst_idx = worst_finalized_idx[sent]
+                    write = append | (replace & worst_idx.ge(0))
+                    store_hypos(
+                        torch.where(write, sent, scratch),
+                        torch.where(append, count, worst_idx.clamp(min=0)),
+                        tokens_clone, pos_scores, eos_scores, attn_clone,
+                    )
+                    num_finalized.index_add_(0, sent, append.type_as(num_finalized))
+
+                    # find new worst finalized hypo for the updated sentences
+                    worst_score, _ = fin_scores[sent].min(dim=1)
+                    worst_idx = torch.where(
+                        fin_scores[sent].eq(worst_score.unsqueeze(1)),
+                        slot_range, slot_range.new_full((1,), beam_size),
+                    ).min(dim=1)[0]
+                    replaced = torch.where(replace, sent, scratch)
+                    worst_finalized_score[replaced] = worst_score
+                    worst_finalized_idx[replaced] = worst_idx
+
+            sents_seen = unfin_idx.new_zeros(sent_ids.numel()).index_fill_(0, unfin_idx, 1).eq(1)
+            # check termination conditions for these sentences
+            return is_finished(step, sents_seen, unfinalized_scores)
 
         reorder_state = None
         batch_idxs = None
@@ -338,7 +380,7 @@ class SequenceGenerator(object):
                         torch.gather(indices, dim=1, index=cand_indices, out=cand_indices)
                         cand_indices.add_(2)
                     else:
-                        exp_probs = probs.div_(self.sampling_temperature).exp_().view(-1, self.vocab_size)
+                        exp_probs = probs.div_(self.sampling_temperature).exp_().view(-1, vocab_size)
 
                         if step == 0:
                             # we exclude the first two vocab items, one of which is pad
@@ -371,8 +413,8 @@ class SequenceGenerator(object):
                         k=min(cand_size, probs.view(bsz, -1).size(1) - 1),  # -1 so we never select pad
                         out=(cand_scores, cand_indices),
                     )
-                    torch.div(cand_indices, self.vocab_size, out=cand_beams)
-                    cand_indices.fmod_(self.vocab_size)
+                    torch.div(cand_indices, vocab_size, out=cand_beams)
+                    cand_indices.fmod_(vocab_size)
             else:
                 # finalize all active hypotheses once we hit maxlen
                 # pick the hypothesis with the highest prob of EOS right now
@@ -381,11 +423,15 @@ class SequenceGenerator(object):
                     descending=True,
                     out=(eos_scores, eos_bbsz_idx),
                 )
-                num_remaining_sent -= len(finalize_hypos(
-                    step, eos_bbsz_idx, eos_scores))
+                num_remaining_sent -= finalize_hypos(
+                    step, eos_bbsz_idx, eos_scores).numel()
                 assert num_remaining_sent == 0
                 break
 
+            if shortlist is not None:
+                # map positions in the shortlist back to dictionary indices
+                cand_indices = shortlist[cand_indices]
+
             # cand_bbsz_idx contains beam indices for the top candidate
             # hypotheses, with a range of values: [0, bsz*beam_size),
             # and dimensions: [bsz, cand_size]
@@ -394,7 +440,7 @@ class SequenceGenerator(object):
             # finalize hypotheses that end in eos
             eos_mask = cand_indices.eq(self.eos)
 
-            finalized_sents = set()
+            finalized_sents = None
             if step >= self.minlen:
                 # only consider eos when it's among the top beam_size indices
                 torch.masked_select(
@@ -410,20 +456,21 @@ class SequenceGenerator(object):
                     )
                     finalized_sents = finalize_hypos(
                         step, eos_bbsz_idx, eos_scores, cand_scores)
-                    num_remaining_sent -= len(finalized_sents)
+                    num_remaining_sent -= finalized_sents.numel()
 
             assert num_remaining_sent >= 0
             if num_remaining_sent == 0:
                 break
             assert step < maxlen
 
-            if len(finalized_sents) > 0:
-                new_bsz = bsz - len(finalized_sents)
+            if finalized_sents is not None and finalized_sents.numel() > 0:
+                new_bsz = bsz - finalized_sents.numel()
 
                 # construct batch_idxs which holds indices of batches to keep for the next pass
                 batch_mask = torch.ones(bsz).type_as(cand_indices)
-                batch_mask[cand_indices.new(finalized_sents)] = 0
+                batch_mask[finalized_sents] = 0
                 batch_idxs = batch_mask.nonzero().squeeze(-1)
+                sent_ids = sent_ids[batch_idxs]
 
                 eos_mask = eos_mask[batch_idxs]
                 cand_beams = cand_beams[batch_idxs]
@@ -511,9 +558,37 @@ class SequenceGenerator(object):
             # reorder incremental state in decoder
             reorder_state = active_bbsz_idx
 
-        # sort by score descending
-        for sent in range(len(finalized)):
-            finalized[sent] = sorted(finalized[sent], key=lambda r: r['score'], reverse=True)
+        # move the finalized hypotheses to the host at once
+        num_finalized = num_finalized.tolist()
+        fin_scores = fin_scores.tolist()
+        fin_lens = fin_lens.tolist()
+        fin_tokens = fin_tokens.cpu()
+        fin_pos_scores = fin_pos_scores.cpu()
+        if fin_attn is not None:
+            fin_attn = fin_attn.cpu()
+            nonpad_idxs = nonpad_idxs.cpu()
+
+        finalized = []
+        for sent in range(len(num_finalized) - 1):
+            hypos = []
+            for i in range(num_finalized[sent]):
+                length = fin_lens[sent][i]
+                if fin_attn is not None:
+                    # remove padding tokens from attn scores
+                    hypo_attn = fin_attn[sent, i][nonpad_idxs[sent]][:, :length]
+                    _, alignment = hypo_attn.max(dim=0)
+                else:
+                    hypo_attn = None
+                    alignment = None
+                hypos.append({
+                    'tokens': fin_tokens[sent, i, :length],
+                    'score': fin_scores[sent][i],
+                    'attention': hypo_attn,  # src_len x tgt_len
+                    'alignment': alignment,
+                    'positional_scores': fin_pos_scores[sent, i, :length],
+                })
+            # sort by score descending
+            finalized.append(sorted(hypos, key=lambda r: r['score'], reverse=True))
 
         return finalized
 
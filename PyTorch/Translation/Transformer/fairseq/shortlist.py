@@ -0,0 +1,144 @@
+# Copyright (c) 2019, NVIDIA CORPORATION. All rights reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import torch
+
+
+class Shortlist(object):
+    """Candidate target vocabulary for a batch of source sentences.
+
+    The candidates are the union of the lexical translations of all source
+    tokens in the batch, the most frequent target tokens and the special
+    symbols. Since the special symbols are the first entries of the
+    dictionary and the candidates are sorted, their position in the
+    shortlist equals their index in the dictionary.
+
+    Args:
+        table: LongTensor of size src_vocab x k with the k most likely
+            target translations of every source token
+        frequent: LongTensor with the most frequent target tokens
+        tgt_vocab_size: size of the target dictionary
+        nspecial: number of special symbols of the target dictionary
+    """
+
+    def __init__(self, table, frequent, tgt_vocab_size, nspecial):
+        self.table = table
+        self.frequent = frequent
+        self.tgt_vocab_size = tgt_vocab_size
+        self.nspecial = nspecial
+
+    @classmethod
+    def load(cls, path):
+        state = torch.load(path)
+        return cls(state['table'], state['frequent'], state['tgt_vocab_size'], state['nspecial'])
+
+    def save(self, path):
+        torch.save({
+            'table': self.table,
+            'frequent': self.frequent,
+            'tgt_vocab_size': self.tgt_vocab_size,
+            'nspecial': self.nspecial,
+        }, path)
+
+    def cuda(self):
+        self.table = self.table.cuda()
+        self.frequent = self.frequent.cuda()
+        return self
+
+    def candidates(self, src_tokens, extra_tokens=None):
+        """Return the sorted target indices allowed for a batch.
+
+        Args:
+            src_tokens: source tokens of the batch
+            extra_tokens: target tokens that must be in the shortlist, e.g.
+                a forced prefix
+        """
+        mask = src_tokens.new_zeros(self.tgt_vocab_size)
+        mask[:self.nspecial] = 1
+        mask[self.frequent] = 1
+        mask[self.table.index_select(0, src_tokens.view(-1)).view(-1)] = 1
+        if extra_tokens is not None:
+            mask[extra_tokens.contiguous().view(-1)] = 1
+        return mask.nonzero().squeeze(-1)
+
+    @classmethod
+    def build(cls, src_sents, tgt_sents, src_vocab_size, tgt_vocab_size, nspecial,
+              topk=50, num_frequent=2000, max_pairs=50000000, chunk_size=100000):
+        """Build a shortlist from a sentence aligned bitext.
+
+        Source and target tokens are paired by sentence co-occurrence and the
+        pairs are scored with the Dice coefficient. Only the pairs with the
+        highest counts are kept in memory: whenever there are more than
+        *max_pairs* distinct pairs, all but the *max_pairs / 2* most frequent
+        ones are dropped.
+
+        Args:
+            src_sents, tgt_sents: iterables of 1D integer arrays with the
+                token indices of each sentence
+            topk: number of translations kept per source token
+            num_frequent: number of most frequent target tokens that are
+                always part of the shortlist
+        """
+        src_df = np.zeros(src_vocab_size, dtype=np.int64)
+        tgt_df = np.zeros(tgt_vocab_size, dtype=np.int64)
+        tgt_count = np.zeros(tgt_vocab_size, dtype=np.int64)
+        pair_keys = np.zeros(0, dtype=np.int64)
+        pair_counts = np.zeros(0, dtype=np.int64)
+
+        def merge(chunk):
+            nonlocal pair_keys, pair_counts
+            keys, inverse = np.unique(
+                np.concatenate([pair_keys] + chunk), return_inverse=True)
+            weights = np.concatenate(
+                [pair_counts, np.ones(len(inverse) - len(pair_counts), dtype=np.int64)])
+            counts = np.bincount(inverse, weights=weights).astype(np.int64)
+            if len(keys) > max_pairs:
+                keep = np.sort(np.argpartition(-counts, max_pairs // 2)[:max_pairs // 2])
+                keys, counts = keys[keep], counts[keep]
+            pair_keys, pair_counts = keys, counts
+
+        chunk = []
+        for src, tgt in zip(src_sents, tgt_sents):
+            src = np.asarray(src)
+            tgt = np.asarray(tgt)
+            np.add.at(tgt_count, tgt, 1)
+            src = np.unique(src[src >= nspecial])
+            tgt = np.unique(tgt[tgt >= nspecial])
+            src_df[src] += 1
+            tgt_df[tgt] += 1
+            chunk.append((src[:, None] * tgt_vocab_size + tgt[None, :]).ravel())
+            if len(chunk) == chunk_size:
+                merge(chunk)
+                chunk = []
+        if chunk:
+            merge(chunk)
+
+        src_ids = pair_keys // tgt_vocab_size
+        tgt_ids = pair_keys % tgt_vocab_size
+        dice = 2. * pair_counts / (src_df[src_ids] + tgt_df[tgt_ids])
+
+        # k best translations of every source token
+        order = np.lexsort((-dice, src_ids))
+        src_ids, tgt_ids = src_ids[order], tgt_ids[order]
+        first = np.searchsorted(src_ids, src_ids)
+        rank = np.arange(len(src_ids)) - first
+        keep = rank < topk
+        table = np.zeros((src_vocab_size, topk), dtype=np.int64)
+        table[src_ids[keep], rank[keep]] = tgt_ids[keep]
+
+        tgt_count[:nspecial] = 0
+        frequent = np.argsort(-tgt_count, kind='mergesort')[:num_frequent]
+        frequent = frequent[tgt_count[frequent] > 0]
+
+        return cls(torch.from_numpy(table), torch.from_numpy(frequent), tgt_vocab_size, nspecial)
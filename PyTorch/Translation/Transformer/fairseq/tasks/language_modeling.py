@@ -24,10 +24,12 @@ import itertools
 import numpy as np
 import os
 
+import torch
 from torch.utils.data import ConcatDataset
 
+from fairseq import distributed_utils
 from fairseq.data import (
-    Dictionary, IndexedInMemoryDataset, IndexedRawTextDataset,
+    Dictionary, IndexedInMemoryDataset, IndexedMMapDataset, IndexedRawTextDataset,
     MonolingualDataset, TokenBlockDataset,
 )
 
@@ -51,6 +53,11 @@ class LanguageModelingTask(FairseqTask):
                             help='max number of tokens per sample for LM dataset')
         parser.add_argument('--raw-text', default=False, action='store_true',
                             help='load raw text dataset')
+        parser.add_argument('--mmap-dataset', default=False, action='store_true',
+                            help='memory-map the binarized dataset instead of reading it into memory')
+        parser.add_argument('--cache-token-blocks', default=False, action='store_true',
+                            help='save the sample boundaries next to the binarized dataset and reuse '
+                                 'them in later runs and other workers')
 
     def __init__(self, args, dictionary):
         super().__init__(args)
@@ -62,6 +69,12 @@ class LanguageModelingTask(FairseqTask):
         print('| dictionary: {} types'.format(len(dictionary)))
         return cls(args, dictionary)
 
+    def _is_distributed(self):
+        return getattr(self.args, 'distributed_world_size', 1) > 1 and torch.distributed.is_initialized()
+
+    def _builds_cache(self):
+        return not self._is_distributed() or distributed_utils.is_master(self.args)
+
     def load_dataset(self, split, combine=False):
         """Load a dataset split."""
 
@@ -71,23 +84,41 @@ class LanguageModelingTask(FairseqTask):
             split_k = split + (str(k) if k > 0 else '')
             path = os.path.join(self.args.data, split_k)
 
+            fix_lua_indexing = False
+            cache_path = None
             if self.args.raw_text and IndexedRawTextDataset.exists(path):
                 ds = IndexedRawTextDataset(path, self.dictionary)
                 tokens = [t for l in ds.tokens_list for t in l]
             elif not self.args.raw_text and IndexedInMemoryDataset.exists(path):
-                ds = IndexedInMemoryDataset(path, fix_lua_indexing=True)
+                if getattr(self.args, 'mmap_dataset', False):
+                    ds = IndexedMMapDataset(path, fix_lua_indexing=True)
+                    fix_lua_indexing = True
+                else:
+                    ds = IndexedInMemoryDataset(path, fix_lua_indexing=True)
                 tokens = ds.buffer
+                if getattr(self.args, 'cache_token_blocks', False):
+                    cache_path = '{}.{}_{}.blocks.npy'.format(
+                        path, self.args.sample_break_mode or 'none', self.args.tokens_per_sample)
+                    if self._builds_cache() and os.path.exists(cache_path) and \
+                            os.path.getmtime(cache_path) < os.path.getmtime(path + '.idx'):
+                        os.remove(cache_path)  # stale, the dataset has been rebuilt
             else:
                 if k > 0:
                     break
                 else:
                     raise FileNotFoundError('Dataset not found: {} ({})'.format(split, self.args.data))
 
+            # the master builds the cache, the other workers load it once it is written
+            wait_for_cache = cache_path is not None and self._is_distributed()
+            if wait_for_cache and not self._builds_cache():
+                torch.distributed.barrier()
             loaded_datasets.append(
                 TokenBlockDataset(
                     tokens, ds.sizes, self.args.tokens_per_sample, self.args.sample_break_mode,
-                    include_targets=True
+                    include_targets=True, fix_lua_indexing=fix_lua_indexing, cache_path=cache_path,
                 ))
+            if wait_for_cache and self._builds_cache():
+                torch.distributed.barrier()
 
             print('| {} {} {} examples'.format(self.args.data, split_k, len(loaded_datasets[-1])))
 
@@ -73,12 +73,14 @@ class Trainer(object):
         self.meters['wall'] = TimeMeter()      # wall time in seconds
 
         self._buffered_stats = defaultdict(lambda: [])
+        self._stat_keys = None
         self._flat_grads = None
         self._num_updates = 0
         self._optim_history = None
         self._optimizer = None
 
         self._last_step = False
+        self._update_params = True
         if self.args.enable_parallel_backward_allred_opt and not self.args.distributed_world_size > 1:
             raise RuntimeError('--enable-parallel-backward-allred-opt is only meant for distributed training')
         if self.args.enable_parallel_backward_allred_opt and not self.args.fp16:
@@ -147,6 +149,7 @@ class Trainer(object):
         torch.cuda.manual_seed(seed)
 
         self._last_step = last_step
+        self._update_params = update_params
 
         # forward and backward pass
         sample = self._prepare_sample(sample)
@@ -166,7 +169,11 @@ class Trainer(object):
             logging_outputs = self._buffered_stats['logging_outputs']
             ooms_fwd = self._buffered_stats['ooms_fwd']
             ooms_bwd = self._buffered_stats['ooms_bwd']
-            if self.args.distributed_world_size > 1:
+            if self.args.distributed_world_size > 1 and getattr(self.args, 'fast_stat_sync', False):
+                sample_sizes, logging_outputs, ooms_fwd, ooms_bwd = self._all_reduce_stats(
+                    sample_sizes, logging_outputs, ooms_fwd, ooms_bwd,
+                )
+            elif self.args.distributed_world_size > 1:
                 sample_sizes, logging_outputs, ooms_fwd, ooms_bwd = map(
                     lambda l: list(chain.from_iterable(l)),
                     zip(*distributed_utils.all_gather_list(
@@ -219,6 +226,36 @@ class Trainer(object):
         else:
             return None  # buffering updates
 
+    def _all_reduce_stats(self, sample_sizes, logging_outputs, ooms_fwd, ooms_bwd):
+        """Sum the stats of all workers with a single all_reduce.
+
+        Returns the same lists as gathering them from all workers, except that
+        each list holds a single (summed) entry.
+        """
+        stats = OrderedDict([
+            ('_sample_size', sum(sample_sizes)),
+            ('_ooms_fwd', sum(ooms_fwd)),
+            ('_ooms_bwd', sum(ooms_bwd)),
+        ])
+        for log in logging_outputs:
+            for k, v in log.items():
+                stats[k] = stats.get(k, 0) + v
+
+        if self._stat_keys is None:
+            # agree on the keys once, a missing key counts as 0
+            all_keys = distributed_utils.all_gather_list(list(stats.keys()))
+            self._stat_keys = sorted(set(chain.from_iterable(all_keys)))
+        stats, has_extra_keys = distributed_utils.all_reduce_dict(stats, self._stat_keys)
+        if has_extra_keys:
+            # a worker logged a new key, agree on the keys again
+            self._stat_keys = None
+            return self._all_reduce_stats(sample_sizes, logging_outputs, ooms_fwd, ooms_bwd)
+
+        sample_size = stats.pop('_sample_size')
+        ooms_fwd = stats.pop('_ooms_fwd')
+        ooms_bwd = stats.pop('_ooms_bwd')
+        return [sample_size], [stats], [ooms_fwd], [ooms_bwd]
+
     def _forward(self, sample, eval=False):
         loss = None
         sample_size = 0
@@ -334,7 +371,11 @@ class Trainer(object):
         assert not oom_fwd, 'Ran out of memory during validation'
 
         # gather logging outputs from all GPUs
-        if self.args.distributed_world_size > 1:
+        if self.args.distributed_world_size > 1 and getattr(self.args, 'fast_stat_sync', False):
+            sample_sizes, logging_outputs, _, _ = self._all_reduce_stats(
+                [sample_size], [logging_output], [0], [0],
+            )
+        elif self.args.distributed_world_size > 1:
             sample_sizes, logging_outputs = zip(*distributed_utils.all_gather_list(
                 (sample_size, logging_output)
             ))
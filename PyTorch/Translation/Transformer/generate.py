@@ -27,6 +27,7 @@ from fairseq import bleu, data, options, progress_bar, tasks, tokenizer, utils
 from fairseq.meters import StopwatchMeter, TimeMeter
 from fairseq.sequence_generator import SequenceGenerator
 from fairseq.sequence_scorer import SequenceScorer
+from fairseq.shortlist import Shortlist
 
 
 def main(args):
@@ -90,15 +91,21 @@ def main(args):
             stop_early=(not args.no_early_stop), normalize_scores=(not args.unnormalized),
             len_penalty=args.lenpen, unk_penalty=args.unkpen,
             sampling=args.sampling, sampling_topk=args.sampling_topk, minlen=args.min_len,
+            shortlist=Shortlist.load(args.shortlist) if args.shortlist else None,
         )
 
     if use_cuda:
         translator.cuda()
 
+    if args.benchmark_lengths is not None:
+        benchmark_lengths(args, translator, itr, use_cuda)
+        return
+
     # Generate and compute BLEU score
     scorer = bleu.Scorer(tgt_dict.pad(), tgt_dict.eos(), tgt_dict.unk())
     num_sentences = 0
     has_target = True
+    ref_toks, hypo_toks = [], []
     with progress_bar.build_progress_bar(args, itr) as t:
         if args.score_reference:
             translations = translator.score_batched_itr(t, cuda=use_cuda, timer=gen_timer)
@@ -162,7 +169,8 @@ def main(args):
                         # Convert back to tokens for evaluation with unk replacement and/or without BPE
                         target_tokens = tokenizer.Tokenizer.tokenize(
                             target_str, tgt_dict, add_if_not_exist=True)
-                    scorer.add(target_tokens, hypo_tokens)
+                    ref_toks.append(target_tokens)
+                    hypo_toks.append(hypo_tokens)
 
             wps_meter.update(src_tokens.size(0))
             t.log({'wps': round(wps_meter.avg)})
@@ -171,9 +179,45 @@ def main(args):
     print('| Translated {} sentences ({} tokens) in {:.1f}s ({:.2f} sentences/s, {:.2f} tokens/s)'.format(
         num_sentences, gen_timer.n, gen_timer.sum, num_sentences / gen_timer.sum, 1. / gen_timer.avg))
     if has_target:
+        scorer.add_batch(ref_toks, hypo_toks)
         print('| Generate {} with beam={}: {}'.format(args.gen_subset, args.beam, scorer.result_string()))
 
 
+def benchmark_lengths(args, translator, itr, use_cuda):
+    """Measure generation speed as a function of the output length.
+
+    The first batch is translated once per requested length with the output
+    forced to exactly that length (EOS is suppressed until then), so the
+    tokens/s numbers show how the cost of a decoding step grows with the
+    number of already generated tokens.
+    """
+    assert not args.score_reference, '--benchmark-lengths cannot be used with --score-reference'
+    lengths = options.eval_str_list(args.benchmark_lengths, type=int)
+    sample = next(itr)
+    s = utils.move_to_cuda(sample) if use_cuda else sample
+    src_tokens = s['net_input']['src_tokens']
+    src_lengths = s['net_input']['src_lengths']
+    lengths = [min(length, translator.maxlen) for length in lengths]
+    print('| benchmarking {} sentences, beam={}'.format(src_tokens.size(0), args.beam))
+
+    # warm up, so that the first length doesn't pay for memory allocation
+    translator.minlen = lengths[0]
+    translator.generate(src_tokens, src_lengths, maxlen=lengths[0])
+
+    for length in lengths:
+        translator.minlen = length
+        if use_cuda:
+            torch.cuda.synchronize()
+        timer = StopwatchMeter()
+        timer.start()
+        hypos = translator.generate(src_tokens, src_lengths, maxlen=length)
+        if use_cuda:
+            torch.cuda.synchronize()
+        timer.stop(sum(len(h[0]['tokens']) for h in hypos))
+        print('| output length {:5d}: {:.3f}s ({:.2f} tokens/s, {:.2f} ms/step)'.format(
+            length, timer.sum, timer.n / timer.sum, 1000. * timer.sum / (length + 1)))
+
+
 if __name__ == '__main__':
     parser = options.get_generation_parser()
     args = options.parse_args_and_arch(parser)
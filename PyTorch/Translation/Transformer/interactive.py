@@ -21,15 +21,22 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from collections import namedtuple
+from collections import deque, namedtuple
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
 import numpy as np
+import queue
 import sys
+import threading
+import time
+import traceback
 
 import torch
 
 from fairseq import data, options, tasks, tokenizer, utils
 from fairseq.sequence_generator import SequenceGenerator
-from fairseq.meters import StopwatchMeter
+from fairseq.shortlist import Shortlist
+from fairseq.meters import PercentileMeter, StopwatchMeter, TimeMeter
 
 from apply_bpe import BPE
 
@@ -70,16 +77,266 @@ def make_batches(lines, args, src_dict, max_positions, bpe=None):
         ), batch['id']
 
 
+def make_hypos(src_str, hypos, args, align_dict, tgt_dict):
+    """Post-process the top predictions for a sentence.
+
+    Returns a list of (score, hypo_str, positional_scores, alignment).
+    """
+    result = []
+    for hypo in hypos[:min(len(hypos), args.nbest)]:
+        hypo_tokens, hypo_str, alignment = utils.post_process_prediction(
+            hypo_tokens=hypo['tokens'].int().cpu(),
+            src_str=src_str,
+            alignment=hypo['alignment'].int().cpu() if hypo['alignment'] is not None else None,
+            align_dict=align_dict,
+            tgt_dict=tgt_dict,
+            remove_bpe=args.remove_bpe,
+        )
+        hypo_str = tokenizer.Tokenizer.detokenize(hypo_str, 'de')
+        result.append((
+            hypo['score'],
+            hypo_str,
+            hypo['positional_scores'].tolist(),
+            [utils.item(x) for x in alignment] if args.print_alignment else None,
+        ))
+    return result
+
+
+class TranslationRequest(object):
+    """A single sentence waiting in the server queue."""
+
+    def __init__(self, src_str, tokens):
+        self.src_str = src_str
+        self.tokens = tokens
+        self.arrival_time = time.time()
+        self.hypos = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class TranslationServer(object):
+    """Serves translations over HTTP with dynamic batching.
+
+    Handler threads tokenize and apply BPE to the incoming sentences and put
+    them on a queue, so the CPU work of new requests overlaps with decoding.
+    The decoding loop (:func:`run`, in the main thread) collects sentences
+    from the queue into batches of up to *--max-tokens* (padded) tokens and
+    *--max-sentences* sentences, but does not make the oldest sentence wait
+    longer than *--batch-timeout* ms for the batch to fill up. Handler threads
+    post-process their own results.
+
+    Endpoints:
+        POST /translate: ``{"text": [sentence, ...]}`` or ``{"text": sentence}``,
+            returns ``{"translations": [{"src": ..., "hypos": [...]}, ...]}``
+        GET /stats: throughput and latency percentiles
+    """
+
+    def __init__(self, args, translator, src_dict, tgt_dict, max_positions, bpe, align_dict, use_cuda):
+        self.args = args
+        self.translator = translator
+        self.src_dict = src_dict
+        self.tgt_dict = tgt_dict
+        self.max_source_positions = max_positions[0] if isinstance(max_positions, tuple) else max_positions
+        self.bpe = bpe
+        self.align_dict = align_dict
+        self.use_cuda = use_cuda
+        self.max_tokens = args.max_tokens or float('inf')
+        self.max_sentences = args.max_sentences or float('inf')
+        self.batch_timeout = args.batch_timeout / 1000.
+
+        self.queue = queue.Queue()
+        self.pending = deque()
+        self.stats_lock = threading.Lock()
+        self.latency = PercentileMeter()
+        self.batch_latency = PercentileMeter()
+        self.sentences = TimeMeter()
+        self.tokens = TimeMeter()
+        self.num_requests = 0
+        self.num_batches = 0
+
+    def translate(self, lines):
+        """Translate a list of sentences, called from the handler threads."""
+        start = time.time()
+        requests = []
+        for src_str in lines:
+            tokens = tokenizer.Tokenizer.tokenize(
+                src_str, self.src_dict, tokenize=tokenizer.tokenize_en, add_if_not_exist=False, bpe=self.bpe,
+            ).long()
+            if tokens.numel() > self.max_source_positions:
+                raise ValueError('sentence is too long ({} > {} tokens): {}'.format(
+                    tokens.numel(), self.max_source_positions, src_str))
+            requests.append(TranslationRequest(src_str, tokens))
+        for request in requests:
+            self.queue.put(request)
+
+        results = []
+        for request in requests:
+            request.done.wait()
+            if request.error is not None:
+                raise RuntimeError(request.error)
+            results.append({
+                'src': request.src_str,
+                'hypos': [
+                    {'score': score, 'text': hypo_str.strip(), 'positional_scores': pos_scores, 'alignment': alignment}
+                    for score, hypo_str, pos_scores, alignment
+                    in make_hypos(request.src_str, request.hypos, self.args, self.align_dict, self.tgt_dict)
+                ],
+            })
+
+        with self.stats_lock:
+            self.num_requests += 1
+            self.latency.update(time.time() - start)
+        return results
+
+    def stats(self):
+        with self.stats_lock:
+            return {
+                'requests': self.num_requests,
+                'sentences': self.sentences.n,
+                'batches': self.num_batches,
+                'sentences_per_sec': self.sentences.avg,
+                'src_tokens_per_sec': self.tokens.avg,
+                'avg_batch_size': self.sentences.n / max(self.num_batches, 1),
+                'latency_ms': {
+                    'p50': 1000 * self.latency.percentile(50),
+                    'p90': 1000 * self.latency.percentile(90),
+                    'p99': 1000 * self.latency.percentile(99),
+                },
+                'batch_latency_ms': {
+                    'p50': 1000 * self.batch_latency.percentile(50),
+                    'p90': 1000 * self.batch_latency.percentile(90),
+                    'p99': 1000 * self.batch_latency.percentile(99),
+                },
+            }
+
+    def _next_request(self, deadline):
+        if self.pending:
+            return self.pending.popleft()
+        timeout = deadline - time.time() if deadline is not None else None
+        if timeout is not None and timeout <= 0:
+            return self.queue.get_nowait()
+        return self.queue.get(timeout=timeout)
+
+    def next_batch(self):
+        """Wait for the next batch of requests."""
+        batch = [self._next_request(None)]
+        deadline = batch[0].arrival_time + self.batch_timeout
+        max_len = batch[0].tokens.numel()
+        while len(batch) < self.max_sentences:
+            try:
+                request = self._next_request(deadline)
+            except queue.Empty:
+                break
+            num_tokens = max(max_len, request.tokens.numel()) * (len(batch) + 1)
+            if num_tokens > self.max_tokens:
+                self.pending.appendleft(request)
+                break
+            batch.append(request)
+            max_len = max(max_len, request.tokens.numel())
+        return batch
+
+    def process_batch(self, batch):
+        tokens = data.data_utils.collate_tokens(
+            [request.tokens for request in batch], self.src_dict.pad(), self.src_dict.eos(),
+            left_pad=self.args.left_pad_source,
+        )
+        lengths = torch.LongTensor([request.tokens.numel() for request in batch])
+        if self.use_cuda:
+            tokens = tokens.cuda()
+            lengths = lengths.cuda()
+
+        start = time.time()
+        try:
+            translations = self.translator.generate(
+                tokens,
+                lengths,
+                maxlen=int(self.args.max_len_a * tokens.size(1) + self.args.max_len_b),
+            )
+        except Exception:
+            error = traceback.format_exc()
+            print(error, file=sys.stderr)
+            translations = [None] * len(batch)
+        else:
+            error = None
+
+        with self.stats_lock:
+            self.num_batches += 1
+            self.batch_latency.update(time.time() - start)
+            self.sentences.update(len(batch))
+            self.tokens.update(utils.item(lengths.sum()))
+
+        for request, hypos in zip(batch, translations):
+            request.hypos = hypos
+            request.error = error
+            request.done.set()
+
+    def run(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def send_json(self, code, obj):
+                body = json.dumps(obj).encode('utf-8')
+                self.send_response(code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path != '/stats':
+                    return self.send_json(404, {'error': 'unknown path {}'.format(self.path)})
+                self.send_json(200, server.stats())
+
+            def do_POST(self):
+                if self.path != '/translate':
+                    return self.send_json(404, {'error': 'unknown path {}'.format(self.path)})
+                try:
+                    body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                    lines = body['text']
+                    if isinstance(lines, str):
+                        lines = [lines]
+                    lines = [line.strip() for line in lines]
+                    results = server.translate(lines)
+                except KeyError as e:
+                    return self.send_json(400, {'error': 'missing field {}'.format(e)})
+                except (ValueError, TypeError) as e:
+                    return self.send_json(400, {'error': str(e)})
+                except RuntimeError as e:
+                    return self.send_json(500, {'error': str(e)})
+                self.send_json(200, {'translations': results})
+
+            def log_message(self, format, *args):
+                pass
+
+        httpd = ThreadingHTTPServer((self.args.host, self.args.port), Handler)
+        httpd.daemon_threads = True
+        threading.Thread(target=httpd.serve_forever, daemon=True).start()
+        print('| Serving translations on http://{}:{}/translate'.format(self.args.host, self.args.port))
+        try:
+            while True:
+                self.process_batch(self.next_batch())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            httpd.shutdown()
+            print('| Server stats: {}'.format(json.dumps(self.stats())))
+
+
 def main(args):
-    if args.buffer_size < 1:
-        args.buffer_size = 1
-    if args.max_tokens is None and args.max_sentences is None:
-        args.max_sentences = 1
+    if args.port is not None:
+        assert args.max_tokens is not None or args.max_sentences is not None, \
+            '--port requires --max-tokens or --max-sentences to bound the batch size'
+    else:
+        if args.buffer_size < 1:
+            args.buffer_size = 1
+        if args.max_tokens is None and args.max_sentences is None:
+            args.max_sentences = 1
+        assert not args.max_sentences or args.max_sentences <= args.buffer_size, \
+            '--max-sentences/--batch-size cannot be larger than --buffer-size'
 
     assert not args.sampling or args.nbest == args.beam, \
         '--sampling requires --nbest to be equal to --beam'
-    assert not args.max_sentences or args.max_sentences <= args.buffer_size, \
-        '--max-sentences/--batch-size cannot be larger than --buffer-size'
 
     print(args)
 
@@ -111,13 +368,15 @@ def main(args):
         models, tgt_dict, beam_size=args.beam, stop_early=(not args.no_early_stop),
         normalize_scores=(not args.unnormalized), len_penalty=args.lenpen,
         unk_penalty=args.unkpen, sampling=args.sampling, sampling_topk=args.sampling_topk,
-        minlen=args.min_len, sampling_temperature=args.sampling_temperature
+        minlen=args.min_len, sampling_temperature=args.sampling_temperature,
+        shortlist=Shortlist.load(args.shortlist) if args.shortlist else None,
     )
 
     if use_cuda:
         translator.cuda()
 
     # Load BPE codes file
+    bpe = None
     if args.bpe_codes:
         codes = open(args.bpe_codes, 'r')
         bpe = BPE(codes)
@@ -134,29 +393,23 @@ def main(args):
         )
 
         # Process top predictions
-        for hypo in hypos[:min(len(hypos), args.nbest)]:
-            hypo_tokens, hypo_str, alignment = utils.post_process_prediction(
-                hypo_tokens=hypo['tokens'].int().cpu(),
-                src_str=src_str,
-                alignment=hypo['alignment'].int().cpu() if hypo['alignment'] is not None else None,
-                align_dict=align_dict,
-                tgt_dict=tgt_dict,
-                remove_bpe=args.remove_bpe,
-            )
-            hypo_str = tokenizer.Tokenizer.detokenize(hypo_str, 'de')
-            result.hypos.append('H\t{}\t{}'.format(hypo['score'], hypo_str))
+        for score, hypo_str, pos_scores, alignment in make_hypos(src_str, hypos, args, align_dict, tgt_dict):
+            result.hypos.append('H\t{}\t{}'.format(score, hypo_str))
             result.pos_scores.append('P\t{}'.format(
-                ' '.join(map(
-                    lambda x: '{:.4f}'.format(x),
-                    hypo['positional_scores'].tolist(),
-                ))
+                ' '.join(map(lambda x: '{:.4f}'.format(x), pos_scores))
             ))
             result.alignments.append(
-                'A\t{}'.format(' '.join(map(lambda x: str(utils.item(x)), alignment)))
+                'A\t{}'.format(' '.join(map(str, alignment)))
                 if args.print_alignment else None
             )
         return result
 
+    if args.port is not None:
+        server = TranslationServer(
+            args, translator, src_dict, tgt_dict, models[0].max_positions(), bpe, align_dict, use_cuda,
+        )
+        return server.run()
+
     gen_timer = StopwatchMeter()
     end2end_timer = StopwatchMeter()
 
@@ -2,37 +2,90 @@
 
 import argparse
 import collections
+import queue
+import threading
 import torch
 import os
 import re
 
 
-def average_checkpoints(inputs):
+def _load_checkpoint(path, mmap=False):
+    if mmap:
+        # tensors are backed by the (page cached) file until they are used
+        return torch.load(path, map_location='cpu', mmap=True)
+    return torch.load(
+        path,
+        map_location=(
+            lambda s, _: torch.serialization.default_restore_location(s, 'cpu')
+        ),
+    )
+
+
+def _prefetch_checkpoints(inputs, mmap=False):
+    """Yields (path, state) of the inputs, loading the next checkpoint in a
+    background thread while the current one is being processed.
+
+    The next checkpoint is only loaded once the current one has been taken,
+    so at most two checkpoints are in memory at the same time.
+    """
+    states = queue.Queue()
+    taken = threading.Semaphore(1)
+
+    def load():
+        try:
+            for f in inputs:
+                taken.acquire()
+                states.put((f, _load_checkpoint(f, mmap)))
+        except Exception as e:
+            states.put((None, e))
+            return
+        states.put((None, None))
+
+    loader = threading.Thread(target=load, daemon=True)
+    loader.start()
+    while True:
+        f, state = states.get()
+        if f is None:
+            if state is not None:
+                raise state
+            break
+        taken.release()
+        yield f, state
+        # drop the reference before waiting for the next checkpoint
+        del state
+    loader.join()
+
+
+def average_checkpoints(inputs, mmap=False):
     """Loads checkpoints from inputs and returns a model with averaged weights.
 
+    The checkpoints are summed one at a time into the parameters of the first
+    one (converted to float32 for half precision parameters), each parameter
+    is freed as soon as it has been added, and the next checkpoint is loaded
+    in the background meanwhile. The peak memory usage is the running sum
+    plus at most two checkpoints, the one being added, which shrinks as its
+    parameters are freed, and the one being loaded.
+
     Args:
       inputs: An iterable of string paths of checkpoints to load from.
+      mmap: memory-map the checkpoint files instead of reading them
+        (requires PyTorch >= 2.1).
 
     Returns:
       A dict of string keys mapping to various values. The 'model' key
       from the returned dict should correspond to an OrderedDict mapping
       string parameter names to torch Tensors.
     """
-    params_dict = collections.OrderedDict()
+    summed_params = collections.OrderedDict()
     params_keys = None
     new_state = None
-    for f in inputs:
-        state = torch.load(
-            f,
-            map_location=(
-                lambda s, _: torch.serialization.default_restore_location(s, 'cpu')
-            ),
-        )
+    num_models = 0
+    for f, state in _prefetch_checkpoints(inputs, mmap):
+        model_params = state.pop('model')
         # Copies over the settings from the first checkpoint
         if new_state is None:
             new_state = state
-
-        model_params = state['model']
+        del state
 
         model_params_keys = list(model_params.keys())
         if params_keys is None:
@@ -44,20 +97,21 @@ def average_checkpoints(inputs):
             )
 
         for k in params_keys:
-            if k not in params_dict:
-                params_dict[k] = []
-            p = model_params[k]
-            if isinstance(p, torch.HalfTensor):
-                p = p.float()
-            params_dict[k].append(p)
+            p = model_params.pop(k)
+            if k not in summed_params:
+                summed_params[k] = p.float() if p.dtype == torch.half else p
+            else:
+                summed_params[k].add_(p.type_as(summed_params[k]))
+            del p
+        num_models += 1
 
     averaged_params = collections.OrderedDict()
-    # v should be a list of torch Tensor.
-    for k, v in params_dict.items():
-        summed_v = None
-        for x in v:
-            summed_v = summed_v + x if summed_v is not None else x
-        averaged_params[k] = summed_v / len(v)
+    for k, v in summed_params.items():
+        if v.is_floating_point():
+            averaged_params[k] = v.div_(num_models)
+        else:
+            # We expect truncation for integer division
+            averaged_params[k] = v // num_models
     new_state['model'] = averaged_params
     return new_state
 
@@ -113,6 +167,12 @@ def main():
         help='if set, will try to find checkpoints with names checkpoint_ee_xx.pt in the path specified by input, '
              'and average last this many of them.',
     )
+    parser.add_argument(
+        '--mmap',
+        action='store_true',
+        help='memory-map the input checkpoints instead of reading them into memory '
+             '(requires PyTorch >= 2.1).',
+    )
     args = parser.parse_args()
     print(args)
 
@@ -128,7 +188,7 @@ def main():
         args.inputs = last_n_checkpoints(args.inputs, num, is_update_based)
         print('averaging checkpoints: ', args.inputs)
 
-    new_state = average_checkpoints(args.inputs)
+    new_state = average_checkpoints(args.inputs, args.mmap)
     torch.save(new_state, args.output)
     print('Finished writing averaged checkpoint to {}.'.format(args.output))
 
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# Copyright (c) 2019, NVIDIA CORPORATION. All rights reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import os
+
+from fairseq.data import Dictionary, IndexedInMemoryDataset
+from fairseq.shortlist import Shortlist
+
+
+def sentences(dataset):
+    for i in range(len(dataset)):
+        yield dataset.buffer[dataset.data_offsets[i]:dataset.data_offsets[i + 1]]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Tool to build a vocabulary shortlist (lexical translation '
+                    'table and most frequent target tokens) from a binarized '
+                    'training bitext, for use with --shortlist',
+    )
+    parser.add_argument('data', metavar='DIR',
+                        help='directory with the binarized data and dictionaries')
+    parser.add_argument('-s', '--source-lang', required=True, metavar='SRC',
+                        help='source language')
+    parser.add_argument('-t', '--target-lang', required=True, metavar='TARGET',
+                        help='target language')
+    parser.add_argument('--trainpref', default='train', metavar='FP',
+                        help='prefix of the training split')
+    parser.add_argument('--topk', type=int, default=50, metavar='N',
+                        help='number of translations kept per source token')
+    parser.add_argument('--num-frequent', type=int, default=2000, metavar='N',
+                        help='number of most frequent target tokens always in the shortlist')
+    parser.add_argument('--max-pairs', type=int, default=50000000, metavar='N',
+                        help='max number of distinct token pairs counted in memory')
+    parser.add_argument('--output', required=True, metavar='FILE',
+                        help='write the shortlist to this path')
+    args = parser.parse_args()
+    print(args)
+
+    src, tgt = args.source_lang, args.target_lang
+    src_dict = Dictionary.load(os.path.join(args.data, 'dict.{}.txt'.format(src)))
+    tgt_dict = Dictionary.load(os.path.join(args.data, 'dict.{}.txt'.format(tgt)))
+    assert src_dict.nspecial == tgt_dict.nspecial
+
+    prefix = os.path.join(args.data, '{}.{}-{}.'.format(args.trainpref, src, tgt))
+    if not IndexedInMemoryDataset.exists(prefix + src):
+        prefix = os.path.join(args.data, '{}.{}-{}.'.format(args.trainpref, tgt, src))
+    src_dataset = IndexedInMemoryDataset(prefix + src, fix_lua_indexing=True)
+    tgt_dataset = IndexedInMemoryDataset(prefix + tgt, fix_lua_indexing=True)
+    assert len(src_dataset) == len(tgt_dataset)
+    print('| {} {} sentence pairs'.format(prefix, len(src_dataset)))
+
+    shortlist = Shortlist.build(
+        sentences(src_dataset), sentences(tgt_dataset),
+        len(src_dict), len(tgt_dict), tgt_dict.nspecial,
+        topk=args.topk, num_frequent=args.num_frequent, max_pairs=args.max_pairs,
+    )
+    shortlist.save(args.output)
+    print('| wrote shortlist ({} x {} translations, {} frequent tokens) to {}'.format(
+        shortlist.table.size(0), shortlist.table.size(1), shortlist.frequent.numel(), args.output))
+
+
+if __name__ == '__main__':
+    main()
@@ -8,11 +8,14 @@
 import collections
 import os
 import tempfile
+import time
 import unittest
+from unittest import mock
 
 import numpy as np
 import torch
 
+from scripts import average_checkpoints as average_checkpoints_module
 from scripts.average_checkpoints import average_checkpoints
 
 
@@ -67,6 +70,53 @@ class TestAverageCheckpoints(unittest.TestCase):
                 err_msg='Tensor value mismatch for key {}'.format(k_expected)
             )
 
+    def test_average_checkpoints_streaming(self):
+        paths = []
+        for i in range(3):
+            fd, path = tempfile.mkstemp()
+            os.close(fd)
+            params = collections.OrderedDict([
+                ('a', torch.HalfTensor([i, 2 * i])),
+                ('b', torch.FloatTensor([[i + 1.0]])),
+            ])
+            torch.save(collections.OrderedDict([('model', params), ('args', i)]), path)
+            paths.append(path)
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        torch.save(collections.OrderedDict([('model', collections.OrderedDict([('a', torch.zeros(2))]))]), path)
+        paths.append(path)
+
+        try:
+            state = average_checkpoints(paths[:3])
+            with self.assertRaises(KeyError):
+                average_checkpoints(paths)
+        finally:
+            for path in paths:
+                os.remove(path)
+
+        # settings are copied from the first checkpoint
+        self.assertEqual(state['args'], 0)
+        self.assertEqual(state['model']['a'].dtype, torch.float32)
+        np.testing.assert_allclose(state['model']['a'].numpy(), [1.0, 2.0])
+        np.testing.assert_allclose(state['model']['b'].numpy(), [[2.0]])
+
+    def test_prefetch_loads_one_checkpoint_ahead(self):
+        events = []
+
+        def load(path, mmap=False):
+            events.append(('load', path))
+            return path
+
+        with mock.patch.object(average_checkpoints_module, '_load_checkpoint', load):
+            for path, _ in average_checkpoints_module._prefetch_checkpoints(range(4)):
+                events.append(('take', path))
+                # give the loader time to run ahead
+                time.sleep(0.05)
+
+        for i in range(2, 4):
+            # checkpoint i is loaded only once checkpoint i - 1 was taken
+            self.assertLess(events.index(('take', i - 1)), events.index(('load', i)))
+
 
 if __name__ == '__main__':
     unittest.main()
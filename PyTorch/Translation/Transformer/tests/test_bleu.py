@@ -0,0 +1,66 @@
+# Copyright (c) 2019, NVIDIA CORPORATION. All rights reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+import numpy as np
+import torch
+
+from fairseq import bleu
+from fairseq.data.data_utils import collate_tokens
+
+
+PAD, EOS, UNK = 1, 2, 3
+
+
+def get_stat(scorer):
+    return [getattr(scorer.stat, name) for name, _ in bleu.BleuStat._fields_]
+
+
+class TestBleu(unittest.TestCase):
+
+    def test_bleu_stats(self):
+        ref = [torch.IntTensor([4, 5, 6, 7, 2]), torch.IntTensor([4, 3, 5, 2])]
+        pred = [torch.IntTensor([1, 4, 5, 6, 8, 2, 2]), torch.IntTensor([4, 3, 5])]
+        stats = bleu.bleu_stats(ref, pred, PAD, EOS, UNK)
+        # unknown reference words never match
+        self.assertEqual(stats.tolist(), [7, 7, 5, 7, 2, 5, 1, 3, 0, 1])
+
+    def test_add_batch(self):
+        rng = np.random.RandomState(0)
+        ref, pred = [], []
+        for _ in range(100):
+            ref.append(torch.IntTensor(rng.randint(2, 12, size=rng.randint(1, 20))))
+            pred.append(torch.IntTensor(rng.randint(2, 12, size=rng.randint(1, 20))))
+        ref[0][:] = PAD
+        ref[0][-1] = 5
+
+        scorer = bleu.Scorer(PAD, EOS, UNK)
+        scorer.add_batch(collate_tokens(ref, PAD, EOS, left_pad=False),
+                         collate_tokens(pred, PAD, EOS, left_pad=True))
+        stat = get_stat(scorer)
+
+        scorer = bleu.Scorer(PAD, EOS, UNK)
+        scorer.add_batch(ref[:50], pred[:50])
+        scorer.add_batch(ref[50:], pred[50:])
+        self.assertEqual(get_stat(scorer), stat)
+
+        if bleu.C is not None:
+            scorer = bleu.Scorer(PAD, EOS, UNK)
+            for r, p in zip(ref, pred):
+                scorer.add(r, p)
+            self.assertEqual(get_stat(scorer), stat)
+
+
+if __name__ == '__main__':
+    unittest.main()
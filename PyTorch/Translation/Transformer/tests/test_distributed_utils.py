@@ -0,0 +1,91 @@
+# Copyright (c) 2019, NVIDIA CORPORATION. All rights reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import unittest
+
+import torch
+import torch.multiprocessing
+
+from fairseq import distributed_utils
+
+WORLD_SIZE = 2
+
+
+def _backward(model, rank, step):
+    torch.manual_seed(100 * step + rank)
+    x = torch.randn(3, 4)
+    h = model[0](x)
+    if not (rank == 1 and step == 2):
+        # the second layer gets no gradient on one worker in one step
+        h = model[1](h)
+    model[2](h).pow(2).sum().backward()
+
+
+def _reference_grads(params):
+    """Reduce the gradients of the parameters at the end of the step."""
+    flat = torch.cat([p.grad.view(-1) if p.grad is not None else p.new_zeros(p.numel()) for p in params])
+    flat.div_(WORLD_SIZE)
+    torch.distributed.all_reduce(flat)
+    return flat
+
+
+def _run_worker(rank, init_file):
+    torch.distributed.init_process_group(
+        backend='gloo', init_method='file://' + init_file, world_size=WORLD_SIZE, rank=rank)
+    torch.manual_seed(1)
+    model = torch.nn.ModuleList([torch.nn.Linear(4, 4), torch.nn.Linear(4, 4), torch.nn.Linear(4, 2)])
+    params = list(model.parameters())
+    # one bucket per parameter, so that the order of the all-reduces matters
+    buckets = distributed_utils.GradientBuckets(params, bucket_size=1, world_size=WORLD_SIZE)
+
+    def zero_grad():
+        for p in params:
+            p.grad = None
+
+    # dummy step, which does not update the parameters
+    buckets.reset(enabled=False)
+    _backward(model, rank, step=0)
+    zero_grad()
+
+    # (step, update_freq) of the following steps
+    for step, update_freq in ((1, 2), (2, 1), (3, 1)):
+        for i in range(update_freq):
+            buckets.reset(enabled=(i == update_freq - 1))
+            _backward(model, rank, step=10 * step + i if i < update_freq - 1 else step)
+        grad_norm = buckets.finish()
+        expected = _reference_grads(params)
+        assert torch.allclose(buckets.flat_grads, expected, atol=1e-6), (step, buckets.flat_grads, expected)
+        assert abs(grad_norm - expected.norm().item()) < 1e-5, (step, grad_norm, expected.norm().item())
+        zero_grad()
+
+
+class TestGradientBuckets(unittest.TestCase):
+
+    def test_buckets(self):
+        params = [torch.nn.Parameter(torch.zeros(n)) for n in (3, 5, 2, 4)]
+        buckets = distributed_utils.GradientBuckets(params, bucket_size=6, world_size=1)
+        self.assertEqual(
+            [(b["start"], b["end"], b["params"]) for b in buckets.buckets],
+            [(8, 14, [3, 2]), (0, 8, [1, 0])])
+
+    @unittest.skipIf(not torch.distributed.is_available(), 'torch.distributed is not available')
+    def test_matches_reduction_at_end_of_step(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            torch.multiprocessing.spawn(
+                _run_worker, args=(os.path.join(tmpdir, 'init'),), nprocs=WORLD_SIZE)
+
+
+if __name__ == '__main__':
+    unittest.main()
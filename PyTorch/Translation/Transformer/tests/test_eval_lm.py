@@ -0,0 +1,70 @@
+# Copyright (c) 2019, NVIDIA CORPORATION. All rights reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import unittest
+
+import numpy as np
+import torch
+
+import eval_lm
+from fairseq.meters import StopwatchMeter
+from fairseq.models.fconv import FConvDecoder
+from fairseq.models import FairseqLanguageModel
+from fairseq.sequence_scorer import SequenceScorer
+
+import tests.utils as test_utils
+
+
+class TestEvalLM(unittest.TestCase):
+
+    def test_sliding_windows(self):
+        starts, ends, score_starts = eval_lm.sliding_windows(11, window=4, stride=3)
+        self.assertEqual(starts.tolist(), [0, 3, 6, 7])
+        self.assertEqual(ends.tolist(), [4, 7, 10, 11])
+        self.assertEqual(score_starts.tolist(), [0, 4, 7, 10])
+
+        starts, ends, score_starts = eval_lm.sliding_windows(3, window=4, stride=2)
+        self.assertEqual((starts.tolist(), ends.tolist(), score_starts.tolist()), ([0], [3], [0]))
+
+    def test_make_batches(self):
+        lengths = np.array([4, 2, 4, 4, 3])
+        self.assertEqual(eval_lm.make_batches(lengths, max_tokens=8, max_sentences=None), [[0, 2], [3, 4], [1]])
+        self.assertEqual(eval_lm.make_batches(lengths, max_tokens=100, max_sentences=3), [[0, 2, 3], [4, 1]])
+
+    def test_incremental_matches_windows(self):
+        # the receptive field of the decoder (5 tokens) fits in the context of
+        # every window, so both modes must produce the same scores
+        torch.manual_seed(1)
+        d = test_utils.dummy_dictionary(vocab_size=10)
+        decoder = FConvDecoder(
+            d, embed_dim=8, convolutions=((8, 3),) * 2, out_embed_dim=8, attention=False,
+            dropout=0., positional_embeddings=False,
+        )
+        model = FairseqLanguageModel(decoder)
+        self.assertTrue(eval_lm.supports_incremental_eval(model))
+
+        stream = torch.randint(d.nspecial, len(d), (40,))
+        args = argparse.Namespace(
+            tokens_per_sample=8, stride=3, max_tokens=16, max_sentences=None,
+            log_format='none', no_progress_bar=True, log_interval=1000,
+        )
+        windows = eval_lm.score_windows(
+            args, SequenceScorer([model], d), stream, d.pad(), False, StopwatchMeter())
+        incremental = eval_lm.score_incremental(args, [model], stream, d.pad(), False, StopwatchMeter())
+        self.assertEqual(windows.size(), (39,))
+        self.assertTrue(torch.allclose(windows, incremental, atol=1e-5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,74 @@
+# Copyright (c) 2019, NVIDIA CORPORATION. All rights reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+
+from fairseq.shortlist import Shortlist
+
+
+class TestShortlist(unittest.TestCase):
+
+    def setUp(self):
+        # source token i + 4 is always translated as target token i + 10,
+        # target token 9 appears in every sentence
+        rng = np.random.RandomState(0)
+        self.src_sents, self.tgt_sents = [], []
+        for _ in range(200):
+            words = rng.choice(6, size=3, replace=False)
+            self.src_sents.append(np.concatenate([words + 4, [2]]))
+            self.tgt_sents.append(np.concatenate([words + 10, [9, 2]]))
+
+    def build(self, **kwargs):
+        return Shortlist.build(
+            self.src_sents, self.tgt_sents, src_vocab_size=10, tgt_vocab_size=16,
+            nspecial=4, **kwargs
+        )
+
+    def test_build(self):
+        shortlist = self.build(topk=1, num_frequent=1, chunk_size=7)
+        self.assertEqual(shortlist.table[4:].view(-1).tolist(), list(range(10, 16)))
+        self.assertEqual(shortlist.frequent.tolist(), [9])
+
+    def test_build_with_pruning(self):
+        # 42 distinct pairs, only the most frequent ones are kept
+        shortlist = self.build(topk=1, num_frequent=1, chunk_size=7, max_pairs=40)
+        self.assertEqual(shortlist.table[4:].view(-1).tolist(), list(range(10, 16)))
+
+    def test_candidates(self):
+        shortlist = self.build(topk=1, num_frequent=1)
+        src_tokens = torch.LongTensor([[1, 4, 6, 2], [5, 4, 4, 2]])
+        self.assertEqual(shortlist.candidates(src_tokens).tolist(), [0, 1, 2, 3, 9, 10, 11, 12])
+        self.assertEqual(
+            shortlist.candidates(src_tokens, torch.LongTensor([[15]])).tolist(),
+            [0, 1, 2, 3, 9, 10, 11, 12, 15],
+        )
+
+    def test_save_load(self):
+        shortlist = self.build(topk=2, num_frequent=1)
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'shortlist.pt')
+            shortlist.save(path)
+            loaded = Shortlist.load(path)
+        self.assertTrue(torch.equal(shortlist.table, loaded.table))
+        self.assertTrue(torch.equal(shortlist.frequent, loaded.frequent))
+        self.assertEqual(loaded.tgt_vocab_size, 16)
+        self.assertEqual(loaded.nspecial, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
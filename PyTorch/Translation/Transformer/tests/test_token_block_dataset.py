@@ -0,0 +1,127 @@
+# Copyright (c) 2019, NVIDIA CORPORATION. All rights reserved.
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import os
+import tempfile
+import unittest
+
+import numpy as np
+import torch
+import torch.multiprocessing
+
+from fairseq.data import Dictionary, TokenBlockDataset
+from fairseq.data.indexed_dataset import IndexedDatasetBuilder, IndexedMMapDataset
+from fairseq.tasks.language_modeling import LanguageModelingTask
+
+WORLD_SIZE = 2
+
+
+def _build_dataset(prefix, tokens, sizes):
+    builder = IndexedDatasetBuilder(prefix + '.bin')
+    for start, size in zip(np.cumsum([0] + sizes[:-1]), sizes):
+        builder.add_item(torch.from_numpy(tokens[start:start + size]))
+    builder.finalize(prefix + '.idx')
+
+
+def _load_with_cache(rank, data_dir, init_file, expected):
+    torch.distributed.init_process_group(
+        backend='gloo', init_method='file://' + init_file, world_size=WORLD_SIZE, rank=rank)
+    if rank > 0:
+        def build_slice_indices(*args):
+            raise AssertionError('only the master builds the block cache')
+        TokenBlockDataset.build_slice_indices = staticmethod(build_slice_indices)
+    args = argparse.Namespace(
+        data=data_dir, raw_text=False, mmap_dataset=True, cache_token_blocks=True,
+        sample_break_mode='complete', tokens_per_sample=5,
+        distributed_world_size=WORLD_SIZE, distributed_rank=rank)
+    task = LanguageModelingTask(args, Dictionary())
+    task.load_dataset('train')
+    slices = task.datasets['train'].dataset.slice_indices.tolist()
+    assert slices == expected, (rank, slices, expected)
+
+
+class TestTokenBlockDataset(unittest.TestCase):
+
+    def setUp(self):
+        self.sizes = [3, 1, 4, 2, 6, 1]
+        self.tokens = np.arange(sum(self.sizes), dtype=np.int64) + 10
+
+    def slices(self, ds):
+        return [tuple(s) for s in ds.slice_indices.tolist()]
+
+    def test_break_mode_none(self):
+        ds = TokenBlockDataset(self.tokens, self.sizes, 5, break_mode='none')
+        self.assertEqual(self.slices(ds), [(0, 5), (5, 10), (10, 15), (15, 17)])
+        self.assertEqual(ds.sizes.tolist(), [5, 5, 5, 2])
+
+    def test_break_mode_complete(self):
+        ds = TokenBlockDataset(self.tokens, self.sizes, 5, break_mode='complete')
+        # the sentence of 6 tokens exceeds the block size and gets its own block
+        self.assertEqual(self.slices(ds), [(0, 4), (4, 8), (8, 10), (10, 16), (16, 17)])
+
+    def test_break_mode_eos(self):
+        ds = TokenBlockDataset(self.tokens, self.sizes, 5, break_mode='eos')
+        self.assertEqual(self.slices(ds), [(0, 3), (4, 8), (8, 10), (10, 16)])
+
+    def test_include_targets(self):
+        ds = TokenBlockDataset(self.tokens, self.sizes, 5, break_mode='complete', include_targets=True)
+        source, target = ds[0]
+        self.assertEqual(source.tolist(), [26, 10, 11, 12])
+        self.assertEqual(target.tolist(), [10, 11, 12, 13])
+        source, target = ds[1]
+        self.assertEqual(source.tolist(), [13, 14, 15, 16])
+        self.assertEqual(target.dtype, torch.long)
+
+    def test_mmap_and_cache(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            prefix = os.path.join(tmpdir, 'train')
+            _build_dataset(prefix, self.tokens, self.sizes)
+
+            mmap_ds = IndexedMMapDataset(prefix, fix_lua_indexing=True)
+            self.assertEqual(mmap_ds[2].tolist(), [14, 15, 16, 17])
+
+            cache_path = prefix + '.blocks.npy'
+            ds = TokenBlockDataset(
+                mmap_ds.buffer, mmap_ds.sizes, 5, break_mode='complete', include_targets=True,
+                fix_lua_indexing=True, cache_path=cache_path,
+            )
+            self.assertTrue(os.path.exists(cache_path))
+            cached = TokenBlockDataset(
+                mmap_ds.buffer, mmap_ds.sizes, 5, break_mode='complete', include_targets=True,
+                fix_lua_indexing=True, cache_path=cache_path,
+            )
+            self.assertEqual(self.slices(cached), self.slices(ds))
+            self.assertEqual(ds[1][1].tolist(), self.tokens[4:8].tolist())
+            self.assertEqual(ds[0][0].tolist(), [26, 10, 11, 12])
+
+    @unittest.skipIf(not torch.distributed.is_available(), 'torch.distributed is not available')
+    def test_distributed_cache_built_by_master(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            prefix = os.path.join(tmpdir, 'train')
+            _build_dataset(prefix, self.tokens, self.sizes)
+            # a stale cache from a previous version of the dataset
+            cache_path = prefix + '.complete_5.blocks.npy'
+            np.save(cache_path, np.zeros((1, 2), dtype=np.int64))
+            idx_mtime = os.path.getmtime(prefix + '.idx')
+            os.utime(cache_path, (idx_mtime - 10, idx_mtime - 10))
+
+            expected = TokenBlockDataset.build_slice_indices(
+                self.sizes, 5, 'complete', len(self.tokens)).tolist()
+            torch.multiprocessing.spawn(
+                _load_with_cache, args=(tmpdir, os.path.join(tmpdir, 'init'), expected), nprocs=WORLD_SIZE)
+            self.assertEqual(np.load(cache_path).tolist(), expected)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -154,9 +154,6 @@ def train(args, trainer, task, epoch_itr):
     else:
         update_freq = args.update_freq[-1]
 
-    if args.enable_parallel_backward_allred_opt and update_freq > 1:
-        raise RuntimeError('--enable-parallel-backward-allred-opt is incompatible with --update-freq > 1')
-
     extra_meters = collections.defaultdict(lambda: AverageMeter())
     first_valid = args.valid_subset.split(',')[0]
     max_update = args.max_update or math.inf
@@ -207,11 +204,18 @@ def train(args, trainer, task, epoch_itr):
         stats[k] = meter.avg
     progress.print(stats)
 
+    bucket_meters = getattr(trainer, 'bucket_meters', [])
+    if bucket_meters:
+        print('| all-reduce time per bucket (ms): {}'.format(
+            ' '.join('{:.2f}'.format(meter.avg) for meter in bucket_meters)))
+
     # reset training meters
     for k in ['train_loss', 'train_nll_loss', 'wps', 'ups', 'wpb', 'bsz', 'clip']:
         meter = trainer.get_meter(k)
         if meter is not None:
             meter.reset()
+    for meter in bucket_meters:
+        meter.reset()
 
 
 def get_training_stats(trainer):
@@ -322,6 +326,7 @@ def score(args, trainer, task, epoch_itr, subset):
     num_sentences = 0
     has_target = True
     predictions = []
+    ref_toks, sys_toks = [], []
     with progress_bar.build_progress_bar(args, itr) as progress:
         translations = translator.generate_batched_itr(
                 progress, maxlen_a=args.max_len_a, maxlen_b=args.max_len_b,
@@ -356,7 +361,8 @@ def score(args, trainer, task, epoch_itr, subset):
                         target_str = target_str.replace(' ', '').replace('▁', ' ')
                     sys_tok = tokenizer.Tokenizer.tokenize((hypo_str.lower() if args.ignore_case else hypo_str), dict)
                     ref_tok = tokenizer.Tokenizer.tokenize((target_str.lower() if args.ignore_case else target_str), dict)
-                    scorer.add(ref_tok, sys_tok)
+                    ref_toks.append(ref_tok)
+                    sys_toks.append(sys_tok)
                     if not args.sentencepiece:
                         hypo_str = tokenizer.Tokenizer.detokenize(hypo_str, 'de')
                     predictions.append('{}\t{}'.format(sample_id, hypo_str))
@@ -365,6 +371,7 @@ def score(args, trainer, task, epoch_itr, subset):
             progress.log({'wps':round(wps_meter.avg)})
             num_sentences += 1
 
+    scorer.add_batch(ref_toks, sys_toks)
     if args.distributed_world_size > 1:
         _all_gather_bleu_scorer(scorer)
         predictions = _all_gather_predictions(predictions)
@@ -389,34 +396,8 @@ def score(args, trainer, task, epoch_itr, subset):
     return scorer.score(order=4), sacrebleu_score.score
 
 def _all_gather_predictions(predictions):
-    ready = False
-    all_ready = False
-    reduced_predictions = []
-    max_size = 65000
-    while not all_ready:
-        lst_len = len(predictions)
-        size = 2000     #some extra space for python stuff
-        n = 0
-        while n < lst_len:
-            str_len = len(predictions[n].encode('utf8')) + 8 # per string pickle overhead
-            if size + str_len >= max_size:
-                break
-            size += str_len
-            n += 1
-        chunk = predictions[:n]
-        predictions = predictions[n:]
-        if not predictions:
-            ready = True
-        chunk = (ready, chunk)
-        torch.cuda.synchronize()
-        gathered = distributed_utils.all_gather_list(chunk, max_size=65000)
-        torch.cuda.synchronize()
-        reduced_predictions += [t[1] for t in gathered]
-        all_ready = all([t[0] for t in gathered])
-
-    reduced_predictions = [item for sublist in reduced_predictions for item in sublist]
-
-    return reduced_predictions
+    gathered = distributed_utils.all_gather_list(predictions)
+    return [item for sublist in gathered for item in sublist]
 
 def _all_gather_bleu_scorer(scorer):
     stats = distributed_utils.all_gather_list(scorer.stat)
@@ -21,10 +21,14 @@ from __future__ import print_function
 import codecs
 import collections
 import json
+import os
 import re
+import threading
 
 import modeling
 import tokenization
+import numpy as np
+from six.moves import queue
 import tensorflow as tf
 
 flags = tf.flags
@@ -77,6 +81,12 @@ flags.DEFINE_bool(
     "tf.nn.embedding_lookup will be used. On TPUs, this should be True "
     "since it is much faster.")
 
+flags.DEFINE_enum(
+    "output_format", "json", ["json", "npy"],
+    "json: one JSON line per example with the values of every token and "
+    "layer. npy: float16 arrays in memory-mapped .npy files, written to the "
+    "output_file directory on the local filesystem.")
+
 
 class InputExample(object):
 
@@ -97,6 +107,80 @@ class InputFeatures(object):
     self.input_type_ids = input_type_ids
 
 
+class FeatureStoreWriter(object):
+  """Writes the features of all examples as float16 arrays in a directory of
+  memory-mapped .npy files:
+
+      embeddings.npy: [num_tokens, num_layers, hidden_size], the tokens of
+          all examples one after the other
+      offsets.npy: [num_examples + 1], the tokens of example i are
+          embeddings[offsets[i]:offsets[i + 1]]
+      unique_ids.npy: [num_examples], the line index of each example
+      layers.npy: [num_layers], the layer indexes
+      tokens.txt: the tokens of each example, one line per example
+
+  The examples are written on a background thread while the estimator
+  predicts the next ones.
+  """
+
+  def __init__(self, output_dir, features, layer_indexes, hidden_size,
+               max_pending=256):
+    lengths = np.array([len(f.tokens) for f in features], dtype=np.int64)
+    self.offsets = np.concatenate([[0], np.cumsum(lengths)])
+    self.feature_index = {f.unique_id: i for (i, f) in enumerate(features)}
+    if not os.path.exists(output_dir):
+      os.makedirs(output_dir)
+    np.save(os.path.join(output_dir, "offsets.npy"), self.offsets)
+    np.save(os.path.join(output_dir, "unique_ids.npy"),
+            np.array([f.unique_id for f in features], dtype=np.int64))
+    np.save(os.path.join(output_dir, "layers.npy"),
+            np.array(layer_indexes, dtype=np.int64))
+    with codecs.open(os.path.join(output_dir, "tokens.txt"), "w",
+                     "utf-8") as writer:
+      for feature in features:
+        writer.write(" ".join(feature.tokens) + "\n")
+    self.embeddings = np.lib.format.open_memmap(
+        os.path.join(output_dir, "embeddings.npy"), mode="w+",
+        dtype=np.float16,
+        shape=(int(self.offsets[-1]), len(layer_indexes), hidden_size))
+
+    self._error = None
+    self._queue = queue.Queue(maxsize=max_pending)
+    self._thread = threading.Thread(target=self._run)
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _run(self):
+    while True:
+      unique_id, layer_outputs = self._queue.get()
+      try:
+        index = self.feature_index[unique_id]
+        start, end = self.offsets[index], self.offsets[index + 1]
+        for (j, layer_output) in enumerate(layer_outputs):
+          self.embeddings[start:end, j] = layer_output[:end - start]
+      except Exception as e:  # pylint: disable=broad-except
+        self._error = e
+      finally:
+        self._queue.task_done()
+
+  def write(self, unique_id, layer_outputs):
+    """Enqueues the [seq_length, hidden_size] outputs of the layers of an
+    example."""
+    self._check_error()
+    self._queue.put((unique_id, layer_outputs))
+
+  def close(self):
+    """Blocks until all features are written and flushes them to disk."""
+    self._queue.join()
+    self._check_error()
+    self.embeddings.flush()
+
+  def _check_error(self):
+    if self._error is not None:
+      error, self._error = self._error, None
+      raise error
+
+
 def input_fn_builder(features, seq_length):
   """Creates an `input_fn` closure to be passed to TPUEstimator."""
 
@@ -384,6 +468,15 @@ def main(_):
   input_fn = input_fn_builder(
       features=features, seq_length=FLAGS.max_seq_length)
 
+  if FLAGS.output_format == "npy":
+    store = FeatureStoreWriter(FLAGS.output_file, features, layer_indexes,
+                               bert_config.hidden_size)
+    for result in estimator.predict(input_fn, yield_single_examples=True):
+      store.write(int(result["unique_id"]), [
+          result["layer_output_%d" % j] for j in range(len(layer_indexes))])
+    store.close()
+    return
+
   with codecs.getwriter("utf-8")(tf.gfile.Open(FLAGS.output_file,
                                                "w")) as writer:
     for result in estimator.predict(input_fn, yield_single_examples=True):
@@ -21,6 +21,7 @@ from __future__ import absolute_import, division, print_function
 import collections
 import json
 import math
+import multiprocessing
 import os
 import random
 import shutil
@@ -131,6 +132,11 @@ flags.DEFINE_integer(
     "because the start and end predictions are not conditioned on one another.")
 
 
+flags.DEFINE_integer(
+    "postprocessing_workers", 1,
+    "Number of processes extracting the n-best answers from the predicted "
+    "start and end logits.")
+
 flags.DEFINE_bool(
     "verbose_logging", False,
     "If true, all of the warnings related to data processing will be printed. "
@@ -424,130 +430,145 @@ RawResult = collections.namedtuple("RawResult",
                                    ["unique_id", "start_logits", "end_logits"])
 
 
-def write_predictions(all_examples, all_features, all_results, n_best_size,
-                      max_answer_length, do_lower_case, output_prediction_file,
-                      output_nbest_file, output_null_log_odds_file):
-  """Write final predictions to the json file and log-odds of null if needed."""
-  tf.logging.info("Writing predictions to: %s" % (output_prediction_file))
-  tf.logging.info("Writing nbest to: %s" % (output_nbest_file))
-
-  example_index_to_features = collections.defaultdict(list)
-  for feature in all_features:
-    example_index_to_features[feature.example_index].append(feature)
-
-  unique_id_to_result = {}
-  for result in all_results:
-    unique_id_to_result[result.unique_id] = result
-
-  _PrelimPrediction = collections.namedtuple(  # pylint: disable=invalid-name
-      "PrelimPrediction",
-      ["feature_index", "start_index", "end_index", "start_logit", "end_logit"])
-
-  all_predictions = collections.OrderedDict()
-  all_nbest_json = collections.OrderedDict()
-  scores_diff_json = collections.OrderedDict()
+class SpanPredictor(object):
+  """Computes the n-best answers of the examples from the logits of their
+  features.
+
+  The candidate spans of a feature are the pairs of its n-best start and end
+  indexes. They are filtered with masks of the valid start and end positions
+  of all features and ranked by the sum of their start and end logits. The
+  ranking is the same as a stable sort of all candidates, so the predictions
+  do not depend on how the examples are split between processes.
+  """
+
+  def __init__(self, all_examples, all_features, all_results, n_best_size,
+               max_answer_length, do_lower_case):
+    self.examples = all_examples
+    self.features = all_features
+    self.n_best_size = n_best_size
+    self.max_answer_length = max_answer_length
+    self.do_lower_case = do_lower_case
+
+    self.example_features = collections.defaultdict(list)
+    for (feature_index, feature) in enumerate(all_features):
+      self.example_features[feature.example_index].append(feature_index)
+
+    unique_id_to_result = {}
+    for result in all_results:
+      unique_id_to_result[result.unique_id] = result
+    results = [unique_id_to_result[feature.unique_id] for feature in all_features]
+    self.start_logits = np.array([r.start_logits for r in results], dtype=np.float64)
+    self.end_logits = np.array([r.end_logits for r in results], dtype=np.float64)
+
+    # spans end on a document token and start on one which is in its
+    # maximum context
+    self.start_valid = np.zeros(self.start_logits.shape, dtype=np.bool_)
+    self.end_valid = np.zeros(self.end_logits.shape, dtype=np.bool_)
+    for (feature_index, feature) in enumerate(all_features):
+      positions = np.fromiter(feature.token_to_orig_map, dtype=np.int64)
+      positions = positions[positions < len(feature.tokens)]
+      self.end_valid[feature_index, positions] = True
+      self.start_valid[feature_index, positions] = [
+          feature.token_is_max_context.get(p, False) for p in positions.tolist()]
+
+  def best_spans(self, feature_index):
+    """Returns the start and end indexes of the valid spans of a feature, in
+    the order of its n-best start indexes and then of its n-best end indexes."""
+    start_indexes = _get_best_indexes(self.start_logits[feature_index], self.n_best_size)
+    end_indexes = _get_best_indexes(self.end_logits[feature_index], self.n_best_size)
+    length = end_indexes[None, :] - start_indexes[:, None] + 1
+    valid = (self.start_valid[feature_index, start_indexes][:, None]
+             & self.end_valid[feature_index, end_indexes][None, :]
+             & (length >= 1) & (length <= self.max_answer_length))
+    start_ranks, end_ranks = np.nonzero(valid)
+    return start_indexes[start_ranks], end_indexes[end_ranks]
+
+  def span_text(self, example, feature_index, start_index, end_index):
+    feature = self.features[feature_index]
+    tok_tokens = feature.tokens[start_index:(end_index + 1)]
+    orig_doc_start = feature.token_to_orig_map[start_index]
+    orig_doc_end = feature.token_to_orig_map[end_index]
+    orig_tokens = example.doc_tokens[orig_doc_start:(orig_doc_end + 1)]
+    tok_text = " ".join(tok_tokens)
+
+    # De-tokenize WordPieces that have been split off.
+    tok_text = tok_text.replace(" ##", "")
+    tok_text = tok_text.replace("##", "")
+
+    # Clean whitespace
+    tok_text = tok_text.strip()
+    tok_text = " ".join(tok_text.split())
+    orig_text = " ".join(orig_tokens)
+
+    return get_final_text(tok_text, orig_text, self.do_lower_case)
+
+  def __call__(self, example_index):
+    """Returns the n-best predictions of an example as a list of dicts, and
+    the score of its null answer."""
+    example = self.examples[example_index]
 
-  for (example_index, example) in enumerate(all_examples):
-    features = example_index_to_features[example_index]
-
-    prelim_predictions = []
     # keep track of the minimum score of null start+end of position 0
     score_null = 1000000  # large and positive
     min_null_feature_index = 0  # the paragraph slice with min mull score
     null_start_logit = 0  # the start logit at the slice with min null score
     null_end_logit = 0  # the end logit at the slice with min null score
-    for (feature_index, feature) in enumerate(features):
-      result = unique_id_to_result[feature.unique_id]
-      start_indexes = _get_best_indexes(result.start_logits, n_best_size)
-      end_indexes = _get_best_indexes(result.end_logits, n_best_size)
+    feature_indexes, start_indexes, end_indexes = [], [], []
+    for feature_index in self.example_features[example_index]:
       # if we could have irrelevant answers, get the min score of irrelevant
       if FLAGS.version_2_with_negative:
-        feature_null_score = result.start_logits[0] + result.end_logits[0]
+        feature_null_score = self.start_logits[feature_index, 0] + self.end_logits[feature_index, 0]
         if feature_null_score < score_null:
-          score_null = feature_null_score
+          score_null = float(feature_null_score)
           min_null_feature_index = feature_index
-          null_start_logit = result.start_logits[0]
-          null_end_logit = result.end_logits[0]
-      for start_index in start_indexes:
-        for end_index in end_indexes:
-          # We could hypothetically create invalid predictions, e.g., predict
-          # that the start of the span is in the question. We throw out all
-          # invalid predictions.
-          if start_index >= len(feature.tokens):
-            continue
-          if end_index >= len(feature.tokens):
-            continue
-          if start_index not in feature.token_to_orig_map:
-            continue
-          if end_index not in feature.token_to_orig_map:
-            continue
-          if not feature.token_is_max_context.get(start_index, False):
-            continue
-          if end_index < start_index:
-            continue
-          length = end_index - start_index + 1
-          if length > max_answer_length:
-            continue
-          prelim_predictions.append(
-              _PrelimPrediction(
-                  feature_index=feature_index,
-                  start_index=start_index,
-                  end_index=end_index,
-                  start_logit=result.start_logits[start_index],
-                  end_logit=result.end_logits[end_index]))
-
+          null_start_logit = float(self.start_logits[feature_index, 0])
+          null_end_logit = float(self.end_logits[feature_index, 0])
+      starts, ends = self.best_spans(feature_index)
+      feature_indexes.append(np.full(len(starts), feature_index))
+      start_indexes.append(starts)
+      end_indexes.append(ends)
     if FLAGS.version_2_with_negative:
-      prelim_predictions.append(
-          _PrelimPrediction(
-              feature_index=min_null_feature_index,
-              start_index=0,
-              end_index=0,
-              start_logit=null_start_logit,
-              end_logit=null_end_logit))
-    prelim_predictions = sorted(
-        prelim_predictions,
-        key=lambda x: (x.start_logit + x.end_logit),
-        reverse=True)
+      feature_indexes.append(np.array([min_null_feature_index]))
+      start_indexes.append(np.zeros(1, dtype=np.int64))
+      end_indexes.append(np.zeros(1, dtype=np.int64))
+    feature_indexes = np.concatenate(feature_indexes or [np.zeros(0, dtype=np.int64)])
+    start_indexes = np.concatenate(start_indexes or [np.zeros(0, dtype=np.int64)])
+    end_indexes = np.concatenate(end_indexes or [np.zeros(0, dtype=np.int64)])
+    start_logits = self.start_logits[feature_indexes, start_indexes]
+    end_logits = self.end_logits[feature_indexes, end_indexes]
+    if FLAGS.version_2_with_negative:
+      start_logits[-1], end_logits[-1] = null_start_logit, null_end_logit
+    scores = start_logits + end_logits
 
     _NbestPrediction = collections.namedtuple(  # pylint: disable=invalid-name
         "NbestPrediction", ["text", "start_logit", "end_logit"])
 
     seen_predictions = {}
     nbest = []
-    for pred in prelim_predictions:
-      if len(nbest) >= n_best_size:
-        break
-      feature = features[pred.feature_index]
-      if pred.start_index > 0:  # this is a non-null prediction
-        tok_tokens = feature.tokens[pred.start_index:(pred.end_index + 1)]
-        orig_doc_start = feature.token_to_orig_map[pred.start_index]
-        orig_doc_end = feature.token_to_orig_map[pred.end_index]
-        orig_tokens = example.doc_tokens[orig_doc_start:(orig_doc_end + 1)]
-        tok_text = " ".join(tok_tokens)
-
-        # De-tokenize WordPieces that have been split off.
-        tok_text = tok_text.replace(" ##", "")
-        tok_text = tok_text.replace("##", "")
-
-        # Clean whitespace
-        tok_text = tok_text.strip()
-        tok_text = " ".join(tok_text.split())
-        orig_text = " ".join(orig_tokens)
-
-        final_text = get_final_text(tok_text, orig_text, do_lower_case)
-        if final_text in seen_predictions:
-          continue
-
-        seen_predictions[final_text] = True
-      else:
-        final_text = ""
-        seen_predictions[final_text] = True
+    # rank all candidates only if duplicate texts leave the n-best incomplete
+    num_ranked = 0
+    for k in (2 * self.n_best_size, len(scores)):
+      order = _get_best_indexes(scores, k)
+      for i in order[num_ranked:].tolist():
+        if len(nbest) >= self.n_best_size:
+          break
+        if start_indexes[i] > 0:  # this is a non-null prediction
+          final_text = self.span_text(example, feature_indexes[i], start_indexes[i], end_indexes[i])
+          if final_text in seen_predictions:
+            continue
 
-      nbest.append(
-          _NbestPrediction(
-              text=final_text,
-              start_logit=pred.start_logit,
-              end_logit=pred.end_logit))
+          seen_predictions[final_text] = True
+        else:
+          final_text = ""
+          seen_predictions[final_text] = True
+
+        nbest.append(
+            _NbestPrediction(
+                text=final_text,
+                start_logit=float(start_logits[i]),
+                end_logit=float(end_logits[i])))
+      num_ranked = len(order)
+      if len(nbest) >= self.n_best_size or num_ranked == len(scores):
+        break
 
     # if we didn't inlude the empty option in the n-best, inlcude it
     if FLAGS.version_2_with_negative:
@@ -565,12 +586,8 @@ def write_predictions(all_examples, all_features, all_results, n_best_size,
     assert len(nbest) >= 1
 
     total_scores = []
-    best_non_null_entry = None
     for entry in nbest:
       total_scores.append(entry.start_logit + entry.end_logit)
-      if not best_non_null_entry:
-        if entry.text:
-          best_non_null_entry = entry
 
     probs = _compute_softmax(total_scores)
 
@@ -584,18 +601,58 @@ def write_predictions(all_examples, all_features, all_results, n_best_size,
       nbest_json.append(output)
 
     assert len(nbest_json) >= 1
+    return nbest_json, score_null
+
+
+def _init_span_predictor(span_predictor):
+  global _span_predictor
+  _span_predictor = span_predictor
+
+
+def _predict_chunk(example_indexes):
+  return [_span_predictor(i) for i in example_indexes]
+
 
+def write_predictions(all_examples, all_features, all_results, n_best_size,
+                      max_answer_length, do_lower_case, output_prediction_file,
+                      output_nbest_file, output_null_log_odds_file, num_workers=1):
+  """Write final predictions to the json file and log-odds of null if needed.
+
+  The examples are processed by a pool of `num_workers` processes when it is
+  larger than 1.
+  """
+  tf.logging.info("Writing predictions to: %s" % (output_prediction_file))
+  tf.logging.info("Writing nbest to: %s" % (output_nbest_file))
+
+  span_predictor = SpanPredictor(all_examples, all_features, all_results, n_best_size,
+                                 max_answer_length, do_lower_case)
+  if num_workers <= 1:
+    predictions = [span_predictor(i) for i in range(len(all_examples))]
+  else:
+    chunk_size = max(1, int(math.ceil(len(all_examples) / (num_workers * 4))))
+    chunks = [range(i, min(i + chunk_size, len(all_examples)))
+              for i in range(0, len(all_examples), chunk_size)]
+    with multiprocessing.Pool(num_workers, initializer=_init_span_predictor,
+                              initargs=(span_predictor,)) as pool:
+      predictions = [p for chunk in pool.imap(_predict_chunk, chunks) for p in chunk]
+
+  all_predictions = collections.OrderedDict()
+  all_nbest_json = collections.OrderedDict()
+  scores_diff_json = collections.OrderedDict()
+
+  for (example, (nbest_json, score_null)) in zip(all_examples, predictions):
     if not FLAGS.version_2_with_negative:
       all_predictions[example.qas_id] = nbest_json[0]["text"]
     else:
+      best_non_null_entry = next(entry for entry in nbest_json if entry["text"])
       # predict "" iff the null score - the score of best non-null > threshold
-      score_diff = score_null - best_non_null_entry.start_logit - (
-          best_non_null_entry.end_logit)
+      score_diff = score_null - best_non_null_entry["start_logit"] - (
+          best_non_null_entry["end_logit"])
       scores_diff_json[example.qas_id] = score_diff
       if score_diff > FLAGS.null_score_diff_threshold:
         all_predictions[example.qas_id] = ""
       else:
-        all_predictions[example.qas_id] = best_non_null_entry.text
+        all_predictions[example.qas_id] = best_non_null_entry["text"]
 
     all_nbest_json[example.qas_id] = nbest_json
 
@@ -707,15 +764,15 @@ def get_final_text(pred_text, orig_text, do_lower_case):
 
 
 def _get_best_indexes(logits, n_best_size):
-  """Get the n-best logits from a list."""
-  index_and_score = sorted(enumerate(logits), key=lambda x: x[1], reverse=True)
-
-  best_indexes = []
-  for i in range(len(index_and_score)):
-    if i >= n_best_size:
-      break
-    best_indexes.append(index_and_score[i][0])
-  return best_indexes
+  """Get the indexes of the n-best logits of an array, in the order of a stable
+  sort by decreasing logit."""
+  if n_best_size < len(logits):
+    kth = logits[np.argpartition(-logits, n_best_size - 1)[n_best_size - 1]]
+    candidates = np.flatnonzero(logits >= kth)
+  else:
+    candidates = np.arange(len(logits))
+  order = np.argsort(-logits[candidates], kind='stable')
+  return candidates[order[:n_best_size]]
 
 
 def _compute_softmax(scores):
@@ -1156,7 +1213,8 @@ def main(_):
     write_predictions(eval_examples, eval_features, all_results,
                       FLAGS.n_best_size, FLAGS.max_answer_length,
                       FLAGS.do_lower_case, output_prediction_file,
-                      output_nbest_file, output_null_log_odds_file)
+                      output_nbest_file, output_null_log_odds_file,
+                      FLAGS.postprocessing_workers)
 
 
 if __name__ == "__main__":